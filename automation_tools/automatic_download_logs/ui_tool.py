@@ -22,6 +22,10 @@ Update history:
     2. 2021/01/11 update, Added the ability to manually fill in cookies to enter the website
     3. 2021/01/12 update, Solve the GUI date control over the year calculation problem
 
+# 2026/10/19 update -> Version: 3.1
+    1. The measurement files are downloaded by a fixed pool of worker threads instead of one thread per test record
+    2. Exiting the GUI cancels the running crawl instead of killing the process
+
 =========================================================
 """
 # -*- coding:utf-8 -*-
@@ -31,11 +35,11 @@ Update history:
 
 import os
 import re
-import sys
 import json
 import time
 import html
 import base64
+import queue
 import requests
 import threading
 import calendar
@@ -44,6 +48,7 @@ import tkinter.font as tkFont
 
 from tkinter import ttk
 from tkinter import messagebox
+from requests.adapters import HTTPAdapter
 
 # global
 spider = None
@@ -51,20 +56,99 @@ datetime = calendar.datetime.datetime
 timedelta = calendar.datetime.timedelta
 
 
+class CrawlTask(object):
+
+    def __init__(self, measurement_data):
+        """
+        One search result to be crawled and its own result
+        :param dict measurement_data: Measurement data of the search result
+        """
+        self.measurement_data = measurement_data
+        self.status = 'pending'  # pending, running, done, failed or cancelled
+        self.downloaded = []  # Downloaded log names
+        self.failed = []  # Log names which failed to download
+        self.error = None
+
+
+class CrawlEngine(object):
+
+    def __init__(self, handler, worker_number=10):
+        """
+        Run crawl tasks from a work queue with at most worker_number daemon threads,
+        the threads are created on demand and reused by the following crawls
+        :param handler: Function called with each CrawlTask
+        :param int worker_number: Maximum number of worker threads
+        """
+        self.handler = handler
+        self.worker_number = worker_number
+        self.task_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.workers = []
+
+    def start_worker(self):
+        while True:
+            task = self.task_queue.get()
+            try:
+                if self.cancel_event.is_set():
+                    task.status = 'cancelled'
+                    continue
+                task.status = 'running'
+                self.handler(task)
+                task.status = 'cancelled' if self.cancel_event.is_set() else 'failed' if task.failed else 'done'
+            except Exception as ex:
+                task.status = 'failed'
+                task.error = ex
+                print('Crawl {} failed: {}'.format(task.measurement_data.get('sernum'), ex))
+            finally:
+                self.task_queue.task_done()
+
+    def run(self, tasks):
+        """
+        Put the tasks into the work queue and wait until all of them are finished or cancelled
+        :param list tasks: CrawlTask list
+        :return: CrawlTask list
+        """
+        self.cancel_event.clear()
+        for task in tasks:
+            self.task_queue.put(task)
+        while len(self.workers) < min(self.worker_number, len(tasks)):
+            worker = threading.Thread(target=self.start_worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.task_queue.join()
+        return tasks
+
+    def cancel(self):
+        """
+        The pending tasks are skipped and the running tasks stop before their next download
+        :return:
+        """
+        self.cancel_event.set()
+
+
 class CCCSpider(object):
 
     def __init__(self, login_account, thread_pool_max=10):
         self.login_account = login_account
-        self.download_results = []
-        self.thread_pool = threading.Semaphore(value=thread_pool_max)
+        self.crawl_tasks = []
+        self.crawl_engine = CrawlEngine(handler=self.get_measurement_log_file, worker_number=thread_pool_max)
+        self.downloaded_names = set()  # Log names downloaded or being downloaded, to skip duplicate test logs
+        self.downloaded_lock = threading.Lock()
         self.root_url = 'https://cesium.cisco.com/apps/cesiumhome/overview'
         self.verification_source_url = 'https://api-dbbfec7f.duosecurity.com'
         self.verification_prompt_url = self.verification_source_url + '/frame/prompt'
         self.verification_status_url = self.verification_source_url + '/frame/status'
+        self.session_lock = threading.Lock()
         self.session = requests.Session()
-        self.session.headers.update({
+        # Every worker thread keeps its connection to the website alive instead of a new TLS handshake per request
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(thread_pool_max, 10), pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.update_session(headers={
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)'
-                          ' Chrome/80.0.3987.132 Safari/537.36'
+                          ' Chrome/80.0.3987.132 Safari/537.36',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
         })
 
     def login(self, authentication_code=''):
@@ -166,7 +250,7 @@ class CCCSpider(object):
                                     resp = self.session.get(token_url)
                                     token = resp.json()['session']
                                     # Adds a token to the crawler
-                                    self.session.headers.update({
+                                    self.update_session(headers={
                                         'csession': token,
                                         '_csession': token
                                     })
@@ -191,11 +275,41 @@ class CCCSpider(object):
         :param login_session: Manually enter the CCC website and copy the session to here
         :return:
         """
-        self.session.headers.update({
+        self.update_session(headers={
             'csession': login_session,
             '_csession': login_session
-        })
-        self.session.cookies.update(self.cookie_format_conversion(login_cookie))
+        }, cookies=self.cookie_format_conversion(login_cookie))
+
+    def update_session(self, headers=None, cookies=None):
+        """
+        Update the headers and cookies shared by the download threads, the headers are replaced by
+        an updated copy so a request being prepared in another thread never sees them half updated
+        :param dict headers: Headers to add or replace
+        :param dict cookies: Cookies to add or replace
+        :return:
+        """
+        with self.session_lock:
+            if headers:
+                new_headers = self.session.headers.copy()
+                new_headers.update(headers)
+                self.session.headers = new_headers
+            if cookies:
+                self.session.cookies.update(cookies)
+
+    def get_connection_stats(self):
+        """
+        Connection reuse of the session, read from the urllib3 connection pools
+        :return: {'requests': number, 'new_connections': number, 'reuse_rate': ratio}
+        """
+        request_number = connection_number = 0
+        for adapter in set(self.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    request_number += pool.num_requests
+                    connection_number += pool.num_connections
+        reuse_rate = 1 - connection_number / request_number if request_number else 0
+        return {'requests': request_number, 'new_connections': connection_number, 'reuse_rate': round(reuse_rate, 3)}
 
     def login_ccc(self, automatic_login=True, authentication_code='', login_cookies={}):
         """
@@ -278,49 +392,61 @@ class CCCSpider(object):
             flag = True
         return flag
 
-    def get_measurement_log_file(self, measurement_data, download_file_list=[]):
+    @property
+    def download_results(self):
+        """
+        Downloaded log names of the last crawl, in the order of the search results
+        :return: list
+        """
+        return [log_name for task in self.crawl_tasks for log_name in task.downloaded]
+
+    def get_measurement_log_file(self, task, download_file_list=[]):
         """
         Get measurement log file
-        :param dict measurement_data: Measurement data
+        :param CrawlTask task: Crawl task of the measurement data, the results are recorded in it
         :param list download_file_list: Fill in the specified file type to download
         :return:
         """
-        with self.thread_pool:  # Controls the number of thread pools
-            serial_number = measurement_data['sernum']
-            params = {
-                'area': measurement_data['area'],
-                'server': 'prod',
-                'timeid': measurement_data['tst_id'],
-                'uuttype': measurement_data['uuttype']
-            }
-            for measures in self.get_measurement_data(serial_number=serial_number,
-                                                      download_file_list=download_file_list,
-                                                      request_params=params):
-                if measures:
-                    test_time = measurement_data['rectime'].replace(' ', '_').replace(':', '-')
-                    test_status = measurement_data['attributes'].get('TEST') or 'PASS'
-                    if ':' in test_status:
-                        test_status = test_status.split(':')[0]
-                    # Log name = 'ApolloServer - SN - TestTime - TestStatus - MeasuresType.log'
-                    log_name = '{}_{}_{}_{}_{}.log'.format(measurement_data['machine'], serial_number,
-                                                           test_time, test_status, measures[0])
-                    # Skip duplicate test logs
-                    if log_name in self.download_results:
+        measurement_data = task.measurement_data
+        serial_number = measurement_data['sernum']
+        params = {
+            'area': measurement_data['area'],
+            'server': 'prod',
+            'timeid': measurement_data['tst_id'],
+            'uuttype': measurement_data['uuttype']
+        }
+        for measures in self.get_measurement_data(serial_number=serial_number,
+                                                  download_file_list=download_file_list,
+                                                  request_params=params):
+            if self.crawl_engine.cancel_event.is_set():
+                return
+            if measures:
+                test_time = measurement_data['rectime'].replace(' ', '_').replace(':', '-')
+                test_status = measurement_data['attributes'].get('TEST') or 'PASS'
+                if ':' in test_status:
+                    test_status = test_status.split(':')[0]
+                # Log name = 'ApolloServer - SN - TestTime - TestStatus - MeasuresType.log'
+                log_name = '{}_{}_{}_{}_{}.log'.format(measurement_data['machine'], serial_number,
+                                                       test_time, test_status, measures[0])
+                # Skip duplicate test logs
+                with self.downloaded_lock:
+                    if log_name in self.downloaded_names:
                         continue
-                    # Download the test log file
+                    self.downloaded_names.add(log_name)
+                # Download the test log file
+                flag = self.download_measurement_log(file_name=log_name, binary_id=measures[1])
+                if not flag:
+                    # If download the test log fail, try again
+                    time.sleep(1)
                     flag = self.download_measurement_log(file_name=log_name, binary_id=measures[1])
-                    if flag:
-                        self.download_results.append(log_name)
-                        print('Download the file << {} >> succeeded'.format(log_name))
-                    else:
-                        # If download the test log fail, try again
-                        time.sleep(1)
-                        flag = self.download_measurement_log(file_name=log_name, binary_id=measures[1])
-                        if flag:
-                            self.download_results.append(log_name)
-                            print('Download the file << {} >> succeeded'.format(log_name))
-                        else:
-                            print('Download the file << {} >> failed !!!')
+                if flag:
+                    task.downloaded.append(log_name)
+                    print('Download the file << {} >> succeeded'.format(log_name))
+                else:
+                    with self.downloaded_lock:
+                        self.downloaded_names.discard(log_name)
+                    task.failed.append(log_name)
+                    print('Download the file << {} >> failed !!!'.format(log_name))
 
     def start_crawl(self, first_request_data={}, download_file_list=[]):
         """
@@ -334,20 +460,22 @@ class CCCSpider(object):
             raise ValueError('No data was found, Please check that the information you entered is correct!')
         print('Crawling all test data is completed, test records count: {}'.format(len(all_data['results'])))
 
-        self.download_results = []
-        threads = []
-        print('Start multi-threading to download the measurement file')
-        for each_data in all_data['results']:
-            t = threading.Thread(target=self.get_measurement_log_file, args=(each_data, download_file_list))
-            t.daemon = True
-            threads.append(t)
-
-        for thread in threads:
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+        self.crawl_engine.handler = lambda task: self.get_measurement_log_file(task, download_file_list)
+        self.crawl_tasks = [CrawlTask(measurement_data=each_data) for each_data in all_data['results']]
+        self.downloaded_names = set()
+        print('Start the worker threads to download the measurement file')
+        self.crawl_engine.run(self.crawl_tasks)
+        if self.crawl_engine.cancel_event.is_set():
+            raise RuntimeError('The crawl has been cancelled, download count: {}'.format(len(self.download_results)))
         print('All the measurement files have been downloaded, download count: {}'.format(len(self.download_results)))
+        print('Connection stats: {}'.format(self.get_connection_stats()))
+
+    def cancel_crawl(self):
+        """
+        Stop the running crawl, the downloads in progress are finished
+        :return:
+        """
+        self.crawl_engine.cancel()
 
 
 class Calendar(object):
@@ -592,7 +720,7 @@ class SpiderGui(object):
         self.build_storage_folder()
         self.root = tk.Tk()
         self.root.geometry('640x410')
-        self.root.title('Download CCC Test Log Tool                         @Author: Evan Liu | @Version: 3.0')
+        self.root.title('Download CCC Test Log Tool                         @Author: Evan Liu | @Version: 3.1')
 
         self.build_date_frame()
         self.build_request_data_frame()
@@ -633,21 +761,9 @@ class SpiderGui(object):
         self.button_frame.grid(row=2, column=1, sticky=tk.NSEW, rowspan=2, columnspan=3)
 
     def tk_quit(self):
-        try:
-            # Gets the name of the currently running program
-            file_path = sys.argv[0]
-            if '/' in file_path:
-                app_name = sys.argv[0].split('/')[-1]
-            else:
-                app_name = sys.argv[0].split('\\')[-1]
-
-            if '.py' in app_name:
-                app_name = app_name.split('.py')[0] + '.exe'
-
-            print('kill app name: {}'.format(app_name))
-            os.system('taskkill /im {} /f'.format(app_name))  # Force kill process
-        except Exception:
-            pass
+        # The login and crawl threads are daemon threads, the process exits with the GUI
+        if spider:
+            spider.cancel_crawl()
         self.root.destroy()
         self.root.quit()
 
@@ -970,7 +1086,7 @@ and manually copy the "cookie" and "csession" values to start the tool
         self.running_label_2.grid(row=1, column=1, sticky=tk.W, pady=5)
 
     def start_login(self):
-        threading.Thread(target=self._start_login, args=()).start()
+        threading.Thread(target=self._start_login, args=(), daemon=True).start()
 
     def _start_login(self):
         login_cookie = self.login_cookie.get(1.0, tk.END).strip()
@@ -1024,7 +1140,7 @@ and manually copy the "cookie" and "csession" values to start the tool
             self.board.insert(tk.END, 'The download result is empty!')
 
     def start_crawl(self):
-        threading.Thread(target=self._start_crawl, args=()).start()
+        threading.Thread(target=self._start_crawl, args=(), daemon=True).start()
 
     def _start_crawl(self):
         if not self.logined_flag:
@@ -7,20 +7,33 @@
 Task1：
     启动服务端永久监听，提供服务端和客户端的文件同步功能
     服务端事务：
-        1. 提供本地目录下所有文件的信息给客户端
+        1. 提供本地目录下所有文件的信息给客户端（从内存中的文件列表快照提供，不重新扫描本地目录）
         2. 接收客户端传送过来的文件，并写入到本地目录
         3. 检查传送后的文件信息是否有误，如果有误实现重传功能
         4. 实时更新 self.latest_file_list 的值
+    服务端的网络接收和写盘解耦：接收到的数据块放入有界队列，由写盘线程池写入文件，队列满时阻塞接收
 Task2:
     启动客户端访问其他服务端请求文件同步
     触发机制:
         1. 当本地目录下有任一文件信息发生变动，如：文件名、文件大小、文件md5
         2. 添加或删除文件（任何格式的文件，包括文件夹）
         3. 每隔 self.automatic_sync_time 秒，自动请求同步一次
+    组播模式下同时连接所有其他服务端，多个服务端需要的文件只组播发送一次，服务端通过TCP报告缺失的分片后补发
+    启动时先向最快的几个其他服务端并行拉取本地缺失的文件，重启后的主机一轮即可追上，不需要等待其他主机逐个推送
+Task3:
+    后台完整性巡检，按 self.scrub_rate 限速重新校验本地文件的md5，前台同步进行时暂停
+    发现损坏的文件时，向其他服务端请求分片摘要，只拉取不一致的分片修复
+    仍在写入的文件（stat签名在 self.stable_quiet_time 秒内有变化）不会被同步，校验失败的文件按指数退避有限次数重传
 
 ***********************************************
 使用命令行启动：多个其他主机用逗号隔开
 python xx.py --ip 192.168.xx.xx,192.168.xx.xx
+启动时从最快的3个其他主机并行拉取缺失的文件，0为不拉取：
+python xx.py --ip 192.168.xx.xx,192.168.xx.xx,192.168.xx.xx --pull-peers 3
+限制后台巡检的读盘速度为每秒5MB，0为关闭巡检：
+python xx.py --ip 192.168.xx.xx,192.168.xx.xx --scrub-rate 5
+开启Prometheus指标端口并打印所有Socket收发信息：
+python xx.py --ip 192.168.xx.xx,192.168.xx.xx --metrics-port 9100 --log-level DEBUG
 ***********************************************
 """
 # -*- coding:utf-8 -*-
@@ -32,17 +45,677 @@ python xx.py --ip 192.168.xx.xx,192.168.xx.xx
 import re
 import os
 import sys
+import math
+import mmap
 import time
 import tqdm
+import random
+import queue
 import socket
+import struct
+import logging
 import hashlib
 import argparse
 import threading
 
-# 定义命令行参数
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 定义命令行参数，在main()中解析，导入本模块时不读取命令行
 parser = argparse.ArgumentParser()
 parser.add_argument("-ip", "--ip", help="请填入其他主机的IP，例如：--ip 192.168.xx.xx,192.168.xx.xx")
-args = parser.parse_args()
+parser.add_argument("--log-level", default='INFO', help="日志级别，DEBUG级别会打印所有的Socket收发信息，默认INFO")
+parser.add_argument("--metrics-port", type=int, help="在本地开启Prometheus指标端口，例如：--metrics-port 9100")
+parser.add_argument("--multicast-group", help="使用组播同时向所有其他主机发送文件，例如：--multicast-group 239.255.66.66")
+parser.add_argument("--pull-peers", type=int, default=2, help="启动时并行拉取缺失文件的主机数量，0为不拉取，默认2")
+parser.add_argument("--scrub-rate", type=float, default=10, help="后台完整性巡检的读盘速度上限，单位MB/s，0为关闭巡检，默认10")
+
+
+def setup_logger(level=logging.INFO):
+    """
+    配置非阻塞日志：业务线程只把日志记录放入队列，由后台线程统一格式化并输出到控制台
+    :param level: 日志级别
+    :return: logger, log queue
+    """
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(side)s %(event)s >> %(asctime)s - %(levelname)s - %(message)s'))
+    QueueListener(log_queue, stream_handler).start()  # 监听线程为守护线程
+
+    sync_logger = logging.getLogger('socket_file_sync')
+    sync_logger.addHandler(QueueHandler(log_queue))
+    sync_logger.setLevel(level)
+    sync_logger.propagate = False
+    return sync_logger, log_queue
+
+
+logger, logger_queue = setup_logger()
+
+
+class SyncMetrics(object):
+    # 指标名称: (指标类型, 说明)
+    metric_definitions = {
+        'sync_sent_bytes_total': ('counter', '发送到对端的文件字节数'),
+        'sync_received_bytes_total': ('counter', '从对端接收的文件字节数'),
+        'sync_sent_files_total': ('counter', '发送到对端的文件数'),
+        'sync_received_files_total': ('counter', '从对端接收的文件数'),
+        'sync_transfer_retries_total': ('counter', '文件校验失败后的重传次数'),
+        'sync_peer_bytes_per_second': ('gauge', '最近一个文件的传输速率'),
+        'sync_queue_depth': ('gauge', '队列中等待处理的数量'),
+        'sync_hash_seconds': ('summary', '计算文件md5的耗时'),
+        'sync_scan_seconds': ('summary', '扫描本地目录的耗时'),
+        'sync_scrub_files_total': ('counter', '后台巡检校验的文件数'),
+        'sync_scrub_bytes_total': ('counter', '后台巡检读取的字节数'),
+        'sync_scrub_repaired_chunks_total': ('counter', '后台巡检从对端修复的分片数'),
+    }
+
+    def __init__(self):
+        """
+        同步指标注册表，以Prometheus文本格式输出
+        """
+        self.lock = threading.Lock()
+        self.values = {}  # {(指标名称, 标签): 数值}
+        self.gauge_callbacks = {}  # {(指标名称, 标签): 返回当前数值的函数}，在输出时读取
+
+    @staticmethod
+    def format_labels(labels):
+        """
+        标签字典转换为排序后的元组，用作指标的Key
+        :param labels: 标签字典，例如：{'peer': '192.168.xx.xx'}
+        :return: tuple
+        """
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        累加counter类型的指标
+        :param name: 指标名称
+        :param value: 累加的数值，默认1
+        :param labels: 指标标签
+        :return:
+        """
+        key = (name, self.format_labels(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        设置gauge类型的指标
+        :param name: 指标名称
+        :param value: 当前数值
+        :param labels: 指标标签
+        :return:
+        """
+        with self.lock:
+            self.values[(name, self.format_labels(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        """
+        记录summary类型的指标，累加耗时和次数
+        :param name: 指标名称
+        :param seconds: 本次耗时，单位秒
+        :param labels: 指标标签
+        :return:
+        """
+        labels = self.format_labels(labels)
+        with self.lock:
+            self.values[(name + '_sum', labels)] = self.values.get((name + '_sum', labels), 0) + seconds
+            self.values[(name + '_count', labels)] = self.values.get((name + '_count', labels), 0) + 1
+
+    def register_gauge(self, name, callback, **labels):
+        """
+        注册gauge类型的指标，输出时调用callback读取当前数值，例如队列深度
+        :param name: 指标名称
+        :param callback: 返回当前数值的函数
+        :param labels: 指标标签
+        :return:
+        """
+        self.gauge_callbacks[(name, self.format_labels(labels))] = callback
+
+    def render(self):
+        """
+        输出Prometheus文本格式的所有指标
+        :return: metrics text
+        """
+        with self.lock:
+            values = dict(self.values)
+        for key, callback in self.gauge_callbacks.items():
+            values[key] = callback()
+
+        lines = []
+        for name, (metric_type, description) in self.metric_definitions.items():
+            samples = sorted((key, value) for key, value in values.items()
+                             if key[0] in (name, name + '_sum', name + '_count'))
+            if not samples:
+                continue
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (sample_name, labels), value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f'{sample_name}{{{label_text}}} {value}' if label_text else f'{sample_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class ManifestEntry(object):
+    __slots__ = ('file', 'digest', 'size', 'mtime')
+
+    def __init__(self, file, digest, size, mtime=0):
+        """
+        文件列表中的单个文件信息
+        :param str file: 文件相对路径
+        :param bytes digest: 16字节的md5原始摘要
+        :param int size: 文件大小
+        :param int mtime: 文件最后修改时间，单位纳秒
+        """
+        self.file = file
+        self.digest = digest
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def md5(self):
+        return self.digest.hex()
+
+    def __repr__(self):
+        return f'ManifestEntry(file={self.file!r}, md5={self.md5!r}, size={self.size})'
+
+
+class FileManifest(object):
+    __slots__ = ('files', 'digests', 'sizes', 'mtimes')
+    digest_size = 16  # md5原始摘要的字节数
+    unknown_digest = bytes(16)  # 仍在写入、还没有计算md5的文件
+
+    def __init__(self, entries=()):
+        """
+        紧凑的文件列表，按文件名排序后使用并行数组保存，每个文件只占用几十个字节：
+            files   - 文件相对路径列表，字符串驻留，相同路径共享同一个对象
+            digests - 所有文件的16字节md5原始摘要首尾相接
+            sizes   - 文件大小，int64数组
+            mtimes  - 文件最后修改时间，单位纳秒，int64数组
+        :param entries: 可迭代的 (file, digest, size, mtime)，顺序不限
+        """
+        entries = sorted(entries, key=itemgetter(0))
+        self.files = [sys.intern(entry[0]) for entry in entries]
+        self.digests = bytearray(b''.join(entry[1] for entry in entries))
+        self.sizes = array('q', (entry[2] for entry in entries))
+        self.mtimes = array('q', (entry[3] for entry in entries))
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        start = index * self.digest_size
+        return ManifestEntry(self.files[index], bytes(self.digests[start:start + self.digest_size]),
+                             self.sizes[index], self.mtimes[index])
+
+    def __iter__(self):
+        for index in range(len(self.files)):
+            yield self[index]
+
+    def __eq__(self, other):
+        # 只比较文件名、md5和size，与对端比较时没有mtime
+        if not isinstance(other, FileManifest):
+            return NotImplemented
+        return self.files == other.files and self.digests == other.digests and self.sizes == other.sizes
+
+    def __contains__(self, file):
+        return self.find_index(file) is not None
+
+    def find_index(self, file):
+        """
+        二分查找文件在列表中的位置
+        :param file: 文件相对路径
+        :return: index or None
+        """
+        index = bisect_left(self.files, file)
+        if index < len(self.files) and self.files[index] == file:
+            return index
+        return None
+
+    def get(self, file):
+        """
+        二分查找文件信息
+        :param file: 文件相对路径
+        :return: ManifestEntry or None
+        """
+        index = self.find_index(file)
+        return None if index is None else self[index]
+
+    def copy(self):
+        """
+        复制快照，并行数组按内存整体复制，不需要重新排序
+        :return: FileManifest
+        """
+        manifest = FileManifest.__new__(FileManifest)
+        manifest.files = list(self.files)
+        manifest.digests = bytearray(self.digests)
+        manifest.sizes = array('q', self.sizes)
+        manifest.mtimes = array('q', self.mtimes)
+        return manifest
+
+    def update(self, file, digest, size, mtime=0):
+        """
+        新增或更新一个文件的信息，保持文件名的顺序
+        :param file: 文件相对路径
+        :param digest: 16字节的md5原始摘要
+        :param size: 文件大小
+        :param mtime: 文件最后修改时间，单位纳秒
+        :return:
+        """
+        index = bisect_left(self.files, file)
+        start = index * self.digest_size
+        if index < len(self.files) and self.files[index] == file:
+            self.digests[start:start + self.digest_size] = digest
+            self.sizes[index] = size
+            self.mtimes[index] = mtime
+        else:
+            self.files.insert(index, sys.intern(file))
+            self.digests[start:start] = digest
+            self.sizes.insert(index, size)
+            self.mtimes.insert(index, mtime)
+
+    def to_text(self, separator):
+        """
+        转换为发送给对端的文本，每行一个文件：文件名<SEP>size<SEP>md5
+        :param separator: 分隔符
+        :return: str
+        """
+        return '\n'.join(f'{entry.file}{separator}{entry.size}{separator}{entry.md5}' for entry in self)
+
+    @classmethod
+    def from_text(cls, text, separator):
+        """
+        解析对端发送的文件列表文本
+        :param text: to_text() 生成的文本
+        :param separator: 分隔符
+        :return: FileManifest
+        """
+        entries = []
+        for line in text.split('\n'):
+            if line:
+                file_name, file_size, file_md5 = line.split(separator)
+                entries.append((file_name, bytes.fromhex(file_md5), int(file_size), 0))
+        return cls(entries)
+
+
+class PageCacheReader(object):
+
+    def __init__(self, drop_cache=True, use_mmap=True, mmap_threshold=67108864, drop_interval=8388608):
+        """
+        同步使用的读盘层：提示内核顺序读取，读取后丢弃页缓存，避免同步大量文件时挤掉同一台机器上测试软件的缓存
+        :param bool drop_cache: 读取后是否丢弃页缓存，默认True
+        :param bool use_mmap: 大文件计算md5时是否使用mmap，默认True
+        :param int mmap_threshold: 使用mmap计算md5的文件大小下限，单位b
+        :param int drop_interval: 每读取多少字节丢弃一次页缓存，单位b，避免每个小数据块都调用一次系统调用
+        """
+        self.drop_cache = drop_cache
+        self.use_mmap = use_mmap
+        self.mmap_threshold = mmap_threshold
+        self.drop_interval = drop_interval
+
+    @staticmethod
+    def advise(file_handle, offset, length, advice):
+        """
+        向内核提示文件的访问方式，不支持posix_fadvise的系统（Windows）直接跳过
+        :param file_handle: 文件句柄
+        :param offset: 开始位置
+        :param length: 长度，0表示到文件结尾
+        :param advice: os模块中的常量名称，例如：POSIX_FADV_DONTNEED
+        :return:
+        """
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file_handle.fileno(), offset, length, getattr(os, advice))
+
+    def read_chunks(self, file_name, chunk_size, first_chunk=0, chunk_number=None, before_read=None):
+        """
+        按分片顺序读取文件，已经读取的部分按 self.drop_interval 丢弃页缓存
+        :param file_name: 文件路径
+        :param chunk_size: 分片大小
+        :param first_chunk: 开始读取的分片序号
+        :param chunk_number: 读取的分片数量，为空时读取到文件结尾
+        :param before_read: 每次读取前调用的函数，参数为分片大小，用于限速或暂停
+        :return: 分片数据的生成器
+        """
+        with open(file_name, 'rb') as rf:
+            offset = dropped_offset = first_chunk * chunk_size
+            rf.seek(offset)
+            self.advise(rf, offset, 0 if chunk_number is None else chunk_number * chunk_size,
+                        'POSIX_FADV_SEQUENTIAL')
+            try:
+                while chunk_number is None or chunk_number > 0:
+                    if before_read:
+                        before_read(chunk_size)
+                    data = rf.read(chunk_size)
+                    if not data:
+                        break
+                    offset += len(data)
+                    if self.drop_cache and offset - dropped_offset >= self.drop_interval:
+                        self.advise(rf, dropped_offset, offset - dropped_offset, 'POSIX_FADV_DONTNEED')
+                        dropped_offset = offset
+                    if chunk_number is not None:
+                        chunk_number -= 1
+                    yield data
+            finally:
+                if self.drop_cache and offset > dropped_offset:
+                    self.advise(rf, dropped_offset, offset - dropped_offset, 'POSIX_FADV_DONTNEED')
+
+    def get_digest(self, file_name, chunk_size=1048576):
+        """
+        计算文件的md5，超过 self.mmap_threshold 的文件使用mmap，不需要把数据复制到Python的内存中
+        :param file_name: 文件路径
+        :param chunk_size: 每次计算的数据大小
+        :return: 16 bytes md5 digest
+        """
+        file_check = hashlib.md5()
+        if not self.use_mmap or os.path.getsize(file_name) < self.mmap_threshold:
+            for data in self.read_chunks(file_name=file_name, chunk_size=chunk_size):
+                file_check.update(data)
+            return file_check.digest()
+
+        with open(file_name, 'rb') as rf:
+            with mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(view), chunk_size):
+                        file_check.update(view[offset:offset + chunk_size])
+            if self.drop_cache:
+                self.advise(rf, 0, 0, 'POSIX_FADV_DONTNEED')
+        return file_check.digest()
+
+
+class ReceiveFileTask(object):
+
+    def __init__(self, file_name, file_size, task_queue):
+        """
+        服务端接收的单个文件的写盘任务
+        :param str file_name: 写入的文件路径
+        :param int file_size: 客户端声明的文件大小，用于预分配磁盘空间
+        :param queue.Queue task_queue: 负责该文件的写盘线程的队列，同一个文件的数据块按顺序写入
+        """
+        self.file_name = file_name
+        self.file_size = file_size
+        self.task_queue = task_queue
+        self.file = None
+        self.written_size = 0
+        self.md5 = hashlib.md5()  # 写盘时同步计算md5，校验时不需要重新读取文件
+        self.error = None
+        self.finished = threading.Event()
+
+
+class DiskWriterPool(object):
+
+    def __init__(self, worker_number=2, queue_size=64):
+        """
+        写盘线程池，服务端的网络线程只负责接收数据，写盘由线程池完成，网络和磁盘可以同时工作
+        :param int worker_number: 写盘线程数量
+        :param int queue_size: 每个写盘线程的队列长度，队列满时网络线程阻塞，形成对socket的背压
+        """
+        self.task_queues = [queue.Queue(maxsize=queue_size) for _ in range(worker_number)]
+        self.next_queue = 0
+        for task_queue in self.task_queues:
+            threading.Thread(target=self.start_disk_writer, args=(task_queue,), daemon=True).start()
+
+    def open_file(self, file_name, file_size):
+        """
+        创建一个写盘任务，轮流分配给每一个写盘线程
+        :param file_name: 写入的文件路径
+        :param file_size: 文件大小
+        :return: ReceiveFileTask
+        """
+        task_queue = self.task_queues[self.next_queue]
+        self.next_queue = (self.next_queue + 1) % len(self.task_queues)
+
+        task = ReceiveFileTask(file_name=file_name, file_size=file_size, task_queue=task_queue)
+        task_queue.put(('open', task, None))
+        return task
+
+    def queue_depth(self):
+        """
+        所有写盘队列中等待写入的数据块数量
+        :return: int
+        """
+        return sum(task_queue.qsize() for task_queue in self.task_queues)
+
+    @staticmethod
+    def write(task, data):
+        """
+        提交数据块到写盘队列，队列满时阻塞
+        :param ReceiveFileTask task: 写盘任务
+        :param bytes data: 数据块
+        :return:
+        """
+        task.task_queue.put(('write', task, data))
+
+    @staticmethod
+    def close(task):
+        """
+        等待写盘任务完成
+        :param ReceiveFileTask task: 写盘任务
+        :return: (写入的文件大小, 写入内容的md5)，写盘失败时返回 (None, None)
+        """
+        task.task_queue.put(('close', task, None))
+        task.finished.wait()
+        if task.error:
+            return None, None
+        return task.written_size, task.md5.hexdigest()
+
+    @staticmethod
+    def start_disk_writer(task_queue):
+        """
+        写盘线程，按顺序处理队列中的打开、写入和关闭操作
+        :param task_queue: 写盘队列
+        :return:
+        """
+        while True:
+            action, task, data = task_queue.get()
+            try:
+                if task.error:  # 写盘已经失败的任务，丢弃剩余的数据块
+                    continue
+                if action == 'open':
+                    task.file = open(task.file_name, 'wb')
+                    # 预分配磁盘空间，减少文件碎片和写入时的元数据更新
+                    if hasattr(os, 'posix_fallocate') and task.file_size > 0:
+                        try:
+                            os.posix_fallocate(task.file.fileno(), 0, task.file_size)
+                        except OSError:
+                            pass  # 文件系统不支持预分配
+                elif action == 'write':
+                    task.file.write(data)
+                    task.md5.update(data)
+                    task.written_size += len(data)
+            except Exception as ex:
+                task.error = ex
+            finally:
+                if action == 'close':
+                    if task.file:
+                        try:
+                            task.file.truncate()  # 截掉预分配但没有写入的部分
+                            task.file.close()
+                        except Exception as ex:
+                            task.error = task.error or ex
+                    task.finished.set()
+
+
+class MulticastSender(object):
+    packet_header = struct.Struct('!II')  # 组播数据包头：传输ID、分片序号
+
+    def __init__(self, local_ip, group, port, ttl=1, rate=52428800):
+        """
+        组播发送端，同一个文件的分片只发送一次，所有加入组播的服务端同时接收
+        :param str local_ip: 本地IP，组播从该IP所在的网卡发出
+        :param str group: 组播地址，例如：239.255.66.66
+        :param int port: 组播端口
+        :param int ttl: 组播TTL，默认1，只在本地网段内传输
+        :param int rate: 发送速率上限，单位b/s，防止服务端接收缓冲区溢出
+        """
+        self.address = (group, port)
+        self.rate = rate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(local_ip))
+
+    def send_chunks(self, transfer_id, file_name, chunk_size, ranges):
+        """
+        按限速组播发送文件的指定分片
+        :param int transfer_id: 传输ID
+        :param str file_name: 文件路径
+        :param int chunk_size: 分片大小
+        :param list ranges: 要发送的分片范围，例如：[(0, 100), (150, 160)]，不包含结束序号
+        :return: 发送的字节数
+        """
+        sent_size = 0
+        start_time = time.time()
+        with open(file_name, 'rb') as rf:
+            for first_chunk, last_chunk in ranges:
+                rf.seek(first_chunk * chunk_size)
+                for chunk_index in range(first_chunk, last_chunk):
+                    data = rf.read(chunk_size)
+                    if not data:
+                        break
+                    self.sock.sendto(self.packet_header.pack(transfer_id, chunk_index) + data, self.address)
+                    sent_size += len(data)
+
+                    # 发送速度超过限速1毫秒以上时等待
+                    ahead_time = sent_size / self.rate - (time.time() - start_time)
+                    if ahead_time > 0.001:
+                        time.sleep(ahead_time)
+            PageCacheReader.advise(rf, 0, 0, 'POSIX_FADV_DONTNEED')  # 补发的分片很少，直接从磁盘重新读取
+        return sent_size
+
+    def close(self):
+        self.sock.close()
+
+
+class MulticastReceiveTask(object):
+
+    def __init__(self, file_name, file_size, file_md5, chunk_size, temp_file_name):
+        """
+        服务端通过组播接收的单个文件，分片可能乱序或丢失，按序号写入临时文件并记录已收到的分片
+        :param str file_name: 文件路径
+        :param int file_size: 文件大小
+        :param str file_md5: 文件md5
+        :param int chunk_size: 分片大小
+        :param str temp_file_name: 接收时写入的临时文件
+        """
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_md5 = file_md5
+        self.chunk_size = chunk_size
+        self.temp_file_name = temp_file_name
+        self.received = bytearray(math.ceil(file_size / chunk_size))  # 每个分片是否已经收到
+        self.lock = threading.Lock()
+        self.file = open(temp_file_name, 'wb')
+        self.file.truncate(file_size)
+
+
+class MulticastReceiver(object):
+
+    def __init__(self, local_ip, group, port, receive_buffer_size=8388608):
+        """
+        组播接收端，只接收通过TCP预告过的文件分片，其他数据包直接丢弃
+        :param str local_ip: 本地IP，在该IP所在的网卡上加入组播
+        :param str group: 组播地址
+        :param int port: 组播端口
+        :param int receive_buffer_size: socket接收缓冲区大小，单位b
+        """
+        self.tasks = {}  # {传输ID: MulticastReceiveTask}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 允许同一台主机上的多个服务端接收
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        self.sock.bind(('' if sys.platform.startswith('win') else group, port))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             socket.inet_aton(group) + socket.inet_aton(local_ip))
+        threading.Thread(target=self.start_receive, daemon=True).start()
+
+    def register(self, transfer_id, file_name, file_size, file_md5, chunk_size, temp_file_name):
+        """
+        登记即将通过组播接收的文件
+        :return:
+        """
+        self.tasks[transfer_id] = MulticastReceiveTask(file_name=file_name, file_size=file_size, file_md5=file_md5,
+                                                       chunk_size=chunk_size, temp_file_name=temp_file_name)
+
+    def start_receive(self):
+        """
+        接收线程，把收到的分片写入对应文件的临时文件
+        :return:
+        """
+        header_size = MulticastSender.packet_header.size
+        while True:
+            packet = self.sock.recv(65536)
+            if len(packet) < header_size:
+                continue
+            transfer_id, chunk_index = MulticastSender.packet_header.unpack_from(packet)
+            task = self.tasks.get(transfer_id)
+            if not task or chunk_index >= len(task.received):
+                continue
+            with task.lock:
+                if task.file.closed or task.received[chunk_index]:
+                    continue
+                task.file.seek(chunk_index * task.chunk_size)
+                task.file.write(packet[header_size:])
+                task.received[chunk_index] = 1
+
+    def get_missing_ranges(self, transfer_id, max_ranges=50):
+        """
+        获取还没有收到的分片范围
+        :param transfer_id: 传输ID
+        :param max_ranges: 最多返回的范围数量，其余的在下一轮补发时返回
+        :return: 例如：[(0, 100), (150, 160)]，不包含结束序号
+        """
+        task = self.tasks[transfer_id]
+        ranges = []
+        chunk_index = task.received.find(0)
+        while chunk_index != -1 and len(ranges) < max_ranges:
+            end_index = task.received.find(1, chunk_index)
+            end_index = len(task.received) if end_index == -1 else end_index
+            ranges.append((chunk_index, end_index))
+            chunk_index = task.received.find(0, end_index)
+        return ranges
+
+    def finish(self, transfer_id):
+        """
+        结束文件接收，关闭临时文件
+        :param transfer_id: 传输ID
+        :return: MulticastReceiveTask
+        """
+        task = self.tasks.pop(transfer_id)
+        with task.lock:
+            task.file.close()
+        return task
+
+
+class IOBudget(object):
+
+    def __init__(self, rate):
+        """
+        读盘限速，所有使用同一个IOBudget的线程共享速率上限
+        :param int rate: 速率上限，单位b/s，0为不限速
+        """
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()  # 下一次读盘允许开始的时间
+
+    def consume(self, size):
+        """
+        申请读取size字节，超过速率上限时等待
+        :param size: 读取的字节数
+        :return:
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            current_time = time.monotonic()
+            start_time = max(self.next_time, current_time)
+            self.next_time = start_time + size / self.rate
+        if start_time > current_time:
+            time.sleep(start_time - current_time)
 
 
 class SocketFileSync(object):
@@ -76,7 +749,49 @@ class SocketFileSync(object):
 
         self.socket_separator = '<SEP>'  # Socket分割符
         self.system_separator = '\\' if 'win' in sys.platform else '/'  # 系统分隔符
-        self.latest_file_list = []  # 记录最新的文件列表，随着本地目录下的文件更改而更新
+        self.latest_file_list = FileManifest()  # 记录最新的文件列表，随着本地目录下的文件更改而更新
+        self.local_manifest = FileManifest()  # 本地目录所有文件的快照，扫描时增量更新，服务端直接从内存提供给客户端
+        self.manifest_message = None  # 当前版本快照发送给客户端的消息缓存
+        self.manifest_lock = threading.Lock()  # 服务端和客户端线程共享快照
+
+        self.stable_quiet_time = 3  # 文件的stat签名(size, mtime)保持不变超过该时间才会被同步，单位秒
+        self.max_transfer_retries = 3  # 服务端校验文件失败后的最大重传次数
+        self.retry_backoff_time = 1  # 重传前的初始等待时间，每重传一次翻倍，单位秒
+        self.retry_backoff_max = 30  # 重传前的最大等待时间，单位秒
+        self.file_stat_records = {}  # 记录每个文件最近一次的stat签名和开始稳定的时间，用于判断文件是否仍在写入
+        self.file_stat_lock = threading.Lock()  # 服务端和客户端线程共享 self.file_stat_records
+
+        self.disk_writer_number = 2  # 服务端写盘线程数量
+        self.disk_writer_queue_size = 64  # 每个写盘线程的队列长度，单位为数据块
+        self.disk_writer = None  # 服务端启动时创建写盘线程池
+        self.checked_folders = set()  # 记录已经检查或创建过的文件夹，避免每个文件都重复检查
+        self.receive_temp_suffix = '.sync_tmp'  # 服务端接收文件时使用的临时文件后缀，扫描本地目录时忽略
+        self.repair_temp_suffix = '.repair_tmp'  # 巡检修复文件时使用的临时文件后缀，扫描本地目录时忽略
+        self.file_reader = PageCacheReader()  # 计算md5、发送文件和巡检使用的读盘层，读取后不保留页缓存
+
+        self.pull_peer_number = 2  # 启动时并行拉取缺失文件的其他服务端数量，0为不拉取
+        self.server_ready = threading.Event()  # 服务端的写盘线程池创建完毕，客户端拉取文件时也使用该线程池
+
+        self.multicast_group = None  # 组播地址，例如：239.255.66.66，为空时不使用组播
+        self.multicast_port = 6667  # 组播端口
+        self.multicast_ttl = 1  # 组播TTL
+        self.multicast_chunk_size = 1400  # 组播分片大小，单位b，加上包头不超过以太网MTU
+        self.multicast_rate = 52428800  # 组播发送速率上限，单位b/s
+        self.multicast_repair_rounds = 5  # 组播补发缺失分片的最大轮数，仍然失败的服务端改用TCP传输
+        self.multicast_receiver = None  # 服务端启动时创建组播接收端
+
+        self.scrub_rate = 10485760  # 后台巡检的读盘速度上限，单位b/s，0为关闭巡检
+        self.scrub_interval = 3600  # 两次完整巡检之间的间隔时间，单位秒
+        self.scrub_chunk_size = 1048576  # 巡检和修复的分片大小，单位b
+        self.scrub_budget = None  # 启动时按 self.scrub_rate 创建读盘限速
+        self.scrub_digest_cache = {}  # 上次巡检确认完好的分片md5，例如：{文件名: (size, mtime_ns, 分片md5)}
+        self.repair_read_rate = 52428800  # 为对端计算分片摘要时估计的最低读盘速度，用于放宽修复请求的超时，单位b/s
+        self.foreground_syncs = 0  # 正在进行的前台同步数量，巡检在前台同步时暂停
+        self.foreground_condition = threading.Condition()
+
+        self.metrics_port = None  # 本地Prometheus指标端口，为空时不开启
+        self.metrics = SyncMetrics()  # 同步指标注册表
+        self.metrics.register_gauge('sync_queue_depth', logger_queue.qsize, queue='log')
 
     def setup_server_side(self):
         """
@@ -112,6 +827,14 @@ class SocketFileSync(object):
         if not os.path.isdir(self.file_location):
             os.mkdir(self.file_location)
 
+    def get_file_digest(self, file_name=''):
+        """
+        获取文件的MD5原始摘要，通过 self.file_reader 分片读取，不一次性读入整个文件
+        :param file_name: 被读取的文件
+        :return: 16 bytes md5 digest
+        """
+        return self.file_reader.get_digest(file_name=file_name)
+
     @staticmethod
     def get_file_md5(file_name=''):
         """
@@ -119,32 +842,23 @@ class SocketFileSync(object):
         :param file_name: 被读取的文件
         :return: md5 string
         """
-        with open(file_name, 'rb') as file:
-            file_data = file.read()
-
-        diff_check = hashlib.md5()
-        diff_check.update(file_data)
-        md5_code = diff_check.hexdigest()
-        return md5_code
+        return PageCacheReader().get_digest(file_name=file_name).hex()
 
     @staticmethod
-    def print_info(side='server', msg=''):
+    def print_info(side='server', msg='', level=logging.INFO):
         """
-        根据side打印不同的前缀信息
+        根据side记录不同前缀的日志，日志由后台线程输出，不阻塞当前线程
         :param side: 默认server端
         :param msg: 要打印的内容
+        :param level: 日志级别，默认INFO
         :return:
         """
-        current_time = time.strftime('%Y-%m-%d %H:%M:%S')
-        if side == 'server':
-            print(f'Server print >> {current_time} - {msg}')
-        else:
-            print(f'Client print >> {current_time} - {msg}')
+        logger.log(level, msg, extra={'side': side.capitalize(), 'event': 'print'})
 
     @staticmethod
     def send_socket_info(handle, msg, side='server', do_encode=True, do_print_info=True):
         """
-        发送socket info，并根据side打印不同的前缀信息
+        发送socket info，并根据side记录不同前缀的DEBUG日志
         :param handle: socket句柄
         :param msg: 要发送的内容
         :param side: 默认server端
@@ -157,16 +871,53 @@ class SocketFileSync(object):
         else:
             handle.send(msg)
 
-        if do_print_info:
-            current_time = time.strftime('%Y-%m-%d %H:%M:%S')
-            if side == 'server':
-                print(f'Server send --> {current_time} - {msg}')
-            else:
-                print(f'Client send --> {current_time} - {msg}')
+        if do_print_info and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg, extra={'side': side.capitalize(), 'event': 'send'})
+
+    def send_socket_frame(self, handle, msg, side='server', do_print_info=True):
+        """
+        发送带长度前缀的完整消息，用于超过 self.buffer_size 的内容，例如文件列表
+        :param handle: socket句柄
+        :param str or bytes msg: 要发送的内容，bytes 类型的内容为已经encode的消息
+        :param side: 默认server端
+        :param do_print_info: 是否需要打印socket信息，默认True
+        :return:
+        """
+        data = msg if isinstance(msg, bytes) else msg.encode()
+        handle.sendall(struct.pack('!Q', len(data)))
+        handle.sendall(data)
+        if do_print_info and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg, extra={'side': side.capitalize(), 'event': 'send'})
+
+    def receive_socket_frame(self, handle, side='server', do_decode=True, do_print_info=True):
+        """
+        接收带长度前缀的完整消息，直到收齐全部内容为止
+        :param handle: socket句柄
+        :param side: 默认server端
+        :param do_decode: 是否需要decode，默认True
+        :param do_print_info: 是否需要打印socket信息，默认True
+        :return: 消息内容
+        """
+        def receive_exactly(size):
+            data = bytearray()
+            while len(data) < size:
+                chunk = handle.recv(min(size - len(data), 65536))
+                if not chunk:
+                    raise ConnectionError('Socket连接已断开')
+                data.extend(chunk)
+            return bytes(data)
+
+        msg_size, = struct.unpack('!Q', receive_exactly(8))
+        msg = receive_exactly(msg_size)
+        if do_decode:
+            msg = msg.decode()
+        if do_print_info and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg, extra={'side': side.capitalize(), 'event': 'received'})
+        return msg
 
     def receive_socket_info(self, handle, expected_msg, side='server', do_decode=True, do_print_info=True):
         """
-        循环接收socket info，判断其返回值，直到指定的值出现为止，防止socket信息粘连，并根据side打印不同的前缀信息
+        循环接收socket info，判断其返回值，直到指定的值出现为止，防止socket信息粘连，并根据side记录不同前缀的DEBUG日志
         :param handle: socket句柄
         :param expected_msg: 期待接受的内容，如果接受内容不在返回结果中，一直循环等待，期待内容可以为字符串，也可以为多个字符串组成的列表或元组
         :param side: 默认server端
@@ -180,12 +931,8 @@ class SocketFileSync(object):
             else:
                 socket_data = handle.recv(self.buffer_size)
 
-            if do_print_info:
-                current_time = time.strftime('%Y-%m-%d %H:%M:%S')
-                if side == 'server':
-                    print(f'Server received ==> {current_time} - {socket_data}')
-                else:
-                    print(f'Client received ==> {current_time} - {socket_data}')
+            if do_print_info and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(socket_data, extra={'side': side.capitalize(), 'event': 'received'})
 
             # 如果expected_msg为空，跳出循环
             if not expected_msg:
@@ -205,36 +952,130 @@ class SocketFileSync(object):
             time.sleep(self.waiting_time)
         return socket_data
 
-    def get_local_all_file(self):
+    def check_file_stable(self, file_name, file_stat=None):
+        """
+        检查文件是否已经写入完毕：文件的stat签名(size, mtime)在 self.stable_quiet_time 秒内没有变化才视为稳定
+        :param file_name: 文件路径
+        :param file_stat: 文件的os.stat结果，为空时重新读取
+        :return: True or False
+        """
+        file_name = os.path.abspath(file_name)
+        file_stat = file_stat or os.stat(file_name)
+        signature = (file_stat.st_size, file_stat.st_mtime_ns)
+        current_time = time.time()
+
+        with self.file_stat_lock:
+            record = self.file_stat_records.get(file_name)
+            if not record:
+                # 第一次发现该文件，从文件的最后修改时间开始计算静默期
+                record = (signature, min(file_stat.st_mtime, current_time))
+            elif record[0] != signature:
+                # 文件签名发生变化，说明文件仍在写入，重新计算静默期
+                record = (signature, current_time)
+            self.file_stat_records[file_name] = record
+        return current_time - record[1] >= self.stable_quiet_time
+
+    def get_local_all_file(self, stable_only=False):
         """
-        获取本地目录下所有的文件名、md5和size
-        :return: file list
-        [
-            {'file': file_relative_path, 'md5': md5_value, 'size': size_value},
-            {'file': file_relative_path, 'md5': md5_value, 'size': size_value},
-            {'file': file_relative_path, 'md5': md5_value, 'size': size_value},
-            ...
-        ]
+        获取本地目录下所有的文件名、md5、size和mtime，并增量更新 self.local_manifest 快照
+        size和mtime与快照相同的文件直接使用快照中的md5，只有新增或变化的文件需要重新计算md5
+        :param stable_only: 是否只返回已经写入完毕的文件，仍在写入的文件不计算md5，默认False
+        :return: FileManifest，按文件相对路径排序，可以按文件名二分查找，返回的快照不能修改
         """
+        scan_start_time = time.time()
         all_files = []
         for root, dirs, files in os.walk(self.file_location):  # 展开文件目录下所有的子目录和文件
             # root 返回一个当前文件夹的绝对路径 - str
             # dirs 返回该文件夹下所有的子目录名 - list
             # files 返回该文件夹下所有的子文件 - list
             for each_file in files:  # 遍历保存所有的文件
+                # 跳过正在接收和修复的临时文件
+                if each_file.endswith((self.receive_temp_suffix, self.repair_temp_suffix)):
+                    continue
                 all_files.append(os.path.join(root, each_file))
 
-        if all_files:
-            file_list = []
-            for each_file in all_files:  # 如果本地目录有文件，循环读取每一个文件名的md5和文件大小
-                file_list.append({
-                    'file': self.file_directory + each_file.split(self.file_directory, 1)[-1],  # 截取相对路径
-                    'md5': self.get_file_md5(file_name=each_file),
-                    'size': os.path.getsize(each_file)
-                })
-            return file_list
-        else:
-            return []
+        # 清理已经被删除的文件的stat记录
+        with self.file_stat_lock:
+            for each_file in set(self.file_stat_records) - set(all_files):
+                del self.file_stat_records[each_file]
+
+        previous_manifest = self.local_manifest
+        file_list = []
+        stable_file_list = []
+        for each_file in all_files:  # 如果本地目录有文件，循环读取每一个文件名的md5和文件大小
+            relative_path = self.file_directory + each_file.split(self.file_directory, 1)[-1]  # 截取相对路径
+            file_stat = os.stat(each_file)
+            file_stable = self.check_file_stable(file_name=each_file, file_stat=file_stat)
+
+            previous_file = previous_manifest.get(relative_path)
+            if previous_file and previous_file.size == file_stat.st_size \
+                    and previous_file.mtime == file_stat.st_mtime_ns \
+                    and previous_file.digest != FileManifest.unknown_digest:
+                file_digest = previous_file.digest  # 文件没有变化，使用快照中的md5
+            elif file_stable:
+                hash_start_time = time.time()
+                file_digest = self.get_file_digest(file_name=each_file)
+                self.metrics.observe('sync_hash_seconds', time.time() - hash_start_time)
+            else:
+                file_digest = FileManifest.unknown_digest  # 仍在写入的文件暂不计算md5，等待下次扫描
+
+            entry = (relative_path, file_digest, file_stat.st_size, file_stat.st_mtime_ns)
+            file_list.append(entry)
+            if file_stable:
+                stable_file_list.append(entry)
+
+        manifest = FileManifest(file_list)
+        with self.manifest_lock:
+            if manifest != self.local_manifest:
+                self.manifest_message = None
+            self.local_manifest = manifest
+        self.metrics.observe('sync_scan_seconds', time.time() - scan_start_time)
+        return FileManifest(stable_file_list) if stable_only else manifest
+
+    def get_stable_manifest(self):
+        """
+        从 self.local_manifest 快照中取出已经写入完毕的文件，不重新扫描本地目录
+        :return: FileManifest
+        """
+        current_time = time.time()
+        stable_file_list = []
+        with self.manifest_lock:
+            manifest = self.local_manifest
+        for each_file in manifest:
+            record = self.file_stat_records.get(os.path.abspath(each_file.file))
+            if record and current_time - record[1] >= self.stable_quiet_time:
+                stable_file_list.append((each_file.file, each_file.digest, each_file.size, each_file.mtime))
+        return FileManifest(stable_file_list)
+
+    def update_local_manifest(self, file_name, file_digest):
+        """
+        接收文件成功后直接更新快照，不需要重新扫描本地目录，接收的文件已经校验完毕，视为稳定
+        已经交出去的快照不能修改，复制一份更新后再替换 self.local_manifest
+        :param file_name: 文件相对路径
+        :param file_digest: 16字节的md5原始摘要
+        :return:
+        """
+        file_stat = os.stat(file_name)
+        with self.file_stat_lock:
+            self.file_stat_records[os.path.abspath(file_name)] = ((file_stat.st_size, file_stat.st_mtime_ns), 0)
+        with self.manifest_lock:
+            manifest = self.local_manifest.copy()
+            manifest.update(file_name, file_digest, file_stat.st_size, file_stat.st_mtime_ns)
+            self.local_manifest = manifest
+            self.manifest_message = None
+
+    def get_manifest_message(self):
+        """
+        获取发送给客户端的文件列表消息，同一个版本的快照只生成一次
+        :return: encoded message
+        """
+        with self.manifest_lock:
+            if self.manifest_message is None:
+                if self.local_manifest:
+                    self.manifest_message = self.local_manifest.to_text(separator=self.socket_separator).encode()
+                else:
+                    self.manifest_message = '服务端没有任何数据'.encode()
+            return self.manifest_message
 
     def check_transfer_folder_exists(self, files):
         """
@@ -242,6 +1083,9 @@ class SocketFileSync(object):
         :param files: 客户端传送过来的文件路径
         :return:
         """
+        if os.path.dirname(files) in self.checked_folders:
+            return
+
         split_folders = files.split(self.system_separator)  # 切割所有文件夹和文件名
         folders = split_folders[:-1]  # 截取所有文件夹名
 
@@ -257,11 +1101,65 @@ class SocketFileSync(object):
         for each_folder in check_folder_list:  # 循环检查每一个文件夹
             if not os.path.isdir(each_folder):
                 self.print_info(msg=f'发现 << {each_folder} >> 文件夹不存在')
-                os.mkdir(each_folder)
+                os.makedirs(each_folder, exist_ok=True)  # 拉取文件时多个线程可能同时创建
                 self.print_info(msg=f'创建 >> {each_folder} << 文件夹成功')
 
+        self.checked_folders.add(os.path.dirname(files))
         self.print_info(msg=f'全部检查完毕！')
 
+    def receive_file(self, handle, file_name, file_size, file_md5, side='server', peer=''):
+        """
+        接收对端发送的文件，网络接收的数据块交给写盘线程池写入，写完后校验size和md5
+        :param handle: socket句柄
+        :param str file_name: 文件路径
+        :param str file_size: 对端声明的文件大小
+        :param str file_md5: 对端声明的文件md5
+        :param side: 默认server端
+        :param peer: 对端IP，用于统计指标
+        :return: True or False
+        """
+        start_time = time.time()
+        # 检查客户端传送过来的文件所处的文件夹是否存在，如果不存在创建一个新的
+        self.check_transfer_folder_exists(files=file_name)
+
+        # 先写入临时文件，校验成功后再替换，防止传输中断时破坏原有文件
+        temp_file_name = file_name + self.receive_temp_suffix
+
+        # 接收客户端发送的文件，数据块放入写盘队列后立即确认，写盘队列满时阻塞，形成对客户端的背压
+        task = self.disk_writer.open_file(file_name=temp_file_name, file_size=int(file_size))
+        try:
+            while True:
+                socket_data = self.receive_socket_info(handle=handle, side=side, expected_msg='',
+                                                       do_decode=False, do_print_info=False)
+                if '文件传输完毕'.encode() in socket_data:
+                    break
+                self.disk_writer.write(task, socket_data)
+                self.send_socket_info(handle=handle, side=side, msg='服务端接收文件成功')
+        finally:
+            # 等待写盘完成
+            new_file_size, new_file_md5 = self.disk_writer.close(task)
+
+        if task.error:
+            self.print_info(side=side, msg=f'写入文件 {file_name} 失败：{task.error}', level=logging.ERROR)
+            self.checked_folders.discard(os.path.dirname(file_name))  # 文件夹可能被删除，下次重新检查
+
+        # 检查文件传输后的size和md5
+        if str(new_file_size) != file_size or new_file_md5 != file_md5:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            self.send_socket_info(handle=handle, side=side, msg='服务端写入文件有误，请重新传送...')
+            return False
+
+        os.replace(temp_file_name, file_name)
+        self.update_local_manifest(file_name=file_name, file_digest=bytes.fromhex(new_file_md5))
+        self.send_socket_info(handle=handle, side=side, msg='服务端写入文件成功')
+
+        self.metrics.inc('sync_received_bytes_total', new_file_size, peer=peer)
+        self.metrics.inc('sync_received_files_total', peer=peer)
+        self.metrics.set('sync_peer_bytes_per_second', new_file_size / max(time.time() - start_time, 1e-6),
+                         peer=peer, direction='received')
+        return True
+
     def start_server_forever_listen(self):
         """
         启动服务端永久监听，提供服务端和客户端的文件同步功能
@@ -273,6 +1171,13 @@ class SocketFileSync(object):
         :return:
         """
         server = self.setup_server_side()  # 配置服务端
+        self.disk_writer = DiskWriterPool(worker_number=self.disk_writer_number,
+                                          queue_size=self.disk_writer_queue_size)  # 启动写盘线程池
+        self.metrics.register_gauge('sync_queue_depth', self.disk_writer.queue_depth, queue='disk_writer')
+        self.server_ready.set()
+        if self.multicast_group:  # 加入组播，接收其他主机组播发送的文件
+            self.multicast_receiver = MulticastReceiver(local_ip=self.local_host_ip[0], group=self.multicast_group,
+                                                        port=self.multicast_port)
         while True:
             conn = None
             try:
@@ -284,70 +1189,139 @@ class SocketFileSync(object):
                 self.receive_socket_info(handle=conn, expected_msg='客户端已就绪')
                 self.send_socket_info(handle=conn, msg='服务端已就绪')
 
-                self.receive_socket_info(handle=conn, expected_msg='请求服务端文件列表')
-                all_file = self.get_local_all_file()
-                if all_file:
-                    # 发送服务端所有文件给客户端检查
-                    self.send_socket_info(handle=conn, msg=str(all_file))
-                else:
-                    self.send_socket_info(handle=conn, msg='服务端没有任何数据')
+                expect_info = ['请求服务端文件列表', '请求分片摘要: ']
+                socket_data = self.receive_socket_info(handle=conn, expected_msg=expect_info)
+
+                # 其他服务端巡检发现损坏的文件，请求分片修复，使用单独的线程处理，不阻塞服务端监听
+                if expect_info[1] in socket_data:
+                    threading.Thread(target=self.serve_chunk_repair, args=(conn, socket_data), daemon=True).start()
+                    continue
 
-                expect_info = ['不需要更新', '开始更新']
+                # 从内存快照发送服务端所有文件给客户端检查，文件列表可能超过buffer size，使用带长度前缀的消息
+                self.send_socket_frame(handle=conn, msg=self.get_manifest_message())
+
+                expect_info = ['不需要更新', '开始更新', '开始组播更新', '请求拉取文件']
                 socket_data = self.receive_socket_info(handle=conn, expected_msg=expect_info)
 
                 # 如果不需要更新，跳到下次连接
                 if expect_info[0] in socket_data:
                     continue
 
+                # 客户端拉取本地缺失的文件，服务端作为发送方
+                if expect_info[3] in socket_data:
+                    self.serve_pull_request(handle=conn, peer=address[0])
+                    conn.close()
+                    continue
+
                 self.send_socket_info(handle=conn, msg='服务端已收到更新请求')
-                while True:
-                    expect_info = ['全部更新完毕', '文件详情: ']
-                    socket_data = self.receive_socket_info(handle=conn, expected_msg=expect_info)
+                with self.foreground_sync():
+                    while True:
+                        expect_info = ['全部更新完毕', '文件详情: ', '组播预告: ', '组播发送完毕: ', '组播放弃: ', '组播进行中']
+                        socket_data = self.receive_socket_info(handle=conn, expected_msg=expect_info)
 
-                    # 如果全部更新完毕，跳出循环
-                    if expect_info[0] in socket_data:
-                        break
+                        # 客户端组播发送期间的保活消息只用于刷新超时时间，可能和后续的控制信息粘连
+                        socket_data = socket_data.replace(expect_info[5], '')
+                        if not socket_data:
+                            continue
 
-                    # 文件详情接收确认
-                    file_name, file_size, file_md5 = socket_data.split(expect_info[1])[-1].split(self.socket_separator)
-                    self.send_socket_info(handle=conn, msg='服务端已收到文件详情')
+                        # 如果全部更新完毕，跳出循环
+                        if expect_info[0] in socket_data:
+                            break
 
-                    # 检查客户端传送过来的文件所处的文件夹是否存在，如果不存在创建一个新的
-                    self.check_transfer_folder_exists(files=file_name)
+                        # 组播传输的文件，通过TCP预告、报告缺失分片和确认结果
+                        if expect_info[2] in socket_data or expect_info[3] in socket_data \
+                                or expect_info[4] in socket_data:
+                            self.handle_multicast_info(handle=conn, socket_data=socket_data, peer=address[0])
+                            continue
 
-                    # 接收客户端发送的文件，将二进制全部保存到python变量中
-                    data_content = ''.encode()
-                    while True:
-                        socket_data = self.receive_socket_info(handle=conn, expected_msg='',
-                                                               do_decode=False, do_print_info=False)
-                        if '文件传输完毕'.encode() in socket_data:
-                            break
-                        data_content += socket_data
-                        self.send_socket_info(handle=conn, msg='服务端接收文件成功')
-
-                    # 一次性写入文件，防止文件粘连
-                    with open(file_name, 'wb') as wf:
-                        wf.write(data_content)
-
-                    # 检查文件传输后的size和md5
-                    new_file_size = str(os.path.getsize(file_name))
-                    new_file_md5 = self.get_file_md5(file_name=file_name)
-                    if new_file_size != file_size or new_file_md5 != file_md5:
-                        self.send_socket_info(handle=conn, msg='服务端写入文件有误，请重新传送...')
-                    else:
-                        self.send_socket_info(handle=conn, msg='服务端写入文件成功')
+                        # 文件详情接收确认
+                        file_name, file_size, file_md5 = \
+                            socket_data.split(expect_info[1])[-1].split(self.socket_separator)
+                        self.send_socket_info(handle=conn, msg='服务端已收到文件详情')
+
+                        self.receive_file(handle=conn, file_name=file_name, file_size=file_size, file_md5=file_md5,
+                                          peer=address[0])
 
                 conn.close()  # 断开socket连接
                 time.sleep(self.waiting_time)
 
             except Exception as ex:
-                self.print_info(msg='服务端发生错误: {}, 正在重新启动...'.format(ex))
+                self.print_info(msg='服务端发生错误: {}, 正在重新启动...'.format(ex), level=logging.ERROR)
                 if conn:  # 断开socket连接
                     conn.close()
                 time.sleep(self.waiting_time)
             finally:
-                # 每次服务端被请求后，更新最新的文件列表到self.latest_file_list
-                self.latest_file_list = self.get_local_all_file()
+                # 每次服务端被请求后，从快照更新最新的文件列表到self.latest_file_list，接收的文件不会再触发客户端同步
+                self.latest_file_list = self.get_stable_manifest()
+
+    def serve_pull_request(self, handle, peer=''):
+        """
+        服务端处理客户端的拉取请求：接收客户端需要的文件列表，逐个使用 self.send_file 发送，收发双方的角色与推送时相反
+        :param handle: socket句柄
+        :param peer: 对端IP，用于统计指标
+        :return:
+        """
+        self.send_socket_info(handle=handle, msg='服务端已收到拉取请求')
+        pull_files = self.receive_socket_frame(handle=handle).split('\n')
+
+        stable_manifest = self.get_stable_manifest()
+        with self.foreground_sync():
+            for file_name in pull_files:
+                each_file = stable_manifest.get(file_name)
+                if each_file and os.path.isfile(file_name):  # 请求期间被删除或仍在写入的文件跳过
+                    self.send_file(handle=handle, each_file=each_file, side='server', peer=peer)
+        self.send_socket_info(handle=handle, msg='全部更新完毕')
+
+    def handle_multicast_info(self, handle, socket_data, peer=''):
+        """
+        服务端处理组播传输的控制信息：
+            组播预告 - 登记即将通过组播接收的文件
+            组播发送完毕 - 返回缺失的分片，分片全部收到后校验size和md5
+            组播放弃 - 客户端改用TCP传输，删除临时文件
+        :param handle: socket句柄
+        :param socket_data: 客户端发送的控制信息
+        :param peer: 对端IP，用于统计指标
+        :return:
+        """
+        if not self.multicast_receiver:
+            raise ValueError('服务端没有开启组播，请使用 --multicast-group 启动')
+
+        if '组播预告: ' in socket_data:
+            transfer_id, file_name, file_size, file_md5, chunk_size = \
+                socket_data.split('组播预告: ')[-1].split(self.socket_separator)
+            self.check_transfer_folder_exists(files=file_name)
+            self.multicast_receiver.register(transfer_id=int(transfer_id), file_name=file_name,
+                                             file_size=int(file_size), file_md5=file_md5, chunk_size=int(chunk_size),
+                                             temp_file_name=file_name + self.receive_temp_suffix)
+            self.send_socket_info(handle=handle, msg='服务端已准备接收组播')
+            return
+
+        if '组播放弃: ' in socket_data:
+            task = self.multicast_receiver.finish(int(socket_data.split('组播放弃: ')[-1]))
+            os.remove(task.temp_file_name)
+            self.send_socket_info(handle=handle, msg='服务端已放弃组播')
+            return
+
+        transfer_id = int(socket_data.split('组播发送完毕: ')[-1])
+        missing_ranges = self.multicast_receiver.get_missing_ranges(transfer_id)
+        if missing_ranges:
+            self.send_socket_info(handle=handle, msg='缺失分片: {}'.format(
+                ','.join(f'{first_chunk}-{last_chunk}' for first_chunk, last_chunk in missing_ranges)))
+            return
+
+        # 分片全部收到，检查文件传输后的size和md5
+        task = self.multicast_receiver.finish(transfer_id)
+        file_digest = self.get_file_digest(file_name=task.temp_file_name)
+        if os.path.getsize(task.temp_file_name) != task.file_size or file_digest.hex() != task.file_md5:
+            os.remove(task.temp_file_name)
+            self.send_socket_info(handle=handle, msg='服务端写入文件有误，请重新传送...')
+            return
+
+        os.replace(task.temp_file_name, task.file_name)
+        self.update_local_manifest(file_name=task.file_name, file_digest=file_digest)
+        self.send_socket_info(handle=handle, msg='服务端写入文件成功')
+        self.metrics.inc('sync_received_bytes_total', task.file_size, peer=peer)
+        self.metrics.inc('sync_received_files_total', peer=peer)
 
     def check_local_file_status(self):
         """
@@ -355,7 +1329,7 @@ class SocketFileSync(object):
         :return:
         """
         for _ in range(self.automatic_sync_time):
-            all_file = self.get_local_all_file()
+            all_file = self.get_local_all_file(stable_only=True)
             if all_file:
                 if all_file != self.latest_file_list:
                     break
@@ -363,6 +1337,433 @@ class SocketFileSync(object):
         else:
             self.print_info(side='client', msg='到达同步时间，开始自动同步！')
 
+    def send_file(self, handle, each_file, side='client', peer=''):
+        """
+        发送单个文件到对端，对端校验size和md5失败时，按指数退避有限次数重传
+        :param handle: socket句柄
+        :param ManifestEntry each_file: 文件信息
+        :param side: 默认client端
+        :param peer: 对端IP，用于统计指标
+        :return: True or False
+        """
+        file_name = each_file.file
+        file_size = each_file.size
+        file_md5 = each_file.md5
+
+        if file_size > self.maximum_transfer_size:
+            self.print_info(side=side, msg=f'跳过超过文件传输上限的文件，file：{file_name}，size：{file_size}',
+                            level=logging.WARNING)
+            return False
+
+        for retry in range(self.max_transfer_retries + 1):
+            if retry:
+                # 文件在扫描之后又发生了变化，说明仍在写入，重传只会再次失败，等待下次同步
+                if not os.path.isfile(file_name) or os.path.getsize(file_name) != file_size \
+                        or not self.check_file_stable(file_name=file_name):
+                    self.print_info(side=side, msg=f'文件仍在写入，跳过本次同步，file：{file_name}')
+                    return False
+
+                backoff_time = min(self.retry_backoff_time * 2 ** (retry - 1), self.retry_backoff_max)
+                self.print_info(side=side, msg=f'{backoff_time}秒后第{retry}次重传，file：{file_name}',
+                                level=logging.WARNING)
+                self.metrics.inc('sync_transfer_retries_total', peer=peer)
+                time.sleep(backoff_time)
+
+            start_time = time.time()
+
+            # 发送文件名、文件大小、md5值到服务端
+            file_info = f'{file_name}{self.socket_separator}{file_size}{self.socket_separator}{file_md5}'
+            self.send_socket_info(handle=handle, side=side, msg=f'文件详情: {file_info}')
+            self.receive_socket_info(handle=handle, side=side, expected_msg='服务端已收到文件详情')
+
+            # 发送文件内容到服务端，使用tqdm显示发送进度
+            with tqdm.tqdm(desc=f'发送: {file_name}', total=file_size, unit='B', unit_divisor=1024,
+                           disable=not logger.isEnabledFor(logging.INFO)) as bar:
+                # 读取文件，发送后不保留页缓存
+                for bytes_read in self.file_reader.read_chunks(file_name=file_name, chunk_size=self.buffer_size):
+                    # 发送文件
+                    self.send_socket_info(handle=handle, side=side,
+                                          msg=bytes_read, do_encode=False, do_print_info=False)
+                    self.receive_socket_info(handle=handle, side=side,
+                                             expected_msg='服务端接收文件成功', do_print_info=False)
+                    bar.update(len(bytes_read))
+
+            self.send_socket_info(handle=handle, side=side, msg='文件传输完毕')
+
+            # 确认文件传输后的size和md5
+            socket_data = self.receive_socket_info(handle=handle, side=side, expected_msg='')
+            if '服务端写入文件有误' not in socket_data:
+                self.metrics.inc('sync_sent_bytes_total', file_size, peer=peer)
+                self.metrics.inc('sync_sent_files_total', peer=peer)
+                self.metrics.set('sync_peer_bytes_per_second', file_size / max(time.time() - start_time, 1e-6),
+                                 peer=peer, direction='sent')
+                return True
+
+        self.print_info(side=side, msg=f'超过最大重传次数{self.max_transfer_retries}，跳过文件：{file_name}',
+                        level=logging.ERROR)
+        return False
+
+    def get_need_sync_files(self, all_file, socket_data):
+        """
+        对比本地文件和服务端文件，找出需要传输到服务端的文件
+        :param FileManifest all_file: 本地已经写入完毕的文件
+        :param str socket_data: 服务端发送的文件列表
+        :return: need sync files
+        """
+        if '服务端没有任何数据' in socket_data:
+            return list(all_file)
+
+        # 取出服务端所有的文件信息，按文件名二分查找
+        server_manifest = FileManifest.from_text(socket_data, separator=self.socket_separator)
+
+        # 判断需要传输到服务端的文件
+        need_sync_files = []
+        for each_file in all_file:
+            server_file = server_manifest.get(each_file.file)
+            if not server_file:  # 如果本地文件不在服务端，添加到同步文件中
+                need_sync_files.append(each_file)
+                continue
+
+            if each_file.digest != server_file.digest:  # 如果本地文件和服务端文件md5不同，添加到同步文件中
+                need_sync_files.append(each_file)
+                continue
+        return need_sync_files
+
+    def request_server_file_list(self, other_host):
+        """
+        连接服务端并握手，请求服务端文件列表，找出需要传输到服务端的文件
+        :param other_host: 被连接的其他主机
+        :return: (client handle, need sync files)
+        """
+        client = self.setup_client_side(other_host)  # 配置客户端
+        try:
+            client.settimeout(self.socket_timeout_time)  # 设置客户端超时时间
+
+            # 与服务端握手
+            self.send_socket_info(handle=client, side='client', msg='客户端已就绪')
+            self.receive_socket_info(handle=client, side='client', expected_msg='服务端已就绪')
+
+            self.send_socket_info(handle=client, side='client', msg='请求服务端文件列表')
+            socket_data = self.receive_socket_frame(handle=client, side='client')
+        except Exception:
+            client.close()
+            raise
+
+        all_file = self.get_local_all_file(stable_only=True)
+        return client, self.get_need_sync_files(all_file=all_file, socket_data=socket_data)
+
+    def pull_files(self, client, other_host, pull_files):
+        """
+        客户端从服务端拉取文件，使用 self.receive_file 接收，收发双方的角色与推送时相反
+        :param client: 已经获取过服务端文件列表的client handle
+        :param other_host: 服务端IP
+        :param list pull_files: 需要拉取的文件名
+        :return: 拉取成功的文件数量
+        """
+        self.send_socket_info(handle=client, side='client', msg='请求拉取文件')
+        self.receive_socket_info(handle=client, side='client', expected_msg='服务端已收到拉取请求')
+        self.send_socket_frame(handle=client, side='client', msg='\n'.join(pull_files))
+
+        pulled_number = 0
+        with self.foreground_sync():
+            while True:
+                expect_info = ['全部更新完毕', '文件详情: ']
+                socket_data = self.receive_socket_info(handle=client, side='client', expected_msg=expect_info)
+                if expect_info[0] in socket_data:
+                    break
+
+                file_name, file_size, file_md5 = socket_data.split(expect_info[1])[-1].split(self.socket_separator)
+                if file_name not in pull_files:
+                    raise ValueError(f'服务端发送了没有请求的文件：{file_name}')
+                self.send_socket_info(handle=client, side='client', msg='服务端已收到文件详情')
+                if self.receive_file(handle=client, file_name=file_name, file_size=file_size, file_md5=file_md5,
+                                     side='client', peer=other_host):
+                    pulled_number += 1
+        return pulled_number
+
+    def pull_missing_files(self):
+        """
+        启动时从其他服务端拉取本地缺失的文件：
+            1. 同时向所有其他服务端请求文件列表，按响应时间排序，取最快的 self.pull_peer_number 个服务端
+            2. 每个缺失的文件只从一个服务端拉取，优先分配给最快且文件数量最少的服务端
+            3. 每个服务端一个线程并行拉取
+        本地已经存在但md5不同的文件不拉取，仍然由推送同步处理
+        :return:
+        """
+        if not self.pull_peer_number:
+            return
+        self.server_ready.wait()
+
+        local_manifest = self.get_local_all_file()
+        probes = []  # [(响应时间, IP, client handle, 服务端文件列表)]
+        probe_lock = threading.Lock()
+
+        def probe_peer(other_host):
+            try:
+                start_time = time.time()
+                client = self.setup_client_side(other_host)
+                client.settimeout(self.socket_timeout_time)
+                self.send_socket_info(handle=client, side='client', msg='客户端已就绪')
+                self.receive_socket_info(handle=client, side='client', expected_msg='服务端已就绪')
+                self.send_socket_info(handle=client, side='client', msg='请求服务端文件列表')
+                socket_data = self.receive_socket_frame(handle=client, side='client')
+            except Exception as ex:
+                self.print_info(side='client', msg=f'连接服务端 {other_host} 失败：{ex}', level=logging.WARNING)
+                return
+            server_manifest = FileManifest() if '服务端没有任何数据' in socket_data else \
+                FileManifest.from_text(socket_data, separator=self.socket_separator)
+            with probe_lock:
+                probes.append((time.time() - start_time, other_host, client, server_manifest))
+
+        probe_threads = [threading.Thread(target=probe_peer, args=(each_host,)) for each_host in self.other_host_ip]
+        for thread in probe_threads:
+            thread.start()
+        for thread in probe_threads:
+            thread.join()
+        probes.sort(key=itemgetter(0))
+
+        # 最快的服务端优先，每个缺失的文件分配给已分配文件最少的服务端
+        selected_probes = probes[:self.pull_peer_number]
+        assigned_files = {other_host: [] for _, other_host, _, _ in selected_probes}
+        for _, other_host, _, server_manifest in selected_probes:
+            for each_file in server_manifest:
+                if each_file.file in local_manifest:
+                    continue
+                owners = [host for _, host, _, manifest in selected_probes if each_file.file in manifest]
+                if owners[0] != other_host:  # 只在第一个拥有该文件的服务端处理一次
+                    continue
+                owner = min(owners, key=lambda host: len(assigned_files[host]))
+                assigned_files[owner].append(each_file.file)
+
+        pull_threads = []
+        for _, other_host, client, _ in probes:
+            if not assigned_files.get(other_host):
+                self.send_socket_info(handle=client, side='client', msg='不需要更新')
+                client.close()
+                continue
+
+            def pull_from_peer(client=client, other_host=other_host):
+                try:
+                    pulled_number = self.pull_files(client=client, other_host=other_host,
+                                                    pull_files=assigned_files[other_host])
+                    self.print_info(side='client', msg=f'从 {other_host} 拉取了 {pulled_number} 个文件')
+                except Exception as ex:
+                    self.print_info(side='client', msg=f'从 {other_host} 拉取文件失败：{ex}', level=logging.ERROR)
+                finally:
+                    client.close()
+
+            pull_threads.append(threading.Thread(target=pull_from_peer))
+        for thread in pull_threads:
+            thread.start()
+        for thread in pull_threads:
+            thread.join()
+
+    def keep_multicast_clients_alive(self, clients, client_locks, stop_event):
+        """
+        组播模式下定时向空闲的控制连接发送保活消息，防止组播发送或TCP发送其他服务端的文件期间服务端超时断开
+        正在与服务端交互的控制连接已经加锁，跳过不发送
+        :param dict clients: 组播模式的控制连接，例如：{ip: client handle}
+        :param dict client_locks: 控制连接的锁，例如：{ip: threading.Lock}
+        :param threading.Event stop_event: 同步结束时停止发送
+        :return:
+        """
+        while not stop_event.wait(self.socket_timeout_time / 3):
+            for host, lock in list(client_locks.items()):
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    if host in clients:
+                        self.send_socket_info(handle=clients[host], side='client', msg='组播进行中', do_print_info=False)
+                except OSError as ex:
+                    self.print_info(side='client', msg=f'发送保活消息到 {host} 失败：{ex}', level=logging.WARNING)
+                finally:
+                    lock.release()
+
+    def drop_multicast_client(self, clients, host, ex):
+        """
+        与某个服务端的控制连接出错时只断开该服务端，其他服务端继续同步，未同步的文件在下次同步时重传
+        :param dict clients: 组播模式的控制连接，例如：{ip: client handle}
+        :param str host: 出错的服务端IP
+        :param Exception ex: 错误信息
+        :return:
+        """
+        self.print_info(side='client', msg=f'与服务端 {host} 同步发生错误：{ex}，断开连接', level=logging.ERROR)
+        client = clients.pop(host, None)
+        if client:
+            client.close()
+
+    def exchange_multicast_info(self, clients, client_locks, host, msg, expected_msg=''):
+        """
+        通过控制连接向一个服务端发送组播控制信息并接收回复，出错时断开该服务端
+        :param dict clients: 组播模式的控制连接，例如：{ip: client handle}
+        :param dict client_locks: 控制连接的锁，例如：{ip: threading.Lock}
+        :param str host: 服务端IP
+        :param str msg: 控制信息
+        :param expected_msg: 期待接受的内容
+        :return: 服务端回复，出错时返回None
+        """
+        try:
+            with client_locks[host]:
+                self.send_socket_info(handle=clients[host], side='client', msg=msg)
+                return self.receive_socket_info(handle=clients[host], side='client', expected_msg=expected_msg)
+        except Exception as ex:
+            self.drop_multicast_client(clients=clients, host=host, ex=ex)
+            return None
+
+    def send_file_to_multicast_client(self, clients, client_locks, host, each_file):
+        """
+        通过控制连接使用TCP发送文件到一个服务端，出错时断开该服务端
+        :param dict clients: 组播模式的控制连接，例如：{ip: client handle}
+        :param dict client_locks: 控制连接的锁，例如：{ip: threading.Lock}
+        :param str host: 服务端IP
+        :param ManifestEntry each_file: 文件信息
+        :return:
+        """
+        try:
+            with client_locks[host]:
+                self.send_file(handle=clients[host], each_file=each_file, side='client', peer=host)
+        except Exception as ex:
+            self.drop_multicast_client(clients=clients, host=host, ex=ex)
+
+    def multicast_file(self, sender, each_file, hosts, clients, client_locks):
+        """
+        组播发送一个文件到多个服务端：通过TCP预告文件信息，组播发送所有分片，再按服务端报告的缺失分片补发
+        多轮补发后仍然失败的服务端，改用TCP发送；控制连接出错的服务端单独断开，不影响其他服务端
+        :param MulticastSender sender: 组播发送端
+        :param ManifestEntry each_file: 文件信息
+        :param list hosts: 需要接收该文件的服务端IP
+        :param dict clients: 组播模式的控制连接，例如：{ip: client handle}
+        :param dict client_locks: 控制连接的锁，例如：{ip: threading.Lock}
+        :return:
+        """
+        if each_file.size > self.maximum_transfer_size:
+            self.print_info(side='client', msg=f'跳过超过文件传输上限的文件，file：{each_file.file}，'
+                                               f'size：{each_file.size}', level=logging.WARNING)
+            return
+
+        transfer_id = random.getrandbits(32)
+        chunk_number = math.ceil(each_file.size / self.multicast_chunk_size)
+        file_info = self.socket_separator.join([str(transfer_id), each_file.file, str(each_file.size),
+                                                each_file.md5, str(self.multicast_chunk_size)])
+        pending = []  # 还没有收齐分片的服务端
+        for host in hosts:
+            if self.exchange_multicast_info(clients=clients, client_locks=client_locks, host=host,
+                                            msg=f'组播预告: {file_info}', expected_msg='服务端已准备接收组播'):
+                pending.append(host)
+
+        failed = []  # 校验失败的服务端
+        ranges = [(0, chunk_number)]
+        for _ in range(self.multicast_repair_rounds + 1):
+            if ranges and pending:
+                sent_size = sender.send_chunks(transfer_id=transfer_id, file_name=each_file.file,
+                                               chunk_size=self.multicast_chunk_size, ranges=ranges)
+                self.metrics.inc('sync_sent_bytes_total', sent_size, peer='multicast')
+
+            # 所有服务端报告的缺失分片合并后统一补发
+            missing_chunks = set()
+            for host in list(pending):
+                socket_data = self.exchange_multicast_info(clients=clients, client_locks=client_locks, host=host,
+                                                           msg=f'组播发送完毕: {transfer_id}')
+                if socket_data is None:
+                    pending.remove(host)
+                    continue
+
+                if '缺失分片: ' in socket_data:
+                    for each_range in socket_data.split('缺失分片: ')[-1].split(','):
+                        first_chunk, last_chunk = each_range.split('-')
+                        missing_chunks.update(range(int(first_chunk), int(last_chunk)))
+                    continue
+
+                pending.remove(host)
+                if '服务端写入文件有误' in socket_data:
+                    failed.append(host)
+                else:
+                    self.metrics.inc('sync_sent_files_total', peer=host)
+
+            if not pending:
+                break
+            ranges = [(chunk_index, chunk_index + 1) for chunk_index in sorted(missing_chunks)]
+
+        for host in pending:
+            if self.exchange_multicast_info(clients=clients, client_locks=client_locks, host=host,
+                                            msg=f'组播放弃: {transfer_id}', expected_msg='服务端已放弃组播'):
+                failed.append(host)
+
+        for host in failed:
+            self.print_info(side='client', msg=f'组播发送失败，改用TCP发送，file：{each_file.file}，server：{host}',
+                            level=logging.WARNING)
+            self.send_file_to_multicast_client(clients=clients, client_locks=client_locks, host=host,
+                                               each_file=each_file)
+
+    def sync_files_by_multicast(self):
+        """
+        组播模式：同时连接所有其他服务端，多个服务端需要的同一个文件只组播发送一次，只有一个服务端需要的文件使用TCP发送
+        同步期间后台线程向空闲的控制连接发送保活消息，某个服务端出错时只断开该服务端
+        :return:
+        """
+        clients = {}  # {ip: client handle}
+        client_locks = {}  # {ip: threading.Lock}，正在交互的控制连接加锁，保活线程跳过
+        need_sync_mapping = {}  # {文件名: (文件信息, [需要该文件的服务端])}
+        sender = None
+        stop_event = threading.Event()
+        keepalive_thread = threading.Thread(target=self.keep_multicast_clients_alive,
+                                            args=(clients, client_locks, stop_event), daemon=True)
+        try:
+            for each_host in self.other_host_ip:
+                try:
+                    client, need_sync_files = self.request_server_file_list(each_host)
+                except Exception as ex:
+                    self.print_info(side='client', msg=f'连接服务端 {each_host} 失败：{ex}', level=logging.ERROR)
+                    continue
+
+                try:
+                    if not need_sync_files:
+                        self.send_socket_info(handle=client, side='client', msg='不需要更新')
+                        client.close()
+                        continue
+
+                    self.send_socket_info(handle=client, side='client', msg='开始组播更新')
+                    self.receive_socket_info(handle=client, side='client', expected_msg='服务端已收到更新请求')
+                except Exception as ex:
+                    self.print_info(side='client', msg=f'连接服务端 {each_host} 失败：{ex}', level=logging.ERROR)
+                    client.close()
+                    continue
+
+                client_locks[each_host] = threading.Lock()
+                clients[each_host] = client
+                for each_file in need_sync_files:
+                    need_sync_mapping.setdefault(each_file.file, (each_file, []))[1].append(each_host)
+
+            if need_sync_mapping:
+                sender = MulticastSender(local_ip=self.local_host_ip[0], group=self.multicast_group,
+                                         port=self.multicast_port, ttl=self.multicast_ttl, rate=self.multicast_rate)
+                keepalive_thread.start()
+            for each_file, hosts in need_sync_mapping.values():
+                hosts = [host for host in hosts if host in clients]  # 跳过已经断开的服务端
+                if len(hosts) == 1:
+                    self.send_file_to_multicast_client(clients=clients, client_locks=client_locks, host=hosts[0],
+                                                       each_file=each_file)
+                elif hosts:
+                    self.multicast_file(sender=sender, each_file=each_file, hosts=hosts, clients=clients,
+                                        client_locks=client_locks)
+
+            stop_event.set()
+            if keepalive_thread.is_alive():
+                keepalive_thread.join()
+            for host, client in list(clients.items()):
+                try:
+                    self.send_socket_info(handle=client, side='client', msg='全部更新完毕')
+                except OSError as ex:
+                    self.drop_multicast_client(clients=clients, host=host, ex=ex)
+        finally:
+            stop_event.set()
+            if keepalive_thread.is_alive():
+                keepalive_thread.join()
+            for client in clients.values():
+                client.close()
+            if sender:
+                sender.close()
+
     def start_client_request_file_sync(self):
         """
         启动客户端访问其他服务端请求文件同步
@@ -372,94 +1773,37 @@ class SocketFileSync(object):
             3. 每隔 self.automatic_sync_time 秒，自动请求同步一次
         :return:
         """
+        try:
+            self.pull_missing_files()  # 启动时先拉取本地缺失的文件
+        except Exception as ex:
+            self.print_info(side='client', msg='拉取文件发生错误：{}'.format(ex), level=logging.ERROR)
+
         while True:
             # 循环读取本地目录下的所有文件，判断是否启动客户端
             self.check_local_file_status()
             client = None
             try:
+                # 组播模式，同时向所有其他服务端同步文件
+                if self.multicast_group:
+                    with self.foreground_sync():
+                        self.sync_files_by_multicast()
+                    time.sleep(self.waiting_time)
+                    continue
+
                 # 启动客户端
                 for each_host in self.other_host_ip:  # 循环连接每一个其他服务端请求文件同步
-                    client = self.setup_client_side(each_host)  # 配置客户端
-                    client.settimeout(self.socket_timeout_time)  # 设置客户端超时时间
-
-                    # 与服务端握手
-                    self.send_socket_info(handle=client, side='client', msg='客户端已就绪')
-                    self.receive_socket_info(handle=client, side='client', expected_msg='服务端已就绪')
-
-                    self.send_socket_info(handle=client, side='client', msg='请求服务端文件列表')
-                    socket_data = self.receive_socket_info(handle=client, side='client', expected_msg='')
-
-                    all_file = self.get_local_all_file()
-                    if all_file:
-                        if '服务端没有任何数据' in socket_data:
-                            need_sync_files = all_file
-                        else:
-                            # 取出服务端所有的文件信息
-                            server_file_mapping = {}
-                            for server_file in eval(socket_data):  # 转变为字典格式，服务端文件名用作Key，方便读取
-                                server_file_mapping[server_file['file']] = server_file
-
-                            server_files = [i for i in server_file_mapping.keys()]  # 取出服务端所有的文件名
-
-                            # 判断需要传输到服务端的文件
-                            need_sync_files = []
-                            for each_file in all_file:
-                                if each_file['file'] not in server_files:  # 如果本地文件不在服务端，添加到同步文件中
-                                    need_sync_files.append(each_file)
-                                    continue
-
-                                server_file_md5 = server_file_mapping[each_file['file']]['md5']
-                                if each_file['md5'] != server_file_md5:  # 如果本地文件和服务端文件md5不同，添加到同步文件中
-                                    need_sync_files.append(each_file)
-                                    continue
-
-                        if need_sync_files:
-                            # 开始传输文件
-                            self.send_socket_info(handle=client, side='client', msg='开始更新')
-                            self.receive_socket_info(handle=client, side='client', expected_msg='服务端已收到更新请求')
+                    client, need_sync_files = self.request_server_file_list(each_host)
+
+                    if need_sync_files:
+                        # 开始传输文件
+                        self.send_socket_info(handle=client, side='client', msg='开始更新')
+                        self.receive_socket_info(handle=client, side='client', expected_msg='服务端已收到更新请求')
 
+                        with self.foreground_sync():
                             for each_file in need_sync_files:  # 循环传输每一个文件
-                                file_name = each_file['file']
-                                file_size = each_file['size']
-                                file_md5 = each_file['md5']
-
-                                if file_size > self.maximum_transfer_size:
-                                    self.print_info(side='client', msg=f'跳过超过文件传输上限的文件，'
-                                                                       f'file：{file_name}，size：{file_size}')
-                                    continue
-
-                                while True:
-                                    # 发送文件名、文件大小、md5值到服务端
-                                    file_info = f'{file_name}{self.socket_separator}{file_size}{self.socket_separator}{file_md5}'
-                                    self.send_socket_info(handle=client, side='client', msg=f'文件详情: {file_info}')
-                                    self.receive_socket_info(handle=client, side='client', expected_msg='服务端已收到文件详情')
-
-                                    # 发送文件内容到服务端，使用tqdm显示发送进度
-                                    with tqdm.tqdm(desc=f'发送: {file_name}', total=file_size, unit='B', unit_divisor=1024) as bar:
-                                        with open(file_name, 'rb') as rf:
-                                            while True:
-                                                # 读取文件
-                                                bytes_read = rf.read(self.buffer_size)
-                                                if not bytes_read:
-                                                    break
-                                                # 发送文件
-                                                self.send_socket_info(handle=client, side='client',
-                                                                      msg=bytes_read, do_encode=False, do_print_info=False)
-                                                self.receive_socket_info(handle=client, side='client',
-                                                                         expected_msg='服务端接收文件成功', do_print_info=False)
-                                                bar.update(len(bytes_read))
-
-                                    self.send_socket_info(handle=client, side='client', msg='文件传输完毕')
-
-                                    # 确认文件传输后的size和md5
-                                    socket_data = self.receive_socket_info(handle=client, side='client', expected_msg='')
-                                    if '服务端写入文件有误' in socket_data:
-                                        continue  # 如果服务端确认有误，retry
-                                    break
-
-                            self.send_socket_info(handle=client, side='client', msg='全部更新完毕')
-                        else:
-                            self.send_socket_info(handle=client, side='client', msg='不需要更新')
+                                self.send_file(handle=client, each_file=each_file, side='client', peer=each_host)
+
+                        self.send_socket_info(handle=client, side='client', msg='全部更新完毕')
                     else:
                         self.send_socket_info(handle=client, side='client', msg='不需要更新')
 
@@ -467,17 +1811,281 @@ class SocketFileSync(object):
                     time.sleep(self.waiting_time)
 
             except Exception as ex:
-                self.print_info(side='client', msg='客户端发生错误：{}'.format(ex))
+                self.print_info(side='client', msg='客户端发生错误：{}'.format(ex), level=logging.ERROR)
                 if client:
                     client.close()
                 time.sleep(self.waiting_time)
 
+    @contextmanager
+    def foreground_sync(self):
+        """
+        标记一次前台同步，期间后台巡检暂停读盘，不和前台同步争抢磁盘带宽
+        :return:
+        """
+        with self.foreground_condition:
+            self.foreground_syncs += 1
+        try:
+            yield
+        finally:
+            with self.foreground_condition:
+                self.foreground_syncs -= 1
+                self.foreground_condition.notify_all()
+
+    def wait_foreground_idle(self):
+        """
+        等待所有前台同步结束
+        :return:
+        """
+        with self.foreground_condition:
+            self.foreground_condition.wait_for(lambda: not self.foreground_syncs)
+
+    def read_scrub_chunks(self, file_name, chunk_size, first_chunk=0, chunk_number=None):
+        """
+        后台巡检读取文件分片：通过 self.file_reader 读取，每次读取前等待前台同步结束，并按 self.scrub_budget 限速
+        :param file_name: 文件路径
+        :param chunk_size: 分片大小
+        :param first_chunk: 开始读取的分片序号
+        :param chunk_number: 读取的分片数量，为空时读取到文件结尾
+        :return: 分片数据的生成器
+        """
+        def before_read(size):
+            self.wait_foreground_idle()
+            if self.scrub_budget:
+                self.scrub_budget.consume(size)
+
+        for data in self.file_reader.read_chunks(file_name=file_name, chunk_size=chunk_size, first_chunk=first_chunk,
+                                                 chunk_number=chunk_number, before_read=before_read):
+            self.metrics.inc('sync_scrub_bytes_total', len(data))
+            yield data
+
+    def get_chunk_digests(self, file_name):
+        """
+        计算文件整体的md5和每个分片的md5
+        :param file_name: 文件路径
+        :return: (16 bytes md5 digest, [每个分片的16 bytes md5 digest])
+        """
+        file_check = hashlib.md5()
+        chunk_digests = []
+        for data in self.read_scrub_chunks(file_name=file_name, chunk_size=self.scrub_chunk_size):
+            file_check.update(data)
+            chunk_digests.append(hashlib.md5(data).digest())
+        return file_check.digest(), chunk_digests
+
+    def serve_chunk_repair(self, handle, socket_data):
+        """
+        服务端为其他服务端的巡检修复提供分片，在单独的线程中运行，结束后断开socket连接：
+            请求分片摘要 - 本地文件与对端期望的md5一致时，返回每个分片的md5，否则返回空消息
+            请求文件分片 - 返回指定序号的分片数据
+            修复完毕 - 结束本次修复
+        对端正在等待修复，读盘不使用后台巡检的限速，也不等待前台同步结束
+        :param handle: socket句柄
+        :param socket_data: 客户端发送的分片摘要请求
+        :return:
+        """
+        try:
+            file_name, file_md5, chunk_size = socket_data.split('请求分片摘要: ')[-1].split(self.socket_separator)
+            chunk_size = int(chunk_size)
+
+            chunk_digests = []
+            local_file = self.local_manifest.get(file_name)
+            if local_file and local_file.md5 == file_md5 and os.path.isfile(file_name):
+                chunk_digests = self.get_cached_chunk_digests(file_name=file_name, chunk_size=chunk_size)
+                if chunk_digests is None:
+                    # 没有巡检缓存时本地文件也重新校验一次，只提供确认完好的文件
+                    chunk_digests = []
+                    file_check = hashlib.md5()
+                    for data in self.file_reader.read_chunks(file_name=file_name, chunk_size=chunk_size):
+                        file_check.update(data)
+                        chunk_digests.append(hashlib.md5(data).digest())
+                    if file_check.hexdigest() != file_md5:
+                        chunk_digests = []
+            self.send_socket_frame(handle=handle, msg=b''.join(chunk_digests), do_print_info=False)
+
+            while chunk_digests:
+                expect_info = ['修复完毕', '请求文件分片: ']
+                socket_data = self.receive_socket_info(handle=handle, expected_msg=expect_info)
+                if expect_info[0] in socket_data:
+                    break
+                chunk_index = int(socket_data.split(expect_info[1])[-1])
+                data = b''.join(self.file_reader.read_chunks(file_name=file_name, chunk_size=chunk_size,
+                                                             first_chunk=chunk_index, chunk_number=1))
+                self.send_socket_frame(handle=handle, msg=data, do_print_info=False)
+        except Exception as ex:
+            self.print_info(msg=f'提供修复分片失败：{ex}', level=logging.ERROR)
+        finally:
+            handle.close()
+
+    def get_cached_chunk_digests(self, file_name, chunk_size):
+        """
+        读取上次巡检确认完好的分片md5，文件在巡检后被修改或分片大小不同时返回None
+        :param file_name: 文件路径
+        :param chunk_size: 分片大小
+        :return: [每个分片的16 bytes md5 digest] or None
+        """
+        cache = self.scrub_digest_cache.get(file_name)
+        if not cache or chunk_size != self.scrub_chunk_size:
+            return None
+        file_size, file_mtime, chunk_digests = cache
+        file_stat = os.stat(file_name)
+        if (file_stat.st_size, file_stat.st_mtime_ns) != (file_size, file_mtime):
+            return None
+        return chunk_digests
+
+    def repair_file_from_peers(self, each_file, chunk_digests, file_stat):
+        """
+        从其他服务端拉取不一致的分片修复损坏的文件，修复后的文件md5与快照一致才替换原文件
+        :param ManifestEntry each_file: 快照中的文件信息
+        :param list chunk_digests: 本地文件每个分片的md5
+        :param file_stat: 巡检开始时文件的os.stat结果，替换前确认文件没有被前台同步修改
+        :return: True or False
+        """
+        # 修复和前台同步可能同时处理同一个文件，使用单独的临时文件，不覆盖或删除对方的临时文件
+        temp_file_name = f'{each_file.file}.{threading.get_ident()}{self.repair_temp_suffix}'
+        for each_host in self.other_host_ip:
+            client = None
+            try:
+                client = self.setup_client_side(each_host)
+                client.settimeout(self.socket_timeout_time)
+                self.send_socket_info(handle=client, side='client', msg='客户端已就绪')
+                self.receive_socket_info(handle=client, side='client', expected_msg='服务端已就绪')
+
+                request_info = self.socket_separator.join([each_file.file, each_file.md5, str(self.scrub_chunk_size)])
+                self.send_socket_info(handle=client, side='client', msg=f'请求分片摘要: {request_info}')
+                # 对端没有巡检缓存时需要先读取整个文件，超时时间按文件大小放宽
+                client.settimeout(self.socket_timeout_time + each_file.size / self.repair_read_rate)
+                peer_digests = self.receive_socket_frame(handle=client, side='client',
+                                                         do_decode=False, do_print_info=False)
+                client.settimeout(self.socket_timeout_time)
+                if not peer_digests:  # 对端没有完好的同一个文件
+                    continue
+
+                # 复制本地文件，只覆盖不一致的分片
+                repaired_chunks = 0
+                with open(temp_file_name, 'wb') as wf:
+                    for data in self.file_reader.read_chunks(file_name=each_file.file,
+                                                             chunk_size=self.scrub_chunk_size):
+                        wf.write(data)
+                    for chunk_index, chunk_digest in enumerate(chunk_digests):
+                        peer_digest = peer_digests[chunk_index * 16:(chunk_index + 1) * 16]
+                        if peer_digest == chunk_digest:
+                            continue
+                        self.send_socket_info(handle=client, side='client', msg=f'请求文件分片: {chunk_index}')
+                        wf.seek(chunk_index * self.scrub_chunk_size)
+                        wf.write(self.receive_socket_frame(handle=client, side='client',
+                                                           do_decode=False, do_print_info=False))
+                        repaired_chunks += 1
+                self.send_socket_info(handle=client, side='client', msg='修复完毕')
+
+                current_stat = os.stat(each_file.file)
+                if (current_stat.st_size, current_stat.st_mtime_ns) != (file_stat.st_size, file_stat.st_mtime_ns):
+                    return False  # 修复期间文件被前台同步更新，放弃修复结果
+                file_digest = self.get_file_digest(file_name=temp_file_name)
+                if file_digest != each_file.digest:
+                    continue
+
+                os.replace(temp_file_name, each_file.file)
+                self.update_local_manifest(file_name=each_file.file, file_digest=file_digest)
+                self.metrics.inc('sync_scrub_repaired_chunks_total', repaired_chunks, peer=each_host)
+                self.print_info(side='client', level=logging.WARNING,
+                                msg=f'从 {each_host} 修复了 {repaired_chunks} 个分片，file：{each_file.file}')
+                return True
+
+            except Exception as ex:
+                self.print_info(side='client', msg=f'从 {each_host} 修复文件失败：{ex}', level=logging.ERROR)
+            finally:
+                if client:
+                    client.close()
+                if os.path.exists(temp_file_name):
+                    os.remove(temp_file_name)
+        return False
+
+    def scrub_file(self, each_file):
+        """
+        重新校验单个文件的md5，与快照不一致时从其他服务端修复
+        :param ManifestEntry each_file: 快照中的文件信息
+        :return: 巡检结果：ok, changed, repaired, failed
+        """
+        if each_file.digest == FileManifest.unknown_digest or not os.path.isfile(each_file.file):
+            return 'changed'
+        file_stat = os.stat(each_file.file)
+        if (file_stat.st_size, file_stat.st_mtime_ns) != (each_file.size, each_file.mtime):
+            return 'changed'  # 文件已经正常修改，由下次扫描更新快照
+
+        file_digest, chunk_digests = self.get_chunk_digests(file_name=each_file.file)
+        current_stat = os.stat(each_file.file)
+        if (current_stat.st_size, current_stat.st_mtime_ns) != (file_stat.st_size, file_stat.st_mtime_ns):
+            return 'changed'
+        if file_digest == each_file.digest:
+            # 缓存确认完好的分片md5，其他服务端请求修复时不需要重新读取整个文件
+            self.scrub_digest_cache[each_file.file] = (file_stat.st_size, file_stat.st_mtime_ns, chunk_digests)
+            return 'ok'
+
+        self.print_info(side='client', msg=f'巡检发现文件损坏，file：{each_file.file}，'
+                                           f'期望md5：{each_file.md5}，实际md5：{file_digest.hex()}',
+                        level=logging.WARNING)
+        if self.repair_file_from_peers(each_file=each_file, chunk_digests=chunk_digests, file_stat=file_stat):
+            return 'repaired'
+        return 'failed'
+
+    def start_integrity_scrub(self):
+        """
+        后台完整性巡检：每隔 self.scrub_interval 秒，按快照逐个重新校验本地文件，发现损坏时从其他服务端修复
+        :return:
+        """
+        while True:
+            time.sleep(self.scrub_interval)
+            with self.manifest_lock:
+                manifest = self.local_manifest
+            for each_file in list(manifest):
+                try:
+                    result = self.scrub_file(each_file)
+                except Exception as ex:
+                    self.print_info(side='client', msg=f'巡检文件 {each_file.file} 失败：{ex}', level=logging.ERROR)
+                    result = 'failed'
+                self.metrics.inc('sync_scrub_files_total', result=result)
+
+            # 删除已经不在快照中的文件的分片md5缓存
+            self.scrub_digest_cache = {file_name: cache for file_name, cache in self.scrub_digest_cache.items()
+                                       if file_name in manifest}
+
+    def start_metrics_server(self):
+        """
+        在本地开启HTTP端口，以Prometheus文本格式提供同步指标，访问路径：http://127.0.0.1:{port}/metrics
+        :return:
+        """
+        metrics = self.metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                content = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass  # 不打印每次抓取指标的访问日志
+
+        server = ThreadingHTTPServer(('127.0.0.1', self.metrics_port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.print_info(msg=f'指标端口 127.0.0.1:{self.metrics_port} 开启')
+
     def main(self):
         # 记录本地目录下最初的所有文件，用于文件同步
-        all_file = self.get_local_all_file()
+        all_file = self.get_local_all_file(stable_only=True)
         if all_file:
             self.latest_file_list = all_file
 
+        if self.metrics_port:
+            self.start_metrics_server()
+
+        self.scrub_budget = IOBudget(rate=self.scrub_rate)  # 后台巡检的读盘限速
+
         threads = []
         # 配置所有线程
         start_server_forever_listen = threading.Thread(target=self.start_server_forever_listen)
@@ -486,15 +2094,18 @@ class SocketFileSync(object):
         # 添加所有线程到列表
         for t in [start_server_forever_listen, start_client_request_file_sync]:
             threads.append(t)
+        if self.scrub_rate:
+            threads.append(threading.Thread(target=self.start_integrity_scrub, daemon=True))
 
         # 开启所有线程
         for thread in threads:
             thread.start()
 
 
-def parameter_testing():
+def parameter_testing(args):
     """
     检查所有的参数是否合法、读取本地主机的IP
+    :param args: 命令行参数
     :return:
     """
     # 输入参数检查
@@ -525,13 +2136,20 @@ def parameter_testing():
 
 
 def main():
+    args = parser.parse_args()
+    logger.setLevel(args.log_level.upper())
+
     # 检查所有的参数是否合法、读取本地主机的IP
-    local_ip, all_other_ip = parameter_testing()
+    local_ip, all_other_ip = parameter_testing(args)
 
     # 启动Socket
     file_sync = SocketFileSync(local_host_ip=local_ip,
                                other_host_ip=all_other_ip,
                                file_directory='Socket_Files')
+    file_sync.metrics_port = args.metrics_port
+    file_sync.multicast_group = args.multicast_group
+    file_sync.scrub_rate = int(args.scrub_rate * 1048576)
+    file_sync.pull_peer_number = args.pull_peers
     file_sync.main()
 
 
@@ -0,0 +1,454 @@
+"""
+SocketFileSync 本机回环性能测试
+
+====================================
+
+在一台Linux主机上启动 N 个 SocketFileSync 进程，每个进程使用独立的 127.x.x.x 地址和独立的工作目录，不需要网络
+每个测试场景：
+    1. 在所有节点上生成相同的初始文件（可以为空）
+    2. 启动所有节点，在第一个节点上修改文件（新增、追加、重命名）
+    3. 统计所有节点的文件列表一致所需的时间、传输速率、所有节点的CPU时间和最大内存占用
+读盘测试：对比普通读取、PageCacheReader分片读取和mmap计算md5的速度，以及读取后留在页缓存中的数据量
+测试结果保存为JSON文件，可以和其他提交的测试结果对比
+
+***********************************************
+使用命令行启动：
+python benchmark.py --nodes 3 --output benchmark_results.json
+只运行部分场景，并和上一次的测试结果对比：
+python benchmark.py --scenarios tiny_files,renames --compare benchmark_results.json
+只运行读盘测试：
+python benchmark.py --scenarios none --io-size-mb 512
+***********************************************
+"""
+# -*- coding:utf-8 -*-
+# @Time     : 2026/10/19
+# @Python   : 3.7
+# @System   : Linux
+
+import os
+import sys
+import json
+import hashlib
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from automatic_file_sync import SocketFileSync, PageCacheReader, logger
+
+# 定义命令行参数
+parser = argparse.ArgumentParser()
+parser.add_argument("--nodes", type=int, default=3, help="启动的SocketFileSync节点数量，默认3")
+parser.add_argument("--scenarios", default='', help="要运行的场景，多个场景用逗号隔开，默认全部运行")
+parser.add_argument("--output", default='benchmark_results.json', help="测试结果保存的JSON文件")
+parser.add_argument("--compare", default='', help="上一次的测试结果JSON文件，用于对比")
+parser.add_argument("--work-dir", default='', help="节点的工作目录，默认使用临时目录，测试完成后删除")
+parser.add_argument("--timeout", type=float, default=300, help="每个场景等待同步完成的最长时间，单位秒")
+parser.add_argument("--tiny-count", type=int, default=1000, help="tiny_files 场景的小文件数量")
+parser.add_argument("--huge-size-mb", type=int, default=16, help="huge_files 场景每个大文件的大小，单位MB")
+parser.add_argument("--waiting-time", type=float, default=0.2, help="节点的 waiting_time，单位秒")
+parser.add_argument("--sync-time", type=int, default=2, help="节点的 automatic_sync_time，单位秒")
+parser.add_argument("--quiet-time", type=float, default=0.5, help="节点的 stable_quiet_time，单位秒")
+parser.add_argument("--multicast-group", default='', help="节点使用组播模式，例如：--multicast-group 239.255.66.66")
+parser.add_argument("--io-size-mb", type=int, default=128, help="读盘测试的文件大小，单位MB，0为不运行读盘测试")
+
+
+def write_random_file(file_name, size):
+    """
+    生成指定大小的随机内容文件
+    :param file_name: 文件路径
+    :param size: 文件大小，单位b
+    :return:
+    """
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'wb') as wf:
+        while size > 0:
+            chunk = os.urandom(min(size, 1048576))
+            wf.write(chunk)
+            size -= len(chunk)
+
+
+def build_tiny_files(options):
+    """
+    大量小文件：初始为空，第一个节点新增 tiny_count 个1KB的文件，分布在20个子目录中
+    :return: (初始化函数, 修改函数)
+    """
+    def mutate(file_location):
+        for index in range(options.tiny_count):
+            write_random_file(os.path.join(file_location, f'dir_{index % 20}', f'tiny_{index}.bin'), 1024)
+    return None, mutate
+
+
+def build_huge_files(options):
+    """
+    少量大文件：初始为空，第一个节点新增2个 huge_size_mb 大小的文件
+    :return: (初始化函数, 修改函数)
+    """
+    def mutate(file_location):
+        for index in range(2):
+            write_random_file(os.path.join(file_location, f'huge_{index}.bin'), options.huge_size_mb * 1048576)
+    return None, mutate
+
+
+def build_appended_logs(options):
+    """
+    持续追加的日志：所有节点初始有20个256KB的日志，第一个节点分5次每隔0.5秒给每个日志追加64KB
+    :return: (初始化函数, 修改函数)
+    """
+    def setup(file_location):
+        for index in range(20):
+            write_random_file(os.path.join(file_location, 'logs', f'test_{index}.log'), 262144)
+
+    def mutate(file_location):
+        for _ in range(5):
+            for index in range(20):
+                with open(os.path.join(file_location, 'logs', f'test_{index}.log'), 'ab') as af:
+                    af.write(os.urandom(65536))
+            time.sleep(0.5)
+    return setup, mutate
+
+
+def build_renames(options):
+    """
+    文件重命名：所有节点初始有200个16KB的文件，第一个节点重命名其中一半
+    同步不会删除文件，所以最终所有节点都会同时拥有重命名前后的文件
+    :return: (初始化函数, 修改函数)
+    """
+    def setup(file_location):
+        for index in range(200):
+            write_random_file(os.path.join(file_location, 'data', f'file_{index}.bin'), 16384)
+
+    def mutate(file_location):
+        for index in range(0, 200, 2):
+            os.rename(os.path.join(file_location, 'data', f'file_{index}.bin'),
+                      os.path.join(file_location, 'data', f'renamed_{index}.bin'))
+    return setup, mutate
+
+
+# 场景名称: 场景生成函数
+all_scenarios = {
+    'tiny_files': build_tiny_files,
+    'huge_files': build_huge_files,
+    'appended_logs': build_appended_logs,
+    'renames': build_renames,
+}
+
+
+def run_sync_node(node_directory, local_host_ip, other_host_ip, settings):
+    """
+    在子进程中启动一个SocketFileSync节点
+    :param node_directory: 节点的工作目录，文件存放在该目录下的 Socket_Files 中
+    :param local_host_ip: 节点的IP
+    :param other_host_ip: 其他节点的IP
+    :param settings: 节点的时间配置
+    :return:
+    """
+    logger.setLevel(logging.WARNING)  # 只打印错误信息
+    os.chdir(node_directory)
+    file_sync = SocketFileSync(local_host_ip=local_host_ip, other_host_ip=other_host_ip)
+    file_sync.waiting_time = settings['waiting_time']
+    file_sync.automatic_sync_time = settings['automatic_sync_time']
+    file_sync.stable_quiet_time = settings['stable_quiet_time']
+    file_sync.multicast_group = settings['multicast_group'] or None
+    file_sync.main()
+
+
+def get_directory_manifest(file_location, with_md5=False):
+    """
+    读取目录下所有文件的相对路径和大小，with_md5为True时同时读取md5
+    :return: dict
+    """
+    manifest = {}
+    for root, dirs, files in os.walk(file_location):
+        for each_file in files:
+            if each_file.endswith(('.sync_tmp', '.repair_tmp')):
+                continue
+            file_name = os.path.join(root, each_file)
+            relative_path = os.path.relpath(file_name, file_location)
+            if with_md5:
+                manifest[relative_path] = SocketFileSync.get_file_md5(file_name=file_name)
+            else:
+                manifest[relative_path] = os.path.getsize(file_name)
+    return manifest
+
+
+def wait_convergence(file_locations, timeout):
+    """
+    等待所有节点的文件列表一致：先比较文件大小，大小一致后再比较md5
+    :return: 同步完成所需的时间，超时返回None
+    """
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        manifests = [get_directory_manifest(file_location) for file_location in file_locations]
+        if all(manifest == manifests[0] for manifest in manifests[1:]):
+            manifests = [get_directory_manifest(file_location, with_md5=True) for file_location in file_locations]
+            if all(manifest == manifests[0] for manifest in manifests[1:]):
+                return time.time() - start_time
+        time.sleep(0.2)
+    return None
+
+
+def read_process_usage(pid):
+    """
+    从/proc读取进程的CPU时间和最大内存占用
+    :param pid: 进程ID
+    :return: (cpu seconds, peak rss bytes)
+    """
+    with open(f'/proc/{pid}/stat') as rf:
+        fields = rf.read().rsplit(')', 1)[-1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+
+    peak_rss = 0
+    with open(f'/proc/{pid}/status') as rf:
+        for line in rf:
+            if line.startswith('VmHWM:'):
+                peak_rss = int(line.split()[1]) * 1024
+    return cpu_seconds, peak_rss
+
+
+def run_scenario(index, name, options, work_directory):
+    """
+    运行一个测试场景
+    :param index: 场景序号，每个场景使用不同的 127.x.0.0/24 地址段，避免端口处于TIME_WAIT
+    :param name: 场景名称
+    :param options: 命令行参数
+    :param work_directory: 工作目录
+    :return: 测试结果
+    """
+    setup, mutate = all_scenarios[name](options)
+    settings = {
+        'waiting_time': options.waiting_time,
+        'automatic_sync_time': options.sync_time,
+        'stable_quiet_time': options.quiet_time,
+        'multicast_group': options.multicast_group,
+    }
+
+    node_directories = []
+    node_ips = []
+    for node in range(options.nodes):
+        node_directory = os.path.join(work_directory, name, f'node_{node}')
+        os.makedirs(os.path.join(node_directory, 'Socket_Files'), exist_ok=True)
+        if setup:
+            setup(os.path.join(node_directory, 'Socket_Files'))
+            if node:  # 所有节点使用相同的初始文件
+                shutil.rmtree(os.path.join(node_directory, 'Socket_Files'))
+                shutil.copytree(os.path.join(node_directories[0], 'Socket_Files'),
+                                os.path.join(node_directory, 'Socket_Files'))
+        node_directories.append(node_directory)
+        node_ips.append(f'127.{index + 1}.0.{node + 1}')
+    file_locations = [os.path.join(node_directory, 'Socket_Files') for node_directory in node_directories]
+    before_manifest = get_directory_manifest(file_locations[0])
+
+    # 使用spawn启动节点，每个节点都是独立的Python进程
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for node, node_directory in enumerate(node_directories):
+        other_host_ip = [ip for ip in node_ips if ip != node_ips[node]]
+        process = context.Process(target=run_sync_node, args=(node_directory, node_ips[node], other_host_ip, settings))
+        process.start()
+        processes.append(process)
+
+    try:
+        time.sleep(1)  # 等待所有服务端开始监听
+        start_time = time.time()
+        mutate(file_locations[0])
+        mutate_time = time.time() - start_time
+        convergence_time = wait_convergence(file_locations, options.timeout)
+        usage = [read_process_usage(process.pid) for process in processes]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+    # 第一个节点新增或修改的文件需要完整传输到其他所有节点（估算值，不包含重传）
+    after_manifest = get_directory_manifest(file_locations[0])
+    changed_files = [size for file, size in after_manifest.items() if before_manifest.get(file) != size]
+    transferred_bytes = sum(changed_files) * (options.nodes - 1)
+    elapsed_time = convergence_time + mutate_time if convergence_time is not None else None
+    return {
+        'name': name,
+        'converged': convergence_time is not None,
+        'convergence_seconds': elapsed_time,
+        'changed_files': len(changed_files),
+        'transferred_bytes': transferred_bytes,
+        'throughput_bytes_per_second': transferred_bytes / elapsed_time if elapsed_time else None,
+        'cpu_seconds': sum(cpu for cpu, _ in usage),
+        'cpu_seconds_per_node': [cpu for cpu, _ in usage],
+        'peak_rss_bytes': max(rss for _, rss in usage),
+        'peak_rss_bytes_per_node': [rss for _, rss in usage],
+    }
+
+
+def read_cached_bytes():
+    """
+    从/proc/meminfo读取系统页缓存的大小
+    :return: bytes
+    """
+    with open('/proc/meminfo') as rf:
+        for line in rf:
+            if line.startswith('Cached:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def hash_with_plain_read(file_name):
+    """
+    对照组：普通分片读取计算md5，不提示内核，读取的数据留在页缓存中
+    :return: 16 bytes md5 digest
+    """
+    file_check = hashlib.md5()
+    with open(file_name, 'rb') as rf:
+        while True:
+            data = rf.read(1048576)
+            if not data:
+                break
+            file_check.update(data)
+    return file_check.digest()
+
+
+def run_io_benchmark(options, work_directory):
+    """
+    读盘测试：每种方式读取前先丢弃测试文件的页缓存，统计计算md5的耗时、CPU时间和读取后页缓存的增长
+    :param options: 命令行参数
+    :param work_directory: 工作目录
+    :return: 测试结果
+    """
+    file_name = os.path.join(work_directory, 'io_benchmark.bin')
+    write_random_file(file_name, options.io_size_mb * 1048576)
+    with open(file_name, 'rb') as rf:
+        os.fsync(rf.fileno())  # 脏页写回磁盘后才能被丢弃
+    methods = {
+        'plain_read': hash_with_plain_read,
+        'fadvise_read': PageCacheReader(use_mmap=False).get_digest,
+        'fadvise_mmap': PageCacheReader(mmap_threshold=1).get_digest,
+    }
+
+    results = []
+    expected_digest = None
+    for name, get_digest in methods.items():
+        with open(file_name, 'rb') as rf:
+            PageCacheReader.advise(rf, 0, 0, 'POSIX_FADV_DONTNEED')
+        cached_before = read_cached_bytes()
+        start_time, start_cpu = time.time(), time.process_time()
+        digest = get_digest(file_name)
+        elapsed_time, cpu_seconds = time.time() - start_time, time.process_time() - start_cpu
+        expected_digest = expected_digest or digest
+        assert digest == expected_digest, f'{name} 计算的md5不一致'
+        results.append({
+            'name': name,
+            'seconds': elapsed_time,
+            'throughput_bytes_per_second': os.path.getsize(file_name) / max(elapsed_time, 1e-6),
+            'cpu_seconds': cpu_seconds,
+            'page_cache_growth_bytes': max(read_cached_bytes() - cached_before, 0),
+        })
+    os.remove(file_name)
+    return results
+
+
+def read_git_commit():
+    """
+    读取当前代码的git提交，用于对比不同提交的测试结果
+    :return: commit id or ''
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ''
+
+
+def compare_results(results, previous_file):
+    """
+    打印本次测试结果和上一次测试结果的对比
+    :param results: 本次测试结果
+    :param previous_file: 上一次的测试结果JSON文件
+    :return:
+    """
+    with open(previous_file, 'r', encoding='utf-8') as rf:
+        previous = json.load(rf)
+    previous_scenarios = {scenario['name']: scenario for scenario in previous['scenarios']}
+
+    previous_io = {method['name']: method for method in previous.get('io', [])}
+
+    print(f"对比提交：{previous.get('commit', '')[:10]} -> {results['commit'][:10]}")
+    for scenario in results['scenarios']:
+        before = previous_scenarios.get(scenario['name'])
+        if not before:
+            continue
+        for key in ['convergence_seconds', 'throughput_bytes_per_second', 'cpu_seconds', 'peak_rss_bytes']:
+            if before[key] and scenario[key]:
+                print(f"{scenario['name']:<15} {key:<30} {before[key]:>16.2f} -> {scenario[key]:>16.2f}"
+                      f" ({scenario[key] / before[key] - 1:+.1%})")
+    for method in results['io']:
+        before = previous_io.get(method['name'])
+        if not before:
+            continue
+        for key in ['throughput_bytes_per_second', 'cpu_seconds', 'page_cache_growth_bytes']:
+            if before[key] and method[key]:
+                print(f"{method['name']:<15} {key:<30} {before[key]:>16.2f} -> {method[key]:>16.2f}"
+                      f" ({method[key] / before[key] - 1:+.1%})")
+
+
+def main():
+    options = parser.parse_args()
+    assert sys.platform.startswith('linux'), '只支持在Linux上运行'
+    assert options.nodes >= 2, '至少需要2个节点'
+
+    scenario_names = options.scenarios.split(',') if options.scenarios else list(all_scenarios)
+    if options.scenarios == 'none':  # 只运行读盘测试
+        scenario_names = []
+    for name in scenario_names:
+        if name not in all_scenarios:
+            raise ValueError(f'没有这个场景：{name}，可选场景：{list(all_scenarios)}')
+
+    work_directory = options.work_dir or tempfile.mkdtemp(prefix='file_sync_benchmark_')
+    results = {
+        'commit': read_git_commit(),
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'nodes': options.nodes,
+        'settings': {
+            'waiting_time': options.waiting_time,
+            'automatic_sync_time': options.sync_time,
+            'stable_quiet_time': options.quiet_time,
+            'multicast_group': options.multicast_group,
+            'tiny_count': options.tiny_count,
+            'huge_size_mb': options.huge_size_mb,
+            'io_size_mb': options.io_size_mb,
+        },
+        'scenarios': [],
+        'io': [],
+    }
+    try:
+        for index, name in enumerate(scenario_names):
+            print(f'开始运行场景：{name}')
+            result = run_scenario(index, name, options, work_directory)
+            print(json.dumps(result, ensure_ascii=False, indent=2))
+            results['scenarios'].append(result)
+
+        if options.io_size_mb:
+            print('开始运行读盘测试')
+            results['io'] = run_io_benchmark(options, work_directory)
+            print(json.dumps(results['io'], ensure_ascii=False, indent=2))
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    if options.compare:
+        compare_results(results, options.compare)
+
+    with open(options.output, 'w', encoding='utf-8') as wf:
+        wf.write(json.dumps(results, ensure_ascii=False, indent=2) + '\n')
+    print(f'测试结果已保存到：{options.output}')
+
+
+if __name__ == '__main__':
+    main()
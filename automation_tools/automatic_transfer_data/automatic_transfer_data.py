@@ -3,10 +3,31 @@ The file is located on a Windows central control machine at BPM2 automation stat
 Use RPC to implement program calls and data interactions between different systems
 
 =====================================================
-This program will start three multi-threads:
-1. Start an rpc-socket service that listens for all incoming data from the Apollo server
-2. Open the local access data table to read each row of data and transfer it to the corresponding Apollo server
+This program will start four multi-threads:
+1. Start an rpc-socket service that listens for all incoming data from the Apollo server,
+   calls are handled by a bounded worker pool over HTTP/1.1 keep-alive connections and support system.multicall
+2. Open the local access data table to read each row of data and transfer it to the corresponding Apollo server,
+   the rows are recorded in a write-ahead journal before they are deleted from the table,
+   then transferred and recorded into the history by their own workers, pending rows are resumed after a restart
+   The table is only read when a cheap COUNT/MAX probe of it changes, or at least every scan_full_read_interval
+   The history is an append-only JSON lines store, one segment per day, closed segments are compressed
+   and indexed by machine and cell
 3. Update the received Apollo server data into the access data table
+4. Update the test status received by RPC into the access data table, the status is queued in memory
+   and recorded in a write-ahead journal, status files dropped into apollo_test_status are still handled by thread 3
+Threads 2, 3 and 4 share a small pool of Access connections instead of connecting on every poll,
+the table is reached through a pluggable backend: Access by ODBC (default) or SQLite to run the pipeline on Linux
+Thread 2 dispatches the rows to per-machine queues, rows of one machine are transferred in order,
+different machines are transferred concurrently by a bounded number of workers,
+a window of 0 (default) sends each row as cpp_automated_data.json, with a transfer_batch_window the rows of one
+machine arriving within it are sent as one payload file with a unique name and a manifest,
+the payload files older than payload_retention are removed from the Apollo server by the transfer backend
+Thread 3 is woken up by inotify (Linux) or polls the directory, a burst of test status files is one commit
+Each scan row gets a trace id which is carried in the json payload, the timings of its stages
+(queue, transfer, history, Apollo test, status update) are logged by the automatic_transfer_data.trace logger
+and summarized by the get_latency_summary RPC
+Files are transferred by a pluggable backend: pscp (default), persistent SFTP sessions (needs paramiko)
+or XML-RPC to an ApolloFileAgent running on the Apollo server
 =====================================================
 """
 # -*- coding:utf-8 -*-
@@ -15,106 +36,1527 @@ This program will start three multi-threads:
 # @Python   : 3.7
 # @System   : Windows <==> Linux
 
-import pyodbc
 import time
 import logging
 import os
 import json
 import re
+import sys
+import ctypes
+import select
+import selectors
+import socket
+import struct
 import threading
 import shutil
-from xmlrpc.server import SimpleXMLRPCServer
+import subprocess
+import queue
+import copy
+import itertools
+import math
+import uuid
+import zlib
+import lzma
+import sqlite3
+import xmlrpc.client
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+try:
+    import pyodbc
+except ImportError:  # Only needed by AccessTableBackend
+    pyodbc = None
+try:
+    import paramiko
+except ImportError:  # Only needed by SftpTransferBackend
+    paramiko = None
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger(__name__ + '.trace')
+
+
+class AccessConnectionPool(object):
+
+    def __init__(self, connection_string, max_size=2, health_check_interval=30):
+        """
+        Thread-safe pool of Access connections shared by the polling threads
+        :param str connection_string: Fill in the ODBC connection string
+        :param int max_size: Maximum number of open connections
+        :param int health_check_interval: Idle seconds after which a connection is checked before reuse
+        """
+        self.connection_string = connection_string
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.idle_connections = []  # [(connection, last used time)]
+        self.open_number = 0
+        self.condition = threading.Condition()
+
+    def create_connection(self):
+        """
+        Open a new Access connection
+        :return: pyodbc connection
+        """
+        cnxn = pyodbc.connect(self.connection_string)
+        logger.debug('Open a new access connection, {} connections are open'.format(self.open_number))
+        return cnxn
+
+    @staticmethod
+    def check_health(cnxn):
+        """
+        Check that the connection still works by listing the tables
+        :param cnxn: pyodbc connection
+        :return: True or False
+        """
+        try:
+            crsr = cnxn.cursor()
+            try:
+                crsr.tables(tableType='TABLE').fetchone()
+            finally:
+                crsr.close()
+            return True
+        except pyodbc.Error as ex:
+            logger.warning('Access connection health check failed, reconnect: {}'.format(ex))
+            return False
+
+    @staticmethod
+    def close_connection(cnxn):
+        try:
+            cnxn.close()
+        except pyodbc.Error:
+            pass
+
+    def acquire(self):
+        """
+        Take an idle connection from the pool, or open a new one while the pool is not full
+        :return: pyodbc connection
+        """
+        with self.condition:
+            while not self.idle_connections and self.open_number >= self.max_size:
+                self.condition.wait()
+            if self.idle_connections:
+                cnxn, last_used_time = self.idle_connections.pop()
+            else:
+                cnxn, last_used_time = None, None
+                self.open_number += 1
+
+        try:
+            if cnxn is not None and time.time() - last_used_time > self.health_check_interval \
+                    and not self.check_health(cnxn):
+                self.close_connection(cnxn)
+                cnxn = None
+            if cnxn is None:
+                cnxn = self.create_connection()
+        except Exception:
+            self.discard(None)
+            raise
+        return cnxn
+
+    def release(self, cnxn):
+        """
+        Return a connection to the pool
+        :param cnxn: pyodbc connection
+        :return:
+        """
+        with self.condition:
+            self.idle_connections.append((cnxn, time.time()))
+            self.condition.notify()
+
+    def discard(self, cnxn):
+        """
+        Close a broken connection, the next acquire opens a new one
+        :param cnxn: pyodbc connection or None
+        :return:
+        """
+        if cnxn is not None:
+            self.close_connection(cnxn)
+        with self.condition:
+            self.open_number -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection, uncommitted changes are rolled back and broken connections are dropped
+        :return: pyodbc connection
+        """
+        cnxn = self.acquire()
+        try:
+            yield cnxn
+        except pyodbc.Error:
+            self.discard(cnxn)
+            raise
+        except Exception:
+            try:
+                cnxn.rollback()
+            except pyodbc.Error:
+                self.discard(cnxn)
+                raise
+            self.release(cnxn)
+            raise
+        else:
+            self.release(cnxn)
+
+    def close_all(self):
+        """
+        Close all idle connections
+        :return:
+        """
+        with self.condition:
+            idle_connections, self.idle_connections = self.idle_connections, []
+            self.open_number -= len(idle_connections)
+        for cnxn, _ in idle_connections:
+            self.close_connection(cnxn)
+
+
+class TableBackend(object):
+    """
+    Storage of the scan table and the link position table, the connections follow the DB-API with "?" parameters
+    """
+
+    def connection(self):
+        """
+        Context manager borrowing a connection, uncommitted changes are rolled back on error
+        :return: DB-API connection
+        """
+        raise NotImplementedError
+
+    def select_top_sql(self, number, table_name, condition):
+        """
+        SQL selecting at most number rows of a table
+        :param number: Maximum number of rows
+        :param table_name: Table name
+        :param condition: WHERE condition
+        :return: SQL
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class AccessTableBackend(TableBackend):
+
+    def __init__(self, access_table_path, max_size=2):
+        """
+        Microsoft Access table through pyodbc and a connection pool
+        :param access_table_path: Fill in the access table path
+        :param max_size: Maximum number of open connections
+        """
+        if pyodbc is None:
+            raise ImportError('pyodbc is required by the Access table backend')
+        self.connection_pool = AccessConnectionPool(
+            r'DRIVER={Microsoft Access Driver (*.mdb)};DBQ=%s' % (access_table_path,), max_size=max_size)
+
+    def connection(self):
+        return self.connection_pool.connection()
+
+    def select_top_sql(self, number, table_name, condition):
+        return 'SELECT TOP {} * FROM {} WHERE {}'.format(number, table_name, condition)
+
+    def close(self):
+        self.connection_pool.close_all()
+
+
+class SqliteTableBackend(TableBackend):
+
+    def __init__(self, database_path, timeout=30):
+        """
+        SQLite database with the same tables, to run and measure the pipeline without Access,
+        each thread uses its own connection
+        :param database_path: SQLite database file path
+        :param timeout: Seconds to wait for a lock of another connection
+        """
+        self.database_path = database_path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        cnxn = getattr(self.local, 'cnxn', None)
+        if cnxn is None:
+            cnxn = self.local.cnxn = sqlite3.connect(self.database_path, timeout=self.timeout,
+                                                     check_same_thread=False)
+            with self.lock:
+                self.connections.append(cnxn)
+        try:
+            yield cnxn
+        except Exception:
+            cnxn.rollback()
+            raise
+
+    def select_top_sql(self, number, table_name, condition):
+        return 'SELECT * FROM {} WHERE {} LIMIT {}'.format(table_name, condition, number)
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for cnxn in connections:
+            cnxn.close()
+
+
+class MachineDispatcher(object):
+
+    def __init__(self, handler, max_workers=8, batch_size=1, batch_window=0):
+        """
+        Dispatch data to per-machine queues, the data of one machine is handled in order
+        and different machines are handled concurrently by at most max_workers threads
+        :param handler: Function called with a list of up to batch_size data of one machine
+        :param int max_workers: Maximum number of machines handled at the same time
+        :param int batch_size: Maximum number of data of one machine handled together
+        :param float batch_window: Seconds a machine waits after its first data, so the following ones join its batch
+        """
+        self.handler = handler
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.machine_queues = {}  # {machine: deque of pending data}
+        self.ready_machines = deque()  # (machine, ready time) of the machines with pending data no worker is handling
+        self.condition = threading.Condition()
+        self.pending_number = 0
+        for _ in range(max_workers):
+            threading.Thread(target=self.start_worker, daemon=True).start()
+
+    def submit(self, machine, data):
+        """
+        Add the data to the queue of its machine
+        :param machine: Machine name
+        :param data: Data passed to the handler
+        :return:
+        """
+        with self.condition:
+            machine_queue = self.machine_queues.get(machine)
+            if machine_queue is None:
+                # A machine without a queue is neither pending nor handled, make it ready
+                machine_queue = self.machine_queues[machine] = deque()
+                self.ready_machines.append((machine, time.time() + self.batch_window))
+            machine_queue.append(data)
+            self.pending_number += 1
+            self.condition.notify_all()
+
+    def wait_pending_below(self, limit):
+        """
+        Block until fewer than limit data are pending
+        :param limit: Maximum number of pending data
+        :return:
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending_number < limit)
+
+    def take_ready_machine(self):
+        """
+        Remove and return the first machine whose batch window is over, called with self.condition held
+        :return: Machine name, or the seconds to wait for the next ready machine (None if there is none)
+        """
+        now = time.time()
+        for index, (machine, ready_time) in enumerate(self.ready_machines):
+            if ready_time <= now:
+                del self.ready_machines[index]
+                return machine, None
+        if self.ready_machines:
+            return None, min(ready_time for _, ready_time in self.ready_machines) - now
+        return None, None
+
+    def start_worker(self):
+        """
+        Take the next ready machine, handle a batch of its data and put it back at the end of the ready machines,
+        so busy machines do not starve the others
+        :return:
+        """
+        while True:
+            with self.condition:
+                while True:
+                    machine, timeout = self.take_ready_machine()
+                    if machine is not None:
+                        break
+                    self.condition.wait(timeout)
+                machine_queue = self.machine_queues[machine]
+                batch = [machine_queue.popleft() for _ in range(min(self.batch_size, len(machine_queue)))]
+
+            try:
+                self.handler(batch)
+            except Exception as ex:
+                logger.exception(ex)
+
+            with self.condition:
+                self.pending_number -= len(batch)
+                if self.machine_queues[machine]:
+                    # The data queued during the handling has already waited
+                    self.ready_machines.append((machine, time.time()))
+                else:
+                    del self.machine_queues[machine]
+                self.condition.notify_all()
+
+
+class StatusFileWatcher(object):
+    # inotify constants from <sys/inotify.h>
+    in_close_write = 0x00000008
+    in_moved_to = 0x00000080
+    in_q_overflow = 0x00004000
+    in_cloexec = 0o2000000
+    event_header = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self, directory, pattern, batch_window=0.2, poll_interval=1, rescan_interval=60):
+        """
+        Collect the new files of a directory, with inotify on Linux and by polling the directory elsewhere
+        :param directory: Directory to be watched, created if it does not exist
+        :param pattern: Regular expression of the file names to be collected
+        :param batch_window: Seconds to keep collecting after the first file, so a burst is returned together
+        :param poll_interval: Seconds between two directory listings without inotify
+        :param rescan_interval: Seconds between two full listings, the files left by a failure are collected again
+        """
+        self.directory = directory
+        self.pattern = re.compile(pattern)
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.pending_files = set()
+        self.listed_files = set()  # Matching files of the last directory listing
+        self.last_rescan_time = 0  # Rescan all files at the first call
+        os.makedirs(directory, exist_ok=True)
+        self.inotify_fd = self.setup_inotify()
+
+    def setup_inotify(self):
+        """
+        Create the inotify watch through libc, return None if inotify is not available
+        :return: inotify file descriptor or None
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(self.in_cloexec)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), self.in_close_write | self.in_moved_to) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        except (OSError, AttributeError) as ex:
+            logger.warning('inotify is not available, poll the directory {}: {}'.format(self.directory, ex))
+            return None
+        logger.debug('Watch the directory {} with inotify'.format(self.directory))
+        return fd
+
+    def request_rescan(self):
+        """
+        List the whole directory again at the next call
+        :return:
+        """
+        self.last_rescan_time = 0
+
+    def rescan(self, only_new=False):
+        """
+        List the directory and collect the matching files
+        :param only_new: Only collect the files which were not in the last listing
+        :return:
+        """
+        files = set(file for file in os.listdir(self.directory) if self.pattern.match(file))
+        self.pending_files.update(files - self.listed_files if only_new else files)
+        self.listed_files = files
+        if not only_new:
+            self.last_rescan_time = time.time()
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds for inotify events and collect the matching file names
+        :return:
+        """
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        data = os.read(self.inotify_fd, 65536)
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            file = data[offset:offset + name_length].rstrip(b'\0').decode(errors='replace')
+            offset += name_length
+            if mask & self.in_q_overflow:  # Events have been lost
+                self.request_rescan()
+            elif self.pattern.match(file):
+                self.pending_files.add(file)
+
+    def wait_files(self, timeout=1):
+        """
+        Wait for new files, once a file arrives keep collecting for self.batch_window seconds
+        :param timeout: Maximum seconds to wait for the first file
+        :return: List of the collected file names, may be empty
+        """
+        if time.time() - self.last_rescan_time >= self.rescan_interval:
+            self.rescan()
+        if self.inotify_fd is None:
+            if not self.pending_files:
+                time.sleep(self.poll_interval)
+                self.rescan(only_new=True)
+        elif not self.pending_files:
+            self.read_events(timeout)
+
+        if self.pending_files:
+            deadline = time.time() + self.batch_window
+            while time.time() < deadline:
+                if self.inotify_fd is None:
+                    time.sleep(max(deadline - time.time(), 0))
+                    self.rescan(only_new=True)
+                else:
+                    self.read_events(max(deadline - time.time(), 0))
+
+        files = sorted(self.pending_files)
+        self.pending_files.clear()
+        return files
+
+
+class WriteAheadJournal(object):
+
+    def __init__(self, path, compact_threshold=1000):
+        """
+        Append-only JSON lines journal of the records which are not processed yet,
+        a record is added before it is processed and marked done afterwards,
+        after a crash replay returns the records which were never marked done
+        :param path: Journal file path
+        :param compact_threshold: Number of done records after which the journal is rewritten with the pending ones
+        """
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.pending_records = {}  # {record id: record}
+        self.last_id = 0
+        self.synced_id = 0  # All the records up to this id are on the disk
+        self.done_number = 0  # Number of done records since the last compaction
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.load()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def load(self):
+        """
+        Read the existing journal into self.pending_records
+        :return:
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as rf:
+            for line in rf:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # The last line may be incomplete after a crash
+                    continue
+                if 'done' in entry:
+                    for record_id in entry['done']:
+                        self.pending_records.pop(record_id, None)
+                else:
+                    self.pending_records[entry['id']] = entry['record']
+                    self.last_id = max(self.last_id, entry['id'])
+        self.synced_id = self.last_id
+
+    def replay(self):
+        """
+        Records added but not marked done, in the order they were added
+        :return: List of (record id, record)
+        """
+        with self.lock:
+            return sorted(self.pending_records.items())
+
+    def append(self, record):
+        """
+        Add a record, it is on the disk when this returns,
+        concurrent appends share one fsync
+        :param record: JSON serializable record
+        :return: Record id
+        """
+        return self.append_many([record])[0]
+
+    def append_many(self, records):
+        """
+        Add several records with one fsync
+        :param records: JSON serializable records
+        :return: List of record ids
+        """
+        with self.lock:
+            record_ids = []
+            for record in records:
+                self.last_id += 1
+                self.file.write(json.dumps({'id': self.last_id, 'record': record}, ensure_ascii=False) + '\n')
+                self.pending_records[self.last_id] = record
+                record_ids.append(self.last_id)
+            self.file.flush()
+        with self.sync_lock:
+            if record_ids and self.synced_id < record_ids[-1]:
+                with self.lock:
+                    last_id = self.last_id
+                os.fsync(self.file.fileno())
+                self.synced_id = last_id
+        return record_ids
+
+    def mark_done(self, record_ids):
+        """
+        Mark records done, not synced to the disk: a lost mark only replays a record which was already processed
+        :param record_ids: Record ids
+        :return:
+        """
+        if not record_ids:
+            return
+        with self.lock:
+            self.file.write(json.dumps({'done': list(record_ids)}) + '\n')
+            self.file.flush()
+            for record_id in record_ids:
+                self.pending_records.pop(record_id, None)
+            self.done_number += len(record_ids)
+            if self.done_number < self.compact_threshold:
+                return
+        self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the pending records
+        :return:
+        """
+        with self.sync_lock, self.lock:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as wf:
+                for record_id, record in sorted(self.pending_records.items()):
+                    wf.write(json.dumps({'id': record_id, 'record': record}, ensure_ascii=False) + '\n')
+                wf.flush()
+                os.fsync(wf.fileno())
+            self.file.close()
+            os.replace(self.path + '.tmp', self.path)
+            self.file = open(self.path, 'a', encoding='utf-8')
+            self.synced_id = self.last_id
+            self.done_number = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class CppDataHistoryStore(object):
+    segment_prefix = 'history-'
+    compressed_suffixes = {'zlib': '.jsonl.zz', 'lzma': '.jsonl.xz', None: '.jsonl'}
+
+    def __init__(self, directory, rotation_interval=86400, compression='zlib'):
+        """
+        Append-only history of records, stored in JSON lines segments which are rotated every rotation_interval
+        seconds, a closed segment is compressed and gets an index file with its time range, machines and cells
+        :param directory: Directory of the segments
+        :param rotation_interval: Seconds covered by one segment, aligned to the local midnight for one day
+        :param compression: 'zlib', 'lzma' or None
+        """
+        if compression not in self.compressed_suffixes:
+            raise ValueError('Unknown history compression: {}'.format(compression))
+        self.directory = directory
+        self.rotation_interval = rotation_interval
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.active_file = None
+        self.active_start = None
+        self.active_index = None
+        os.makedirs(directory, exist_ok=True)
+        self.close_old_segments()
+        # Continue the segment of the current period written before a restart, so its records are queried at once
+        segment_start = self.get_segment_start(time.time())
+        name = self.get_segment_name(segment_start)
+        if os.path.exists(os.path.join(directory, name + '.jsonl')) \
+                and not os.path.exists(os.path.join(directory, name + '.index.json')):
+            self.open_active_segment(segment_start)
+
+    def get_segment_start(self, timestamp):
+        return int((timestamp - time.timezone) // self.rotation_interval * self.rotation_interval + time.timezone)
+
+    def get_segment_name(self, segment_start):
+        return self.segment_prefix + time.strftime('%Y%m%d-%H%M%S', time.localtime(segment_start))
+
+    @staticmethod
+    def new_index(segment_start, segment_end):
+        return {'start': segment_start, 'end': segment_end, 'count': 0, 'machines': {}}  # {machine: {cell: count}}
+
+    @staticmethod
+    def add_to_index(index, record):
+        cells = index['machines'].setdefault(str(record['data'].get('machine')), {})
+        cell = str(record['data'].get('cell'))
+        cells[cell] = cells.get(cell, 0) + 1
+        index['count'] += 1
+
+    def append(self, data, timestamp=None):
+        """
+        Append a record to the active segment, rotate the segment first if its time is over
+        :param data: JSON serializable dict with machine and cell
+        :param timestamp: Record time, default now
+        :return:
+        """
+        timestamp = timestamp or time.time()
+        record = {'time': timestamp, 'data': data}
+        with self.lock:
+            segment_start = self.get_segment_start(timestamp)
+            if self.active_start != segment_start:
+                self.close_active_segment()
+                self.open_active_segment(segment_start)
+            self.active_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.active_file.flush()
+            self.add_to_index(self.active_index, record)
+
+    def open_active_segment(self, segment_start):
+        path = os.path.join(self.directory, self.get_segment_name(segment_start) + '.jsonl')
+        self.active_index = self.new_index(segment_start, segment_start + self.rotation_interval)
+        # Continue a segment of the same period written before a restart
+        for record in self.read_segment(path):
+            self.add_to_index(self.active_index, record)
+        self.active_file = open(path, 'a', encoding='utf-8')
+        self.active_start = segment_start
+
+    def close_active_segment(self):
+        if self.active_file is None:
+            return
+        path = self.active_file.name
+        self.active_file.close()
+        self.active_file = None
+        self.active_start = None
+        self.close_segment(path)
+
+    def close_segment(self, path, index=None):
+        """
+        Compress a finished segment and write its index
+        :param path: Uncompressed segment path
+        :param index: Index of the segment, built by reading the segment if None
+        :return:
+        """
+        name = os.path.basename(path)[:-len('.jsonl')]
+        if index is None:
+            segment_start = time.mktime(time.strptime(name[len(self.segment_prefix):], '%Y%m%d-%H%M%S'))
+            index = self.new_index(int(segment_start), int(segment_start) + self.rotation_interval)
+            for record in self.read_segment(path):
+                self.add_to_index(index, record)
+        compressed_path = os.path.join(self.directory, name + self.compressed_suffixes[self.compression])
+        if compressed_path != path:
+            with open(path, 'rb') as rf:
+                with self.open_compressed(compressed_path + '.tmp', 'wb') as wf:
+                    shutil.copyfileobj(rf, wf, 1048576)
+            os.replace(compressed_path + '.tmp', compressed_path)
+        index['segment'] = os.path.basename(compressed_path)
+        with open(os.path.join(self.directory, name + '.index.json'), 'w', encoding='utf-8') as wf:
+            json.dump(index, wf, ensure_ascii=False)
+        if compressed_path != path:
+            os.remove(path)
+        logger.debug('Close the history segment {} ({} records)'.format(compressed_path, index['count']))
+
+    def close_old_segments(self):
+        """
+        Close the uncompressed segments of the past periods, left by a stop before the rotation
+        :return:
+        """
+        current_name = self.get_segment_name(self.get_segment_start(time.time())) + '.jsonl'
+        for file in sorted(os.listdir(self.directory)):
+            if file.startswith(self.segment_prefix) and file.endswith('.jsonl') and file != current_name \
+                    and not os.path.exists(os.path.join(self.directory, file[:-len('.jsonl')] + '.index.json')):
+                self.close_segment(os.path.join(self.directory, file))
+
+    @staticmethod
+    def open_compressed(path, mode):
+        if path.endswith('.zz') or path.endswith('.zz.tmp'):
+            return ZlibFile(path, mode)
+        if path.endswith('.xz') or path.endswith('.xz.tmp'):
+            return lzma.open(path, mode)
+        return open(path, mode)
+
+    def read_segment(self, path):
+        """
+        Read the records of a segment, an incomplete last line is skipped
+        :param path: Segment path, compressed or not
+        :return: Generator of records
+        """
+        if not os.path.exists(path):
+            return
+        with self.open_compressed(path, 'rb') as rf:
+            for line in rf:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def query(self, machine=None, cell=None, start_time=None, end_time=None):
+        """
+        Find the records of a machine and cell in a time range, only the segments
+        whose index matches are read
+        :param machine: Machine name, None for all
+        :param cell: Cell, None for all
+        :param start_time: Start timestamp, None for no limit
+        :param end_time: End timestamp, None for no limit
+        :return: List of {'time', 'data'} in time order
+        """
+        with self.lock:
+            if self.active_file is not None:
+                self.active_file.flush()
+            segments = []
+            for file in sorted(os.listdir(self.directory)):
+                if file.startswith(self.segment_prefix) and file.endswith('.index.json'):
+                    with open(os.path.join(self.directory, file), encoding='utf-8') as rf:
+                        index = json.load(rf)
+                    segments.append((os.path.join(self.directory, index['segment']), index))
+            if self.active_file is not None:
+                segments.append((self.active_file.name, copy.deepcopy(self.active_index)))
+
+        result = []
+        for path, index in segments:
+            if start_time is not None and index['end'] <= start_time \
+                    or end_time is not None and index['start'] > end_time:
+                continue
+            if machine is not None:
+                cells = index['machines'].get(str(machine))
+                if cells is None or cell is not None and str(cell) not in cells:
+                    continue
+            elif cell is not None and not any(str(cell) in cells for cells in index['machines'].values()):
+                continue
+            for record in self.read_segment(path):
+                data = record['data']
+                if machine is not None and str(data.get('machine')) != str(machine) \
+                        or cell is not None and str(data.get('cell')) != str(cell) \
+                        or start_time is not None and record['time'] < start_time \
+                        or end_time is not None and record['time'] > end_time:
+                    continue
+                result.append(record)
+        return result
+
+    def close(self):
+        with self.lock:
+            if self.active_file is not None:
+                self.active_file.close()
+                self.active_file = None
+                self.active_start = None
+
+
+class ZlibFile(object):
+
+    def __init__(self, path, mode):
+        """
+        Minimal binary file object for zlib streams, read by lines or written in chunks
+        :param path: File path
+        :param mode: 'rb' or 'wb'
+        """
+        self.file = open(path, mode)
+        self.mode = mode
+        self.compressor = zlib.compressobj(9) if 'w' in mode else None
+
+    def write(self, data):
+        self.file.write(self.compressor.compress(data))
+        return len(data)
+
+    def __iter__(self):
+        decompressor = zlib.decompressobj()
+        remain = b''
+        for chunk in iter(lambda: self.file.read(1048576), b''):
+            lines = (remain + decompressor.decompress(chunk)).split(b'\n')
+            remain = lines.pop()
+            for line in lines:
+                yield line
+        remain += decompressor.flush()
+        if remain:
+            yield remain
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TransferError(Exception):
+    pass
+
+
+class TransferBackend(object):
+    """
+    Interface of the file transfer to the Apollo servers,
+    transfer() is called by one thread per machine at a time and raises TransferError on failure
+    """
+
+    def transfer(self, remote_machine, local_file_path, target_path):
+        """
+        Transfer the local file into the target directory of the remote Apollo server
+        :param remote_machine: Fill in the remote apollo server name
+        :param local_file_path: Fill in the path of the local file to be transferred
+        :param target_path: Fill in the placement file path for the Apollo server
+        :return:
+        """
+        raise NotImplementedError
+
+    def remove_expired(self, remote_machine, target_path, prefix, max_age):
+        """
+        Remove the files of the target directory whose name starts with prefix and which are older than max_age,
+        the files are kept by a backend which can not list the remote directory
+        :param remote_machine: Fill in the remote apollo server name
+        :param target_path: Fill in the placement file path for the Apollo server
+        :param prefix: File name prefix, e.g. cpp_automated_data_
+        :param max_age: Age in seconds
+        :return:
+        """
+
+    def close(self):
+        """
+        Release the sessions kept by the backend
+        :return:
+        """
+
+
+class PscpTransferBackend(TransferBackend):
+
+    def __init__(self, account, password, timeout=60):
+        """
+        Transfer each file with a pscp process, the host key of a machine is accepted on its first transfer
+        :param account: Apollo server account
+        :param password: Apollo server password
+        :param timeout: Seconds before a pscp process is killed
+        """
+        self.account = account
+        self.password = password
+        self.timeout = timeout
+        self.known_machines = set()
+
+    def transfer(self, remote_machine, local_file_path, target_path):
+        command = ['pscp', '-pw', self.password, local_file_path,
+                   '{}@{}:{}'.format(self.account, remote_machine, target_path)]
+        # Answer "y" to the host key prompt of the first connection
+        answer = 'y\n' if remote_machine not in self.known_machines else ''
+        try:
+            result = subprocess.run(command, input=answer, capture_output=True, text=True, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as ex:
+            raise TransferError('pscp to ({}) failed: {}'.format(remote_machine, ex))
+        if result.returncode:
+            raise TransferError('pscp to ({}) failed with code {}: {}'
+                                .format(remote_machine, result.returncode, result.stderr.strip()))
+        self.known_machines.add(remote_machine)
+
+    def remove_expired(self, remote_machine, target_path, prefix, max_age):
+        # plink is installed together with pscp, the host key is already accepted by the transfers
+        command = ['plink', '-batch', '-pw', self.password, '{}@{}'.format(self.account, remote_machine),
+                   "find {} -maxdepth 1 -name '{}*' -mmin +{} -delete".format(target_path, prefix,
+                                                                             math.ceil(max_age / 60))]
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as ex:
+            raise TransferError('plink to ({}) failed: {}'.format(remote_machine, ex))
+        if result.returncode:
+            raise TransferError('plink to ({}) failed with code {}: {}'
+                                .format(remote_machine, result.returncode, result.stderr.strip()))
+
+
+class SftpTransferBackend(TransferBackend):
+
+    def __init__(self, account, password, port=22, timeout=30):
+        """
+        Keep one authenticated SFTP session per Apollo server and reuse it for every file
+        :param account: Apollo server account
+        :param password: Apollo server password
+        :param port: SSH port
+        :param timeout: Connection timeout in seconds
+        """
+        if paramiko is None:
+            raise ImportError('SftpTransferBackend requires paramiko, please install it with: pip install paramiko')
+        self.account = account
+        self.password = password
+        self.port = port
+        self.timeout = timeout
+        self.sessions = {}  # {machine: (ssh client, sftp client)}
+        self.lock = threading.Lock()
+
+    def open_session(self, remote_machine):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(remote_machine, port=self.port, username=self.account, password=self.password,
+                    timeout=self.timeout)
+        logger.debug('Open the sftp session to apollo server ({})'.format(remote_machine))
+        return ssh, ssh.open_sftp()
+
+    def close_session(self, remote_machine):
+        with self.lock:
+            session = self.sessions.pop(remote_machine, None)
+        if session:
+            ssh, sftp = session
+            sftp.close()
+            ssh.close()
+
+    def transfer(self, remote_machine, local_file_path, target_path):
+        remote_file_path = target_path.rstrip('/') + '/' + os.path.basename(local_file_path)
+        # Retry once with a new session if the kept session has been closed by the server
+        for retry in range(2):
+            try:
+                with self.lock:
+                    session = self.sessions.get(remote_machine)
+                if not session:
+                    session = self.open_session(remote_machine)
+                    with self.lock:
+                        self.sessions[remote_machine] = session
+                session[1].put(local_file_path, remote_file_path)
+                return
+            except Exception as ex:
+                self.close_session(remote_machine)
+                if retry:
+                    raise TransferError('sftp to ({}) failed: {}'.format(remote_machine, ex))
+
+    def remove_expired(self, remote_machine, target_path, prefix, max_age):
+        with self.lock:
+            session = self.sessions.get(remote_machine)
+        if not session:  # Only called after a transfer, the session is opened again by the next one
+            return
+        try:
+            expired_time = time.time() - max_age
+            for attributes in session[1].listdir_attr(target_path):
+                if attributes.filename.startswith(prefix) and attributes.st_mtime < expired_time:
+                    session[1].remove(target_path.rstrip('/') + '/' + attributes.filename)
+        except Exception as ex:
+            self.close_session(remote_machine)
+            raise TransferError('sftp cleanup of ({}) failed: {}'.format(remote_machine, ex))
+
+    def close(self):
+        for remote_machine in list(self.sessions):
+            self.close_session(remote_machine)
+
+
+class TimeoutTransport(xmlrpc.client.Transport):
+
+    def __init__(self, timeout):
+        """
+        XML-RPC transport with a socket timeout, the HTTP connection is kept between calls
+        :param timeout: Socket timeout in seconds
+        """
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class XmlRpcTransferBackend(TransferBackend):
+
+    def __init__(self, port=9011, timeout=30):
+        """
+        Push the file content over XML-RPC to the ApolloFileAgent of each Apollo server,
+        one proxy is kept per machine so the HTTP connection can be reused
+        :param port: ApolloFileAgent port
+        :param timeout: Socket timeout in seconds
+        """
+        self.port = port
+        self.timeout = timeout
+        self.proxies = {}  # {machine: xmlrpc.client.ServerProxy}
+        self.lock = threading.Lock()
+
+    def transfer(self, remote_machine, local_file_path, target_path):
+        with open(local_file_path, 'rb') as rf:
+            content = xmlrpc.client.Binary(rf.read())
+        with self.lock:
+            agent = self.proxies.get(remote_machine)
+            if not agent:
+                agent = self.proxies[remote_machine] = xmlrpc.client.ServerProxy(
+                    'http://{}:{}'.format(remote_machine, self.port), transport=TimeoutTransport(self.timeout))
+        try:
+            agent.receive_file(os.path.basename(local_file_path), content, target_path)
+        except (OSError, xmlrpc.client.Error) as ex:
+            with self.lock:
+                self.proxies.pop(remote_machine, None)
+            agent('close')()
+            raise TransferError('xml-rpc transfer to ({}) failed: {}'.format(remote_machine, ex))
+
+    def remove_expired(self, remote_machine, target_path, prefix, max_age):
+        with self.lock:
+            agent = self.proxies.get(remote_machine)
+        if not agent:  # Only called after a transfer, the proxy is created again by the next one
+            return
+        try:
+            agent.remove_expired_files(target_path, prefix, max_age)
+        except (OSError, xmlrpc.client.Error) as ex:
+            raise TransferError('xml-rpc cleanup of ({}) failed: {}'.format(remote_machine, ex))
+
+    def close(self):
+        with self.lock:
+            proxies, self.proxies = self.proxies, {}
+        for agent in proxies.values():
+            agent('close')()
+
+
+class ApolloFileAgent(object):
+
+    def __init__(self, root_directory='/'):
+        """
+        XML-RPC agent on the Apollo server receiving the files of XmlRpcTransferBackend,
+        also used as a local stand-in server for testing
+        :param root_directory: Directory the target paths are relative to, e.g. a temporary directory when testing
+        """
+        self.root_directory = root_directory
+
+    @staticmethod
+    def check_file_name(file_name):
+        """
+        Only plain file names are accepted, the agent has no authentication
+        :param str file_name: File name or file name prefix
+        :return:
+        """
+        if not file_name or '/' in file_name or '\\' in file_name or '..' in file_name:
+            raise ValueError('Invalid file name: {}'.format(file_name))
+
+    def get_target_directory(self, target_path):
+        """
+        Resolve the target path under self.root_directory, paths leaving the root directory are rejected
+        :param str target_path: Target directory, e.g. /tftpboot/
+        :return: Real path of the target directory
+        """
+        root_directory = os.path.realpath(self.root_directory)
+        target_directory = os.path.realpath(os.path.join(root_directory, target_path.lstrip('/\\')))
+        if os.path.commonpath([root_directory, target_directory]) != root_directory:
+            raise ValueError('Invalid target path: {}'.format(target_path))
+        return target_directory
+
+    def receive_file(self, file_name, content, target_path):
+        """
+        Write the received file into the target path, the file is replaced atomically
+        :param str file_name: File name without directory
+        :param xmlrpc.client.Binary content: File content
+        :param str target_path: Target directory, e.g. /tftpboot/
+        :return: True
+        """
+        self.check_file_name(file_name)
+        target_directory = self.get_target_directory(target_path)
+        os.makedirs(target_directory, exist_ok=True)
+        file_path = os.path.join(target_directory, file_name)
+        with open(file_path + '.tmp', 'wb') as wf:
+            wf.write(content.data)
+        os.replace(file_path + '.tmp', file_path)
+        logger.debug('Receive file {} ({} bytes)'.format(file_path, len(content.data)))
+        return True
+
+    def remove_expired_files(self, target_path, prefix, max_age):
+        """
+        Remove the files of the target path whose name starts with prefix and which are older than max_age
+        :param str target_path: Target directory, e.g. /tftpboot/
+        :param str prefix: File name prefix, e.g. cpp_automated_data_
+        :param max_age: Age in seconds
+        :return: Number of removed files
+        """
+        self.check_file_name(prefix)
+        target_directory = self.get_target_directory(target_path)
+        if not os.path.isdir(target_directory):
+            return 0
+        expired_time = time.time() - max_age
+        removed_number = 0
+        for entry in os.scandir(target_directory):
+            if entry.name.startswith(prefix) and entry.is_file() and entry.stat().st_mtime < expired_time:
+                os.remove(entry.path)
+                removed_number += 1
+        logger.debug('Remove {} expired files from {}'.format(removed_number, target_directory))
+        return removed_number
+
+    def serve(self, ip_address='', port=9011):
+        """
+        Start the XML-RPC server of the agent
+        :param ip_address: Fill in the server ip address
+        :param port: Fill in the server port
+        :return:
+        """
+        server = SimpleXMLRPCServer((ip_address, port), logRequests=False, allow_none=True)
+        # Only the file API is exposed, not the other methods of this instance
+        server.register_function(self.receive_file)
+        server.register_function(self.remove_expired_files)
+        logger.debug('Apollo file agent {} Listening on port {} ...'.format(ip_address, port))
+        server.serve_forever()
+
+
+class LatencyStats(object):
+
+    def __init__(self, sample_size=1024):
+        """
+        Thread-safe latency statistics per name, the percentiles use the latest sample_size samples
+        :param sample_size: Number of latest samples kept per name
+        """
+        self.sample_size = sample_size
+        self.stats = {}  # {name: [count, total seconds, max seconds, deque of latest samples]}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0.0, 0.0, deque(maxlen=self.sample_size)]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            stat[3].append(seconds)
+
+    def summary(self):
+        """
+        Summarize the statistics in milliseconds
+        :return: {name: {'count', 'avg_ms', 'p50_ms', 'p95_ms', 'max_ms'}}
+        """
+        with self.lock:
+            stats = {name: (count, total, maximum, sorted(samples))
+                     for name, (count, total, maximum, samples) in self.stats.items()}
+        result = {}
+        for name, (count, total, maximum, samples) in stats.items():
+            result[name] = {
+                'count': count,
+                'avg_ms': round(total / count * 1000, 3),
+                'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+                'p95_ms': round(samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000, 3),
+                'max_ms': round(maximum * 1000, 3),
+            }
+        return result
+
+
+class LatencyTracer(object):
+    # (stage, start event, end event)
+    stages = (
+        ('queue', 'read', 'transfer_start'),
+        ('transfer', 'transfer_start', 'transferred'),
+        ('history', 'transferred', 'recorded'),
+        ('apollo', 'transferred', 'status_received'),
+        ('status_update', 'status_received', 'status_updated'),
+        ('total', 'read', 'status_updated'),
+    )
+
+    def __init__(self, max_traces=10000):
+        """
+        Follow each scan row by its trace id from the table read to the update of its test status,
+        the duration of each stage is logged as JSON by trace_logger and added to the LatencyStats
+        :param max_traces: Maximum number of unfinished traces, the oldest are dropped
+        """
+        self.max_traces = max_traces
+        self.traces = OrderedDict()  # {trace id: {'machine', 'cell', 'events': {event: time}}}
+        self.cell_traces = {}  # {(machine, cell): latest trace id}, the test status does not carry the trace id
+        self.stats = LatencyStats()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_trace_id():
+        return uuid.uuid4().hex[:16]
+
+    def start(self, trace_id, machine, cell):
+        with self.lock:
+            self.traces[trace_id] = {'machine': str(machine), 'cell': str(cell), 'events': {'read': time.time()}}
+            self.cell_traces[(str(machine), str(cell))] = trace_id
+            while len(self.traces) > self.max_traces:
+                _, trace = self.traces.popitem(last=False)
+                self.forget_cell(trace)
+
+    def forget_cell(self, trace):
+        key = (trace['machine'], trace['cell'])
+        if key in self.cell_traces and self.cell_traces[key] not in self.traces:
+            del self.cell_traces[key]
+
+    def event(self, name, trace_id=None, machine=None, cell=None):
+        """
+        Record an event of a trace, only the first event of each name counts
+        :param name: Event name of self.stages
+        :param trace_id: Trace id, found from machine and cell if empty
+        :param machine: Machine name
+        :param cell: Cell
+        :return:
+        """
+        now = time.time()
+        durations = []
+        with self.lock:
+            if not trace_id:
+                trace_id = self.cell_traces.get((str(machine), str(cell)))
+            trace = self.traces.get(trace_id)
+            if trace is None or name in trace['events']:
+                return
+            events = trace['events']
+            events[name] = now
+            for stage, start_event, end_event in self.stages:
+                if end_event == name and start_event in events:
+                    durations.append((stage, now - events[start_event]))
+            if name == 'status_updated':
+                del self.traces[trace_id]
+                self.forget_cell(trace)
+        for stage, seconds in durations:
+            self.stats.record(stage, seconds)
+            trace_logger.info(json.dumps({'trace_id': trace_id, 'machine': trace['machine'], 'cell': trace['cell'],
+                                          'stage': stage, 'ms': round(seconds * 1000, 3)}))
+
+    def summary(self):
+        result = self.stats.summary()
+        result['active_traces'] = len(self.traces)
+        return result
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep the connection open between the calls of one client
+    timeout = 10  # Seconds a started request has to arrive completely
+
+    def handle(self):
+        # Handle one request per worker turn, the server parks the connection until its next request arrives
+        self.close_connection = True
+        self.handle_one_request()
+
+
+class PooledXMLRPCServer(SimpleXMLRPCServer):
+    request_queue_size = 64
+    keep_alive_timeout = 60  # Idle keep-alive connections are closed after this many seconds
+
+    def __init__(self, address, max_workers=16, **kwargs):
+        """
+        XML-RPC server handling each request in a bounded worker pool,
+        when all workers are busy new connections wait in the listen backlog.
+        Between two requests a keep-alive connection is parked in a selector and holds no worker
+        :param address: (ip address, port)
+        :param max_workers: Maximum number of requests handled at the same time
+        :param kwargs: Other SimpleXMLRPCServer parameters
+        """
+        super().__init__(address, requestHandler=KeepAliveRequestHandler, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rpc')
+        self.worker_slots = threading.BoundedSemaphore(max_workers)
+        self.latency_stats = LatencyStats()
+        self.idle_connections = queue.SimpleQueue()  # (request, client_address) to be parked
+        self.idle_wakeup, self.idle_notify = socket.socketpair()
+        self.idle_closed = threading.Event()
+        threading.Thread(target=self.park_idle_connections, name='rpc-idle', daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.worker_slots.acquire()
+        self.executor.submit(self.process_request_in_worker, request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_in_worker(self, request, client_address):
+        keep_alive = False
+        try:
+            keep_alive = not self.finish_request(request, client_address).close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.worker_slots.release()
+            if keep_alive and not self.idle_closed.is_set():
+                self.idle_connections.put((request, client_address))
+                self.idle_notify.send(b'\0')
+            else:
+                self.shutdown_request(request)
+
+    def park_idle_connections(self):
+        """
+        Wait for the next request of the idle keep-alive connections without holding a worker,
+        a connection is handed to the worker pool again as soon as it is readable
+        :return:
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.idle_wakeup, selectors.EVENT_READ)
+        while not self.idle_closed.is_set():
+            while not self.idle_connections.empty():
+                request, client_address = self.idle_connections.get()
+                selector.register(request, selectors.EVENT_READ, (client_address, time.monotonic()))
+
+            for key, _ in selector.select(timeout=1):
+                if key.fileobj is self.idle_wakeup:
+                    self.idle_wakeup.recv(4096)
+                    continue
+                selector.unregister(key.fileobj)
+                self.process_request(key.fileobj, key.data[0])  # Also a closed connection, the worker closes it
+
+            current_time = time.monotonic()
+            for key in list(selector.get_map().values()):
+                if key.data and current_time - key.data[1] > self.keep_alive_timeout:
+                    selector.unregister(key.fileobj)
+                    self.shutdown_request(key.fileobj)
+
+        for key in list(selector.get_map().values()):
+            if key.data:
+                self.shutdown_request(key.fileobj)
+        selector.close()
+
+    def _dispatch(self, method, params):
+        # Called once per method, also for each call inside system.multicall
+        start_time = time.perf_counter()
+        try:
+            return super()._dispatch(method, params)
+        finally:
+            if method in self.funcs:  # Unknown method names are not kept
+                self.latency_stats.record(method, time.perf_counter() - start_time)
+
+    def server_close(self):
+        super().server_close()
+        self.idle_closed.set()
+        self.idle_notify.send(b'\0')
+        self.executor.shutdown(wait=False)
 
 
 class ApolloAutomation(object):
     # CPP machine constants
     cpp_data_file = 'cpp_automated_data.json'
     cpp_data_path = os.path.join(os.getcwd(), cpp_data_file)
+    cpp_data_directory = 'cpp_automated_data'
+    cpp_data_directory_path = os.path.join(os.getcwd(), cpp_data_directory)
     cpp_data_record_directory = 'cpp_automated_data_history'
     cpp_data_record_directory_path = os.path.join(os.getcwd(), cpp_data_record_directory)
     apollo_test_status_directory = 'apollo_test_status'
     apollo_test_status_path = os.path.join(os.getcwd(), apollo_test_status_directory)
+    apollo_status_journal_file = 'apollo_test_status_journal.jsonl'
+    apollo_status_journal_path = os.path.join(os.getcwd(), apollo_status_journal_file)
+    cpp_data_journal_file = 'cpp_automated_data_journal.jsonl'
+    cpp_data_journal_path = os.path.join(os.getcwd(), cpp_data_journal_file)
+    cpp_payload_prefix = 'cpp_automated_data_'  # Name prefix of the batched payload files
     # Apollo machine constants
     apollo_target_path = '/tftpboot/'
+    # Apollo server names in the scan table, ODBC LIKE patterns
+    apollo_machine_patterns = ('fxcavp_%', 'fxcapp_%')
     apollo_account = ''
     apollo_password = ''
 
-    def __init__(self, access_table_path='', table_names=None):
+    def __init__(self, access_table_path='', table_names=None, transfer_backend=None, table_backend=None):
         """
         Access table parameter initialization
         :param str access_table_path: Fill in the access table path
         :param tuple table_names: Fill in the Access table names
+        :param TransferBackend transfer_backend: File transfer to the Apollo servers, default pscp
+        :param TableBackend table_backend: Storage of the tables, default the Access table of access_table_path
         """
+        self.transfer_backend = transfer_backend or PscpTransferBackend(account=self.apollo_account,
+                                                                        password=self.apollo_password)
         self.access_table_path = access_table_path
+        self.drain_batch_size = 200  # Maximum number of scan rows read from the table at a time
+        self.scan_id_column = None  # Autonumber or timestamp column of the scan table, its MAX is added to the probe
+        self.scan_full_read_interval = 30  # Seconds after which the scan table is read even if the probe is the same
+        self.scan_probe = None  # Probe of the scan table when it was last read empty
+        self.last_full_read_time = 0
+        self.max_dispatch_workers = 8  # Maximum number of Apollo servers transferred to at the same time
+        self.transfer_batch_window = 0  # Seconds the rows of one Apollo server are collected, 0 for one row per file
+        self.transfer_batch_size = 32  # Maximum number of rows in one payload file
+        self.payload_retention = 86400  # Seconds the payload files are kept on the Apollo server, 0 to keep them
+        self.payload_cleanup_interval = 600  # Minimum seconds between two cleanups of one Apollo server
+        self.payload_cleanup_times = {}  # {machine: time of the last cleanup}
+        self.payload_sequence = itertools.count(1)
+        self.latency_tracer = LatencyTracer()
+        self.transfer_retries = 3  # Attempts of one transfer, a row still failing stays in the journal
+        self.transfer_retry_interval = 5
+        self.journal_retry_interval = 60  # Seconds after which the rows given up by the transfer stage are retried
+        self.cpp_data_journal = None  # Scan rows which are read from the table but not transferred and recorded yet
+        self.dispatched_ids = set()  # Journal record ids being transferred or recorded
+        self.dispatched_lock = threading.Lock()
+        self.history_queue = queue.Queue(maxsize=1000)  # (journal record id, scan information) to be recorded
+        self.history_store = None  # Created on the first record
+        self.stop_event = threading.Event()  # Set to stop the loops of send_data_to_apollo
+        self.max_rpc_workers = 16  # Maximum number of Apollo server connections handled at the same time
+        self.rpc_server = None
+        self.status_queue = queue.Queue()  # (journal record id, [machine, cell, test status])
+        self.status_journal = None  # Created by write_status_queue, the RPC status is written to files until then
+        self.status_batch_size = 500  # Maximum number of test status updated in one transaction
+        self.status_retry_interval = 60  # Seconds between two updates of the status whose machine was not found
         if table_names:
             self.ccd_scan_table_name, self.link_position_table_name = table_names
+        self.table_backend = table_backend
+        if table_backend is None and access_table_path:
+            self.table_backend = AccessTableBackend(access_table_path)
 
     def transfer_file_to_apollo(self, remote_machine, local_file_path, target_path, first_connection=False):
         """
-        The feature use the PSCP command for file transfer to the remote apollo server
+        The feature use self.transfer_backend for file transfer to the remote apollo server
         :param remote_machine: Fill in the remote apollo server name
         :param local_file_path: Fill in the path of the local file to be transferred
         :param target_path: Fill in the placement file path for the Apollo server
-        :param first_connection: The server needs to be set to True for the first connection
+        :param first_connection: Kept for compatibility, the backends accept the host key of a new server themselves
         :return:
         """
-        if first_connection:
-            cmd1 = r'echo y|pscp {} {}@{}:{}'.format(local_file_path, self.apollo_account,
-                                                     remote_machine, target_path)
-            os.system(cmd1)
-        # Transfer the local file to the Apollo server
-        cmd2 = r'echo {}|pscp {} {}@{}:{}'.format(self.apollo_password, local_file_path, self.apollo_account,
-                                                  remote_machine, target_path)
-        os.system(cmd2)
+        # Transfer the local file to the Apollo server, TransferError is raised on failure
+        self.transfer_backend.transfer(remote_machine=remote_machine, local_file_path=local_file_path,
+                                       target_path=target_path)
         logger.debug('Transfer file to apollo server ({}) successful'.format(remote_machine))
 
-    def write_json_file(self, content):
+    def get_cpp_data_path(self, machine):
+        """
+        Each machine has its own json file, so machines can be transferred concurrently,
+        the file name stays the same because the Apollo server reads it by name
+        :param machine: Apollo server name
+        :return: json file path
+        """
+        return os.path.join(self.cpp_data_directory_path, machine, self.cpp_data_file)
+
+    def write_json_file(self, content, file_path=None):
         """
         Write the json file
         :param content: Fill in the information to be written
+        :param file_path: Fill in the json file path, default self.cpp_data_path
         :return:
         """
-        with open(self.cpp_data_path, 'w', encoding='utf-8') as wf:
+        file_path = file_path or self.cpp_data_path
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8') as wf:
             wf.write(json.dumps(content, ensure_ascii=False, indent=2) + '\n')
         logger.debug('Write json file successful')
 
-    def read_access_table(self):
+    def read_access_table(self, before_delete=None):
+        """
+        Connect to the access table and drain a batch of Apollo server scan information,
+        the rows are only selected when the probe of the table changed since it was last read empty
+        :param before_delete: Function called with the scan information list before the rows are deleted
+        :return: List of test container scan information, empty if there is no new scan
         """
-        Connect to the access table to read the specified scan information
-        :return: Test container scan information or None
+        with self.table_backend.connection() as cnxn:
+            probe = self.probe_scan_table(cnxn)
+            if probe == self.scan_probe and time.time() - self.last_full_read_time < self.scan_full_read_interval:
+                return []
+            self.last_full_read_time = start_time = time.time()
+            result = self.read_scan_data(cnxn, before_delete=before_delete)
+            # Taken before the select, so a row inserted after it changes the next probe
+            self.scan_probe = None if result else probe
+            if result:
+                self.latency_tracer.stats.record('read_table', time.time() - start_time)
+            return result
+
+    def probe_scan_table(self, cnxn):
+        """
+        Row count of the scan table and the maximum of self.scan_id_column if it is set
+        :param cnxn: Connection borrowed from the table backend
+        :return: tuple
         """
-        cnxn = pyodbc.connect(r'DRIVER={Microsoft Access Driver (*.mdb)};DBQ=%s' % (self.access_table_path,))
         crsr = cnxn.cursor()
         try:
-            # Query all data in the table
-            data_list = [data for data in crsr.execute("SELECT * from {}".format(self.ccd_scan_table_name))]
+            columns = 'COUNT(*)' + (', MAX({})'.format(self.scan_id_column) if self.scan_id_column else '')
+            probe = tuple(crsr.execute('SELECT {} FROM {}'.format(columns, self.ccd_scan_table_name)).fetchone())
+            # Nothing is written by a probe, end the read transaction so the robot software is not blocked
+            cnxn.commit()
+        finally:
+            crsr.close()
+        return probe
+
+    def read_scan_data(self, cnxn, before_delete=None):
+        """
+        Read up to self.drain_batch_size Apollo server rows of the scan table and delete them in one transaction
+        :param cnxn: Connection borrowed from the table backend
+        :param before_delete: Function called with the scan information list before the rows are deleted,
+                              the rows are kept in the table if it raises
+        :return: List of test container scan information
+        """
+        crsr = cnxn.cursor()
+        try:
+            # Query only the rows of the Apollo servers
+            data_list = crsr.execute(self.table_backend.select_top_sql(self.drain_batch_size, self.ccd_scan_table_name,
+                                                                       'machine LIKE ? OR machine LIKE ?'),
+                                     tuple(self.apollo_machine_patterns)).fetchall()
+            if not data_list:
+                return []
             logger.info('Read the table({}) data:\n{}'.format(self.ccd_scan_table_name, data_list))
 
-            result = None
-            if data_list:
-                cpp_data = dict()
-                for item in data_list:
-                    # Match only the Apollo server
-                    condition = re.match('fxcavp.+|fxcapp.+', item[0])
-                    if condition:
-                        cpp_data['machine'] = item[0]
-                        cpp_data['cell'] = item[1]
-                        cpp_data['sn'] = item[2]
-                        cpp_data['pn'] = item[3]
-                        # Delete the captured row data
-                        crsr.execute("DELETE FROM {} WHERE machine='{}' and cell='{}'"
-                                     .format(self.ccd_scan_table_name, cpp_data['machine'], cpp_data['cell']))
-                        # Submit changes
-                        crsr.commit()
-                        result = cpp_data
-                        break
+            result = []
+            captured_keys = set()
+            for item in data_list:
+                # The same machine and cell is only transferred once, all of its rows are deleted together
+                if (item[0], item[1]) in captured_keys:
+                    continue
+                captured_keys.add((item[0], item[1]))
+                result.append({'machine': item[0], 'cell': item[1], 'sn': item[2], 'pn': item[3]})
+            if before_delete is not None:
+                before_delete(result)
+
+            # Delete the captured row data and submit the changes in one transaction
+            crsr.executemany("DELETE FROM {} WHERE machine=? AND cell=?".format(self.ccd_scan_table_name),
+                             [(data['machine'], data['cell']) for data in result])
+            cnxn.commit()
         finally:
             crsr.close()
-            cnxn.close()
         return result
 
     def update_access_table(self, machine, cell, test_status):
@@ -125,27 +1567,46 @@ class ApolloAutomation(object):
         :param test_status: Fill in the machine's test status
         :return: 'PASS' or 'No data found'
         """
-        cnxn = pyodbc.connect(r'DRIVER={Microsoft Access Driver (*.mdb)};DBQ=%s' % (self.access_table_path,))
+        return self.update_access_table_batch([(machine, cell, test_status)])[0]
+
+    def update_access_table_batch(self, test_status_list):
+        """
+        Connect to Microsoft's access table and update the test status of several machines in one transaction
+        :param list test_status_list: Fill in the (machine, cell, test_status) to be updated
+        :return: List of 'PASS' or 'No data found', in the order of test_status_list
+        """
+        with self.table_backend.connection() as cnxn:
+            return self.update_link_positions(cnxn, test_status_list=test_status_list)
+
+    def update_link_positions(self, cnxn, test_status_list):
+        """
+        Update the test status of each machine and cell in the link position table with parameterized UPDATEs,
+        the affected row count tells whether the machine and cell exist, all changes are committed once
+        :param cnxn: Connection borrowed from the table backend
+        :param list test_status_list: Fill in the (machine, cell, test_status) to be updated
+        :return: List of 'PASS' or 'No data found'
+        """
+        results = []
         crsr = cnxn.cursor()
         try:
-            check_list = [i for i in crsr.execute("SELECT * from {} WHERE machine='{}' and cell='{}'"
-                                                  .format(self.link_position_table_name, machine, cell))]
-            if not check_list:
-                logger.warning('No (Cell {}) data information for ({}) server was found in the ({}) table,'
-                               ' Please check!'.format(cell, machine, self.link_position_table_name))
-                return 'No data found'
-
-            # Updates the state of the specified server and container
-            crsr.execute("UPDATE {} SET passfail='{}' WHERE machine='{}' and cell='{}'".format
-                         (self.link_position_table_name, test_status, machine, cell))
+            for machine, cell, test_status in test_status_list:
+                # Updates the state of the specified server and container
+                crsr.execute("UPDATE {} SET passfail=? WHERE machine=? AND cell=?"
+                             .format(self.link_position_table_name), (test_status, machine, cell))
+                if crsr.rowcount == 0:
+                    logger.warning('No (Cell {}) data information for ({}) server was found in the ({}) table,'
+                                   ' Please check!'.format(cell, machine, self.link_position_table_name))
+                    results.append('No data found')
+                    continue
+                logger.debug('Change the (cell {}) status of the ({}) server to "{}" in the ({}) table, '
+                             'Number of updates: {}'.format(cell, machine, test_status,
+                                                            self.link_position_table_name, crsr.rowcount))
+                results.append('PASS')
             # Submit changes
-            crsr.commit()
+            cnxn.commit()
         finally:
             crsr.close()
-            cnxn.close()
-        logger.debug('Change the (cell {}) status of the ({}) server to "{}" in the ({}) table, Number of updates: {}'
-                     .format(cell, machine, test_status, self.link_position_table_name, crsr.rowcount))
-        return 'PASS'
+        return results
 
     @staticmethod
     def read_local_ip_address():
@@ -166,12 +1627,42 @@ class ApolloAutomation(object):
         """
         return True
 
-    def write_test_status_to_windows(self, apollo_test_status):
+    def get_latency_summary(self):
+        """
+        Latency statistics of each stage of the traced scan rows
+        :return: {stage: {'count', 'avg_ms', 'p50_ms', 'p95_ms', 'max_ms'}, 'active_traces': number}
+        """
+        return self.latency_tracer.summary()
+
+    def get_rpc_latency(self):
         """
-        Write the test status transferred from the Apollo server into the local apollo_test_status directory
+        Latency statistics of each RPC method
+        :return: {method: {'count', 'avg_ms', 'p50_ms', 'p95_ms', 'max_ms'}}
+        """
+        return self.rpc_server.latency_stats.summary() if self.rpc_server else {}
+
+    def write_test_status_to_windows(self, apollo_test_status, trace_id=''):
+        """
+        Receive the test status transferred from the Apollo server,
+        it is journaled and queued for write_status_queue when that thread is running,
+        otherwise it is written into the local apollo_test_status directory
         :param str apollo_test_status: Fill in the apollo test status, The format must be "ApolloServerName_Cell_Status"
+        :param str trace_id: Trace id of the payload row, the latest trace of the machine and cell if empty
         :return:
         """
+        test_status = apollo_test_status.split('_')
+        if len(test_status) == 3:
+            self.latency_tracer.event('status_received', trace_id=trace_id, machine=test_status[0],
+                                      cell=test_status[1])
+        if self.status_journal is not None:
+            if len(test_status) != 3:
+                raise ValueError('Test status format error: {}, the format must be "ApolloServerName_Cell_Status"'
+                                 .format(apollo_test_status))
+            record_id = self.status_journal.append(test_status)
+            self.status_queue.put((record_id, test_status))
+            logger.debug('Queue the apollo test status successful, test status is:\n{}'.format(apollo_test_status))
+            return True
+
         if not os.path.exists(self.apollo_test_status_path):
             raise FileNotFoundError('Not found the Apollo_test_status directory in windows, Please check!')
 
@@ -182,7 +1673,8 @@ class ApolloAutomation(object):
 
     def setup_socket_server(self, ip_address='', port=9010):
         """
-        register a function to respond to XML-RPC requests and start XML-RPC server
+        register the Apollo server API to respond to XML-RPC requests and start XML-RPC server,
+        the calls from different Apollo servers are handled concurrently
         :param ip_address: Fill in the server ip address
         :param port: Fill in the server port
         :return:
@@ -191,112 +1683,384 @@ class ApolloAutomation(object):
         ip_address = ip_address or self.read_local_ip_address()
         try:
             # Start the xml-rpc socket service
-            server = SimpleXMLRPCServer((ip_address, port))
+            self.rpc_server = PooledXMLRPCServer((ip_address, port), max_workers=self.max_rpc_workers,
+                                                 logRequests=False)
             logger.debug('Server {} Listening on port {} ...'.format(ip_address, port))
-            server.register_instance(ApolloAutomation())
-            server.serve_forever()
+            # Only the API of the Apollo servers is exposed, not the other methods of this instance
+            for function in (self.communication_test, self.write_test_status_to_windows, self.get_latency_summary,
+                             self.get_rpc_latency, self.query_cpp_history):
+                self.rpc_server.register_function(function)
+            self.rpc_server.register_multicall_functions()
+            self.rpc_server.serve_forever()
         except Exception as ex:
             raise Exception('Setup socket server error:\n{}'.format(ex))
 
     def record_cpp_data(self, data):
         """
-        Record the CPP data into the cpp_automated_data_history directory
+        Record the CPP data into the history store of the cpp_automated_data_history directory
         :param data: cpp data
         :return:
         """
-        if not os.path.exists(self.cpp_data_record_directory_path):
-            os.mkdir(self.cpp_data_record_directory_path)
-            logger.debug('Create ({}) directory under {} path successfully'
-                         .format(self.cpp_data_record_directory, self.cpp_data_record_directory_path))
+        if self.history_store is None:
+            self.history_store = CppDataHistoryStore(self.cpp_data_record_directory_path)
+        self.history_store.append(data)
+
+    def query_cpp_history(self, machine='', cell='', start_date='', end_date=''):
+        """
+        Query the recorded CPP data, e.g. all scans of fxcavp12 last week
+        :param machine: Machine name, empty for all
+        :param cell: Cell, empty for all
+        :param start_date: First day "YYYY-MM-DD", empty for no limit
+        :param end_date: Last day "YYYY-MM-DD" (included), empty for no limit
+        :return: List of {'time': "YYYY-MM-DD HH:MM:SS", 'data': cpp data}
+        """
+        if self.history_store is None:
+            self.history_store = CppDataHistoryStore(self.cpp_data_record_directory_path)
+        start_time = time.mktime(time.strptime(start_date, '%Y-%m-%d')) if start_date else None
+        end_time = time.mktime(time.strptime(end_date, '%Y-%m-%d')) + 86400 if end_date else None
+        records = self.history_store.query(machine=machine or None, cell=cell or None,
+                                           start_time=start_time, end_time=end_time)
+        return [{'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time'])), 'data': record['data']}
+                for record in records]
+
+    def process_cpp_data(self, received):
+        """
+        Write the scan information to the json file of its machine and transfer it to the Apollo server
+        :param received: Test container scan information
+        :return:
+        """
+        logger.info('Received the table ({}) information:\n{}'.format(self.ccd_scan_table_name, received))
+        cpp_data_path = self.get_cpp_data_path(machine=received['machine'])
+        # Write the automated data transfer to json file
+        self.write_json_file(content=received, file_path=cpp_data_path)
+        # Transfer the json file to the corresponding apollo server
+        self.transfer_file_to_apollo(remote_machine=received['machine'],
+                                     local_file_path=cpp_data_path,
+                                     target_path=self.apollo_target_path,
+                                     first_connection=True)
 
-        current_time = time.strftime('%Y-%m-%d %H-%M-%S')
-        paste_file = '{} {}_{}.json'.format(current_time, data['machine'], data['cell'])
-        shutil.copy(self.cpp_data_path, os.path.join(self.cpp_data_record_directory_path, paste_file))
+    def get_payload_name(self, machine):
+        """
+        Unique payload file name, so the payloads of different batches never overwrite each other
+        :param machine: Apollo server name
+        :return: File name
+        """
+        return '{}{}_{}_{}_{:06d}.json'.format(self.cpp_payload_prefix, machine, time.strftime('%Y%m%d-%H%M%S'),
+                                               os.getpid(), next(self.payload_sequence))
+
+    def remove_expired_payloads(self, machine):
+        """
+        Remove the payload files older than self.payload_retention from the Apollo server,
+        at most once every self.payload_cleanup_interval seconds, a failed cleanup is retried after the next payload
+        :param machine: Apollo server name
+        :return:
+        """
+        if not self.payload_retention \
+                or time.time() - self.payload_cleanup_times.get(machine, 0) < self.payload_cleanup_interval:
+            return
+        try:
+            self.transfer_backend.remove_expired(remote_machine=machine, target_path=self.apollo_target_path,
+                                                 prefix=self.cpp_payload_prefix, max_age=self.payload_retention)
+            self.payload_cleanup_times[machine] = time.time()
+        except TransferError as ex:
+            logger.warning('Remove the expired payload files of ({}) failed: {}'.format(machine, ex))
+
+    def process_cpp_batch(self, received_list):
+        """
+        Write the scan information of one machine into a payload file with a manifest,
+        transfer it to the Apollo server and delete the local file
+        :param received_list: Test container scan information of the same machine
+        :return:
+        """
+        machine = received_list[0]['machine']
+        payload_name = self.get_payload_name(machine)
+        logger.info('Received the table ({}) information for {}:\n{}'.format(self.ccd_scan_table_name, machine,
+                                                                             received_list))
+        content = {
+            'manifest': {
+                'payload': payload_name,
+                'machine': machine,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'count': len(received_list),
+                'cells': [received['cell'] for received in received_list],
+            },
+            'rows': received_list,
+        }
+        payload_path = os.path.join(self.cpp_data_directory_path, machine, payload_name)
+        self.write_json_file(content=content, file_path=payload_path)
+        try:
+            self.transfer_file_to_apollo(remote_machine=machine, local_file_path=payload_path,
+                                         target_path=self.apollo_target_path)
+        finally:
+            os.remove(payload_path)
+        self.remove_expired_payloads(machine)
+
+    def journal_scan_data(self, data_list):
+        """
+        Record the scan information into the journal, the rows are read again when the delete of a previous drain
+        failed, those already pending in the journal are not recorded twice but returned again
+        if they are not being transferred any more
+        :param data_list: List of test container scan information
+        :return: List of (journal record id, scan information) to be dispatched
+        """
+        pending_items = {tuple(data[key] for key in ('machine', 'cell', 'sn', 'pn')): (record_id, data)
+                         for record_id, data in self.cpp_data_journal.replay()}
+        new_list = []
+        stuck_list = []
+        with self.dispatched_lock:
+            for data in data_list:
+                pending_item = pending_items.get(tuple(data[key] for key in ('machine', 'cell', 'sn', 'pn')))
+                if pending_item is None:
+                    new_list.append(data)
+                elif pending_item[0] not in self.dispatched_ids:
+                    stuck_list.append(pending_item)
+        for data in new_list:
+            data['trace_id'] = self.latency_tracer.new_trace_id()
+            self.latency_tracer.start(data['trace_id'], machine=data['machine'], cell=data['cell'])
+        return stuck_list + list(zip(self.cpp_data_journal.append_many(new_list), new_list))
+
+    def dispatch_journaled_data(self, dispatcher, items):
+        """
+        Submit journaled scan information to the transfer stage, they are in flight until they are recorded
+        or given up by the transfer stage
+        :param MachineDispatcher dispatcher: Dispatcher of the transfer stage
+        :param items: List of (journal record id, scan information)
+        :return:
+        """
+        with self.dispatched_lock:
+            self.dispatched_ids.update(record_id for record_id, _ in items)
+        for record_id, received in items:
+            dispatcher.submit(machine=received['machine'], data=(record_id, received))
+
+    def transfer_journaled_data(self, items):
+        """
+        Transfer stage, process journaled scan information of one machine and pass them to the history stage,
+        they are retried self.transfer_retries times and then left in the journal,
+        the drain loop dispatches them again every self.journal_retry_interval seconds
+        :param items: List of (journal record id, scan information)
+        :return:
+        """
+        received_list = [received for _, received in items]
+        for received in received_list:
+            self.latency_tracer.event('transfer_start', trace_id=received.get('trace_id'))
+        for attempt in range(1, self.transfer_retries + 1):
+            try:
+                if self.transfer_batch_window:
+                    self.process_cpp_batch(received_list=received_list)
+                else:
+                    for received in received_list:
+                        self.process_cpp_data(received=received)
+                break
+            except Exception as ex:
+                logger.warning('Transfer {} attempt {} failed: {}'.format(received_list, attempt, ex))
+                if attempt == self.transfer_retries:
+                    logger.error('Give up {}, it is kept in the journal {} and retried later'
+                                 .format(received_list, self.cpp_data_journal_path))
+                    with self.dispatched_lock:
+                        self.dispatched_ids.difference_update(record_id for record_id, _ in items)
+                    return
+                time.sleep(self.transfer_retry_interval)
+        for received in received_list:
+            self.latency_tracer.event('transferred', trace_id=received.get('trace_id'))
+        # Blocks the transfer workers while the history stage is behind
+        for item in items:
+            self.history_queue.put(item)
+
+    def record_cpp_history(self):
+        """
+        History stage, record the transferred scan information and mark them done in the journal
+        :return:
+        """
+        while not self.stop_event.is_set():
+            try:
+                items = [self.history_queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    items.append(self.history_queue.get_nowait())
+                except queue.Empty:
+                    break
+            done_ids = []
+            for record_id, data in items:
+                try:
+                    self.record_cpp_data(data=data)
+                    self.latency_tracer.event('recorded', trace_id=data.get('trace_id'))
+                except Exception as ex:
+                    logger.exception(ex)
+                done_ids.append(record_id)
+            self.cpp_data_journal.mark_done(done_ids)
+            with self.dispatched_lock:
+                self.dispatched_ids.difference_update(done_ids)
+
+    def retry_journaled_data(self, dispatcher):
+        """
+        Dispatch again the journaled scan information which is not in flight, i.e. given up by the transfer stage,
+        e.g. while its Apollo server was rebooting
+        :param MachineDispatcher dispatcher: Dispatcher of the transfer stage
+        :return:
+        """
+        with self.dispatched_lock:
+            retry_list = [(record_id, received) for record_id, received in self.cpp_data_journal.replay()
+                          if record_id not in self.dispatched_ids]
+        if retry_list:
+            logger.info('Retry {} scan rows from the journal'.format(len(retry_list)))
+            self.dispatch_journaled_data(dispatcher, retry_list)
 
     def send_data_to_apollo(self):
         """
         While the loop scans the data in the Access table, if any, it will transfer the data to the Apollo server
+        The rows go through three stages: drain (this loop, rows are journaled before they are deleted),
+        transfer (dispatched by machine, a slow Apollo server only delays its own data) and history,
+        the rows left in the journal by a previous run are transferred first,
+        the rows given up by the transfer stage are dispatched again every self.journal_retry_interval seconds
+        :return:
+        """
+        self.cpp_data_journal = WriteAheadJournal(self.cpp_data_journal_path)
+        dispatcher = MachineDispatcher(handler=self.transfer_journaled_data, max_workers=self.max_dispatch_workers,
+                                       batch_size=self.transfer_batch_size if self.transfer_batch_window else 1,
+                                       batch_window=self.transfer_batch_window)
+        threading.Thread(target=self.record_cpp_history, daemon=True).start()
+        resumed_list = self.cpp_data_journal.replay()
+        if resumed_list:
+            logger.info('Resume {} scan rows from the journal'.format(len(resumed_list)))
+        for record_id, received in resumed_list:
+            # The resumed rows are traced from now on, with the trace id given before the restart if any
+            received.setdefault('trace_id', self.latency_tracer.new_trace_id())
+            self.latency_tracer.start(received['trace_id'], machine=received['machine'], cell=received['cell'])
+        self.dispatch_journaled_data(dispatcher, resumed_list)
+
+        last_retry_time = time.time()
+        while not self.stop_event.is_set():
+            try:
+                # Do not drain more rows from the table while a full batch is still waiting for transfer
+                dispatcher.wait_pending_below(self.drain_batch_size)
+                if time.time() - last_retry_time >= self.journal_retry_interval:
+                    last_retry_time = time.time()
+                    self.retry_journaled_data(dispatcher)
+                journaled_list = []
+                try:
+                    self.read_access_table(
+                        before_delete=lambda data_list: journaled_list.extend(self.journal_scan_data(data_list)))
+                finally:
+                    # Also when the delete failed, the journaled rows are transferred and not read as new again
+                    self.dispatch_journaled_data(dispatcher, journaled_list)
+                if not journaled_list:
+                    self.stop_event.wait(1)
+            except Exception as ex:
+                logger.exception(ex)
+                self.stop_event.wait(1)
+
+    def update_test_status(self):
+        """
+        Watch the local apollo_test_status path and update the test status files to the access data table,
+        the files arriving together are updated in one transaction and deleted after the update
         :return:
         """
+        watcher = StatusFileWatcher(directory=self.apollo_test_status_path, pattern=r'fx.+?_.+?_.+?\.txt')
         while True:
             try:
-                received = self.read_access_table()
-                if received:
-                    logger.info('Received the table ({}) information:\n{}'.format(self.ccd_scan_table_name, received))
-                    # Write the automated data transfer to json file
-                    self.write_json_file(content=received)
-                    # Transfer the json file to the corresponding apollo server
-                    self.transfer_file_to_apollo(remote_machine=received['machine'],
-                                                 local_file_path=self.cpp_data_path,
-                                                 target_path=self.apollo_target_path,
-                                                 first_connection=True)
-                    # Record the cpp data
-                    self.record_cpp_data(data=received)
-                else:
-                    time.sleep(1)
+                test_status_files = watcher.wait_files()
+                if not test_status_files:
+                    continue
+                logger.info('Captured files: {}'.format(test_status_files))
+
+                # Format to check
+                test_status_list = [tuple(file.split('.txt')[0].split('_')) for file in test_status_files]
+                valid_files = [file for file, test_status in zip(test_status_files, test_status_list)
+                               if len(test_status) == 3]
+                test_status_list = [test_status for test_status in test_status_list if len(test_status) == 3]
+                for machine, cell, _ in test_status_list:
+                    self.latency_tracer.event('status_received', machine=machine, cell=cell)
+
+                # Start updating the access data table
+                updated_status_list = self.update_access_table_batch(test_status_list)
+
+                # Delete test status files whose status has been updated
+                for file, test_status, updated_status in zip(valid_files, test_status_list, updated_status_list):
+                    if updated_status == 'PASS':
+                        self.latency_tracer.event('status_updated', machine=test_status[0], cell=test_status[1])
+                        updated_file = os.path.join(self.apollo_test_status_path, file)
+                        if os.path.exists(updated_file):
+                            os.remove(updated_file)
+                        logger.debug('Delete {} successful'.format(updated_file))
             except Exception as ex:
                 logger.exception(ex)
+                watcher.request_rescan()  # The files are kept, pick them up again
                 time.sleep(1)
 
-    def update_test_status(self):
+    def write_status_queue(self):
         """
-        Loop through the files under the local apollo_test_status path
-        and update the data in the files to the access data table, if any
+        Update the queued test status to the access data table, the status queued together is updated
+        in one transaction, the status whose machine and cell are not found is retried every
+        self.status_retry_interval seconds, the journaled status is queued again at start
         :return:
         """
+        self.status_journal = WriteAheadJournal(self.apollo_status_journal_path)
+        for record_id, test_status in self.status_journal.replay():
+            self.status_queue.put((record_id, test_status))
+        retry_list = []
+        next_retry_time = time.time() + self.status_retry_interval
+        failed_list = []
         while True:
+            batch = failed_list
+            failed_list = []
+            if not batch:
+                try:
+                    batch.append(self.status_queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+            while len(batch) < self.status_batch_size:
+                try:
+                    batch.append(self.status_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if retry_list and time.time() >= next_retry_time:
+                batch.extend(retry_list)
+                retry_list = []
+                next_retry_time = time.time() + self.status_retry_interval
+            if not batch:
+                continue
+
             try:
-                if not os.path.exists(self.apollo_test_status_path):
-                    os.mkdir(self.apollo_test_status_path)
-                    logger.debug('Create ({}) directory under {} path successfully'
-                                 .format(self.apollo_test_status_directory, self.apollo_test_status_path))
-
-                # Read the test status information from the apollo_test_status directory
-                test_status_list = os.listdir(self.apollo_test_status_path)
-
-                if test_status_list:
-                    logger.debug('Read the file under path {}:\n{}'.format(self.apollo_test_status_path,
-                                                                           test_status_list))
-                    for file in test_status_list:
-                        if re.match(r'fx.+?_.+?_.+?\.txt', file):
-                            logger.info('Captured file: {}'.format(file))
-                            # Format to check
-                            machine, cell, test_status = file.split('.txt')[0].split('_')
-                            # Start updating the access data table
-                            updated_status = self.update_access_table(machine=machine,
-                                                                      cell=cell,
-                                                                      test_status=test_status)
-                            # Delete test status files whose status has been updated
-                            if updated_status == 'PASS':
-                                updated_file = os.path.join(self.apollo_test_status_path, file)
-                                if os.path.exists(updated_file):
-                                    os.remove(updated_file)
-                                logger.debug('Delete {} successful'.format(updated_file))
-                else:
-                    time.sleep(1)
+                updated_status_list = self.update_access_table_batch([tuple(test_status) for _, test_status in batch])
             except Exception as ex:
                 logger.exception(ex)
+                failed_list = batch  # Update them again
                 time.sleep(1)
+                continue
+            done_ids = []
+            for (record_id, test_status), updated_status in zip(batch, updated_status_list):
+                if updated_status == 'PASS':
+                    done_ids.append(record_id)
+                    self.latency_tracer.event('status_updated', machine=test_status[0], cell=test_status[1])
+                else:
+                    retry_list.append((record_id, test_status))
+            self.status_journal.mark_done(done_ids)
 
 
-def main(access_table_path, table_names):
+def main(access_table_path, table_names, transfer_backend=None, table_backend=None):
     """
     Connect to the access data table to read the data and send it to the Apollo server,
     and receive the data from the Apollo server to update it to the access data table
     :param str access_table_path: Fill in the access table path
     :param tuple table_names: Fill in the Access table names
+    :param TransferBackend transfer_backend: File transfer to the Apollo servers, default pscp
+    :param TableBackend table_backend: Storage of the tables, default the Access table of access_table_path
     :return:
     """
-    handle = ApolloAutomation(access_table_path=access_table_path, table_names=table_names)
+    handle = ApolloAutomation(access_table_path=access_table_path, table_names=table_names,
+                              transfer_backend=transfer_backend, table_backend=table_backend)
     threads = []
 
     # Multi-threaded setup
     setup_socket_server = threading.Thread(target=handle.setup_socket_server, args=())
     send_data_to_apollo = threading.Thread(target=handle.send_data_to_apollo, args=())
     update_test_status = threading.Thread(target=handle.update_test_status, args=())
+    write_status_queue = threading.Thread(target=handle.write_status_queue, args=())
 
     # Add multi-threaded to threads list
-    for t in [setup_socket_server, send_data_to_apollo, update_test_status]:
+    for t in [setup_socket_server, send_data_to_apollo, update_test_status, write_status_queue]:
         threads.append(t)
 
     # Start all threads
@@ -0,0 +1,321 @@
+"""
+ApolloAutomation pipeline benchmark on a SQLite table backend
+
+====================================
+
+Runs the real send_data_to_apollo, update_test_status and write_status_queue threads against a SQLite database
+with the same tables as the Access database, files are "transferred" by a fake backend which only waits
+1. Scan rows: synthetic rows are inserted into the scan table at --scan-rate rows/s,
+   measures rows/s and the latency from the insert to the end of the transfer,
+   the fake Apollo server answers each row with a PASS status after --apollo-test-ms
+2. RPC status: write_test_status_to_windows is called from --rpc-clients threads,
+   measures status/s and the latency from the call to the commit of the update
+3. File status: status files are dropped into the apollo_test_status directory,
+   measures status/s and the latency from the file creation to the commit of the update
+The per-stage latency summary of the traced rows is added to the results, which are saved as a JSON file
+
+***********************************************
+Run from the command line:
+python benchmark.py --rows 2000 --machines 40 --transfer-delay-ms 20
+Tune the batch and worker sizes:
+python benchmark.py --drain-batch-size 50 --dispatch-workers 16 --status-batch-size 100
+Send the rows of one machine as batched payload files:
+python benchmark.py --batch-window-ms 500
+***********************************************
+"""
+# -*- coding:utf-8 -*-
+# @Time     : 2026/10/19
+# @Python   : 3.7
+# @System   : Linux
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+import threading
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from automatic_transfer_data import ApolloAutomation, SqliteTableBackend, TransferBackend, logger
+
+# Command line parameters
+parser = argparse.ArgumentParser()
+parser.add_argument("--rows", type=int, default=2000, help="Number of synthetic scan rows, 0 to skip")
+parser.add_argument("--scan-rate", type=float, default=500, help="Inserted scan rows per second, 0 for all at once")
+parser.add_argument("--machines", type=int, default=40, help="Number of Apollo servers")
+parser.add_argument("--cells", type=int, default=8, help="Number of cells of each Apollo server")
+parser.add_argument("--transfer-delay-ms", type=float, default=20, help="Duration of one fake transfer")
+parser.add_argument("--apollo-test-ms", type=float, default=50,
+                    help="Delay of the PASS status answered for each transferred row, 0 for no answer")
+parser.add_argument("--statuses", type=int, default=2000, help="Number of RPC test status, 0 to skip")
+parser.add_argument("--rpc-clients", type=int, default=16, help="Threads calling write_test_status_to_windows")
+parser.add_argument("--status-files", type=int, default=500, help="Number of test status files, 0 to skip")
+parser.add_argument("--drain-batch-size", type=int, default=200, help="ApolloAutomation.drain_batch_size")
+parser.add_argument("--dispatch-workers", type=int, default=8, help="ApolloAutomation.max_dispatch_workers")
+parser.add_argument("--batch-window-ms", type=float, default=0,
+                    help="ApolloAutomation.transfer_batch_window, 0 for one transfer per row")
+parser.add_argument("--scan-id-column", default='', help="ApolloAutomation.scan_id_column, e.g. rowid")
+parser.add_argument("--status-batch-size", type=int, default=500, help="ApolloAutomation.status_batch_size")
+parser.add_argument("--timeout", type=float, default=300, help="Maximum seconds of each phase")
+parser.add_argument("--output", default='transfer_benchmark_results.json', help="JSON file of the results")
+parser.add_argument("--work-dir", default='', help="Working directory, default a temporary directory")
+
+
+class FakeTransferBackend(TransferBackend):
+
+    def __init__(self, delay, answer_delay=0):
+        """
+        Wait delay seconds instead of transferring, the completion time of each serial number is recorded
+        :param delay: Seconds of one transfer
+        :param answer_delay: Seconds after which each row is answered with a PASS status, 0 for no answer
+        """
+        self.delay = delay
+        self.answer_delay = answer_delay
+        self.handle = None  # ApolloAutomation receiving the answers
+        self.completed = {}  # {sn: completion time}
+        self.transfer_number = 0
+        self.lock = threading.Lock()
+
+    def transfer(self, remote_machine, local_file_path, target_path):
+        with open(local_file_path, encoding='utf-8') as rf:
+            content = json.load(rf)
+        time.sleep(self.delay)
+        with self.lock:
+            self.transfer_number += 1
+            for row in content.get('rows', [content]):
+                self.completed[row['sn']] = time.time()
+        if self.answer_delay:
+            for row in content.get('rows', [content]):
+                test_status = '{}_{}_PASS'.format(row['machine'], row['cell'])
+                threading.Timer(self.answer_delay, self.handle.write_test_status_to_windows,
+                                args=(test_status, row.get('trace_id', ''))).start()
+
+
+class BenchmarkAutomation(ApolloAutomation):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.status_completed = {}  # {(machine, cell, status): commit time}
+        self.status_lock = threading.Lock()
+
+    def update_access_table_batch(self, test_status_list):
+        results = super().update_access_table_batch(test_status_list)
+        completion_time = time.time()
+        with self.status_lock:
+            for test_status, result in zip(test_status_list, results):
+                if result == 'PASS':
+                    self.status_completed[tuple(test_status)] = completion_time
+        return results
+
+
+def create_database(database_path, options):
+    cnxn = sqlite3.connect(database_path)
+    cnxn.execute('CREATE TABLE tbl_CCDScanData (machine TEXT, cell TEXT, sn TEXT, pn TEXT)')
+    cnxn.execute('CREATE TABLE tbl_linkPosition (machine TEXT, cell TEXT, passfail TEXT)')
+    cnxn.execute('CREATE INDEX link_index ON tbl_linkPosition (machine, cell)')
+    cnxn.executemany('INSERT INTO tbl_linkPosition VALUES (?, ?, ?)',
+                     [('fxcavp{}'.format(machine), str(cell), '')
+                      for machine in range(options.machines) for cell in range(options.cells)])
+    # The cells of the scan rows, answered by the fake Apollo servers
+    cnxn.executemany('INSERT INTO tbl_linkPosition VALUES (?, ?, ?)',
+                     [('fxcavp{}'.format(index % options.machines), 'scan{}'.format(index), '')
+                      for index in range(options.rows)])
+    cnxn.commit()
+    cnxn.close()
+
+
+def get_percentiles(latencies):
+    """
+    Latency percentiles in milliseconds
+    :param latencies: List of seconds
+    :return: dict
+    """
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    result = {}
+    for name, ratio in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+        result[name] = round(latencies[min(int(len(latencies) * ratio), len(latencies) - 1)] * 1000, 2)
+    result['max_ms'] = round(latencies[-1] * 1000, 2)
+    return result
+
+
+def wait_completed(completed, number, timeout):
+    deadline = time.time() + timeout
+    while len(completed) < number and time.time() < deadline:
+        time.sleep(0.01)
+    return len(completed) >= number
+
+
+def run_scan_phase(handle, database_path, options):
+    """
+    Insert synthetic scan rows and wait until all of them are transferred
+    :return: dict
+    """
+    inserted = {}  # {sn: insert time}
+    cnxn = sqlite3.connect(database_path, timeout=30)
+    batch_size = 10
+    start_time = time.time()
+    for first in range(0, options.rows, batch_size):
+        if options.scan_rate:
+            time.sleep(max(start_time + first / options.scan_rate - time.time(), 0))
+        rows = [('fxcavp{}'.format(index % options.machines), 'scan{}'.format(index), 'sn{}'.format(index), 'pn')
+                for index in range(first, min(first + batch_size, options.rows))]
+        cnxn.executemany('INSERT INTO tbl_CCDScanData VALUES (?, ?, ?, ?)', rows)
+        cnxn.commit()
+        insert_time = time.time()
+        for row in rows:
+            inserted[row[2]] = insert_time
+    cnxn.close()
+
+    completed = handle.transfer_backend.completed
+    finished = wait_completed(completed, options.rows, options.timeout)
+    last_time = max(completed.values()) if completed else time.time()
+    return {
+        'rows': options.rows,
+        'transferred': len(completed),
+        'transfers': handle.transfer_backend.transfer_number,
+        'finished': finished,
+        'rows_per_second': round(len(completed) / max(last_time - start_time, 1e-6), 1),
+        'latency': get_percentiles([completed[sn] - inserted[sn] for sn in completed if sn in inserted]),
+    }
+
+
+def run_rpc_status_phase(handle, options):
+    """
+    Call write_test_status_to_windows from several threads and wait until all the status are committed
+    :return: dict
+    """
+    called = {}
+
+    def call_status(client_index):
+        for index in range(client_index, options.statuses, options.rpc_clients):
+            test_status = ('fxcavp{}'.format(index % options.machines),
+                           str(index // options.machines % options.cells), 'RPC{}'.format(index))
+            called[test_status] = time.time()
+            handle.write_test_status_to_windows('_'.join(test_status))
+
+    start_time = time.time()
+    threads = [threading.Thread(target=call_status, args=(client_index,))
+               for client_index in range(options.rpc_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize_status_phase(handle, called, options.statuses, start_time, options.timeout)
+
+
+def run_file_status_phase(handle, options):
+    """
+    Drop status files into the apollo_test_status directory and wait until all the status are committed
+    :return: dict
+    """
+    created = {}
+    start_time = time.time()
+    for index in range(options.status_files):
+        test_status = ('fxcavp{}'.format(index % options.machines),
+                       str(index // options.machines % options.cells), 'FILE{}'.format(index))
+        file_name = os.path.join(handle.apollo_test_status_path, '_'.join(test_status) + '.txt')
+        with open(file_name + '.tmp', 'w') as wf:
+            wf.write('_'.join(test_status))
+        os.replace(file_name + '.tmp', file_name)
+        created[test_status] = time.time()
+    return summarize_status_phase(handle, created, options.status_files, start_time, options.timeout)
+
+
+def summarize_status_phase(handle, sent, number, start_time, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with handle.status_lock:
+            completed = dict((test_status, handle.status_completed[test_status])
+                             for test_status in sent if test_status in handle.status_completed)
+        if len(completed) >= number:
+            break
+        time.sleep(0.01)
+    last_time = max(completed.values()) if completed else time.time()
+    return {
+        'status': number,
+        'committed': len(completed),
+        'finished': len(completed) >= number,
+        'status_per_second': round(len(completed) / max(last_time - start_time, 1e-6), 1),
+        'latency': get_percentiles([completed[test_status] - sent[test_status] for test_status in completed]),
+    }
+
+
+def main():
+    options = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+    work_directory = options.work_dir or tempfile.mkdtemp(prefix='transfer_benchmark_')
+    os.makedirs(work_directory, exist_ok=True)
+    database_path = os.path.join(work_directory, 'template.sqlite')
+    create_database(database_path, options)
+
+    class Automation(BenchmarkAutomation):
+        cpp_data_path = os.path.join(work_directory, ApolloAutomation.cpp_data_file)
+        cpp_data_directory_path = os.path.join(work_directory, ApolloAutomation.cpp_data_directory)
+        cpp_data_record_directory_path = os.path.join(work_directory, ApolloAutomation.cpp_data_record_directory)
+        cpp_data_journal_path = os.path.join(work_directory, ApolloAutomation.cpp_data_journal_file)
+        apollo_test_status_path = os.path.join(work_directory, ApolloAutomation.apollo_test_status_directory)
+        apollo_status_journal_path = os.path.join(work_directory, ApolloAutomation.apollo_status_journal_file)
+
+    handle = Automation(table_names=('tbl_CCDScanData', 'tbl_linkPosition'),
+                        transfer_backend=FakeTransferBackend(options.transfer_delay_ms / 1000,
+                                                             options.apollo_test_ms / 1000),
+                        table_backend=SqliteTableBackend(database_path))
+    handle.transfer_backend.handle = handle
+    handle.drain_batch_size = options.drain_batch_size
+    handle.max_dispatch_workers = options.dispatch_workers
+    handle.status_batch_size = options.status_batch_size
+    handle.scan_id_column = options.scan_id_column or None
+    handle.transfer_batch_window = options.batch_window_ms / 1000
+    os.makedirs(handle.apollo_test_status_path, exist_ok=True)
+
+    results = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'settings': vars(options),
+    }
+    send_thread = threading.Thread(target=handle.send_data_to_apollo)
+    send_thread.start()
+    threading.Thread(target=handle.update_test_status, daemon=True).start()
+    threading.Thread(target=handle.write_status_queue, daemon=True).start()
+    while handle.status_journal is None:
+        time.sleep(0.01)
+    try:
+        if options.rows:
+            print('Run the scan row phase')
+            results['scan_rows'] = run_scan_phase(handle, database_path, options)
+            print(json.dumps(results['scan_rows'], indent=2))
+        if options.statuses:
+            print('Run the RPC status phase')
+            results['rpc_status'] = run_rpc_status_phase(handle, options)
+            print(json.dumps(results['rpc_status'], indent=2))
+        if options.status_files:
+            print('Run the status file phase')
+            results['file_status'] = run_file_status_phase(handle, options)
+            print(json.dumps(results['file_status'], indent=2))
+        if options.rows and options.apollo_test_ms:
+            deadline = time.time() + options.timeout
+            while handle.latency_tracer.summary().get('total', {}).get('count', 0) < options.rows \
+                    and time.time() < deadline:
+                time.sleep(0.05)
+        results['stages'] = handle.get_latency_summary()
+        print('Latency of the stages')
+        print(json.dumps(results['stages'], indent=2))
+    finally:
+        handle.stop_event.set()
+        send_thread.join()
+        handle.table_backend.close()
+        if not options.work_dir:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    with open(options.output, 'w', encoding='utf-8') as wf:
+        wf.write(json.dumps(results, indent=2) + '\n')
+    print('The results are saved to: {}'.format(options.output))
+
+
+if __name__ == '__main__':
+    main()